@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import calendar
+import logging
+try:
+    import numpy
+except ImportError:
+    # the reports are optional, "stats" says so where they would be
+    numpy = None
+
+import dbase
+import exporter
+
+log = logging.getLogger('mpsd')
+
+# One play in the cache: when, what and how long for, -1 if not known
+DTYPE = [('date', '<i8'), ('track', '<i4'), ('listentime', '<i4')]
+# bumped when the cache file's layout changes, to have it read again
+VERSION = 1
+# how far back from the latest play a refresh reads again, as listen
+# times are updated after the play is recorded
+OVERLAP = 86400
+# a play is a skip if less than this much of the track was listened to
+SKIPPED = 0.5
+
+# read through exporter.chunks()
+ROWS = '''SELECT coalesce(play.listentime, -1), \
+        play.date, play.source, play.track FROM %s AS play'''
+
+def utc_offset(t):
+    """
+    Seconds local time is ahead of UTC at epoch time t.
+    """
+    return calendar.timegm(time.localtime(t)) - t
+
+class Plays(object):
+    """
+    Every play in a database, archived ones included, as columns of
+    numpy arrays: date (seconds since the epoch), track and listentime.
+
+    They are kept in path (next to the database by default) as a flat
+    file of DTYPE records that is memory mapped rather than read, with
+    how far it got in path.json. refresh() only reads the plays recorded
+    since, and the last OVERLAP seconds of them again. If the database
+    lost plays or gained some before that (eg. by an import), they are
+    read in full into a new file. Where path can't be written the plays
+    are read into memory every time instead.
+    """
+    def __init__(self, db_path, path=None):
+        self.db_path = db_path
+        self.path = path or db_path + '.plays'
+        self.meta = self.path + '.json'
+        self.plays = numpy.zeros(0, DTYPE)
+        self.local = numpy.zeros(0, 'i8')
+        # by track id
+        self.artist = numpy.zeros(0, 'i4')
+        self.length = numpy.zeros(0, 'i4')
+        self.names = {}     # artist id -> name
+
+    def __len__(self):
+        return len(self.plays)
+
+    def refresh(self):
+        db = dbase.connect_readonly(self.db_path)
+        try:
+            try:
+                self.update(db)
+            except (IOError, OSError) as err:
+                log.warning("Could not cache plays in %s: %s"
+                        % (self.path, err))
+                self.plays = self.read(db)
+            self.loadTracks(db)
+        finally:
+            db.close()
+        self.localize()
+
+    def count(self, db):
+        """
+        The number of plays in the database and its archives.
+        """
+        c = db.cursor()
+        c.execute('''SELECT count(*) FROM play''')
+        total = c.fetchone()[0]
+        try:
+            c.execute('''SELECT path, plays FROM archive''')
+        except sqlite3.OperationalError:
+            return total
+        # exporter.chunks() skips missing archives
+        return total + sum(plays for path, plays in c.fetchall()
+                if os.path.exists(path))
+
+    def read(self, db, cursor=(-1, '', -1)):
+        """
+        The plays after cursor as a DTYPE array.
+        """
+        parts = [numpy.zeros(0, DTYPE)]
+        for rows, cursor in exporter.chunks(db, ROWS, cursor, 10000):
+            parts.append(numpy.array([(date, track, listentime)
+                for listentime, date, source, track in rows], DTYPE))
+        return numpy.concatenate(parts)
+
+    def readMeta(self):
+        try:
+            f = open(self.meta)
+        except IOError:
+            return None
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+        finally:
+            f.close()
+
+    def writeMeta(self, meta):
+        tmp = self.meta + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(meta, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.meta)
+
+    def mapped(self, rows):
+        if not rows:
+            # an empty file can't be mapped
+            return numpy.zeros(0, DTYPE)
+        return numpy.memmap(self.path, DTYPE, 'r', shape=(rows,))
+
+    def update(self, db):
+        """
+        Bring the cache file up to date and map it.
+        """
+        lock = open(self.path + '.lock', 'a')
+        try:
+            # one refresh at a time, eg. the daemon's and "mpsd stats"
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            rows = self.extend(db, self.readMeta())
+            if rows == None:
+                rows = self.rewrite(db)
+            self.plays = self.mapped(rows)
+            self.writeMeta({'version': VERSION, 'rows': rows,
+                'last': int(self.plays['date'].max()) if rows else -1})
+        finally:
+            lock.close()
+
+    def extend(self, db, meta):
+        """
+        Add the plays since the last refresh to the cache file. Returns
+        how many it then holds, or None if it has to be read in full.
+        """
+        size = numpy.dtype(DTYPE).itemsize
+        if not meta or meta['version'] != VERSION or not meta['rows'] \
+                or not os.path.exists(self.path) \
+                or os.path.getsize(self.path) != meta['rows'] * size:
+            return None
+        cut = meta['last'] - OVERLAP
+        recent = numpy.flatnonzero(self.mapped(meta['rows'])['date'] >= cut)
+        kept = meta['rows'] - len(recent)
+        # plays older than cut that came in since (eg. imported) would be
+        # in the middle
+        if len(recent) and recent[0] != kept:
+            return None
+        new = self.read(db, (cut, '', -1))
+        if len(new) < len(recent) or kept + len(new) != self.count(db):
+            return None
+        # written over rather than truncated, as other processes may have
+        # the file mapped
+        f = open(self.path, 'r+b')
+        try:
+            f.seek(kept * size)
+            f.write(new.tobytes())
+        finally:
+            f.close()
+        return kept + len(new)
+
+    def rewrite(self, db):
+        """
+        Read every play into a new cache file. Returns how many there are.
+        """
+        new = self.read(db)
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(new.tobytes())
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        log.info("Cached %d plays in %s" % (len(new), self.path))
+        return len(new)
+
+    def loadTracks(self, db):
+        c = db.cursor()
+        c.execute('''SELECT id, coalesce(artist, 0), coalesce(length, 0) \
+                FROM track''')
+        tracks = numpy.array(c.fetchall(), 'i8').reshape(-1, 3)
+        size = max(int(tracks[:, 0].max()) + 1 if len(tracks) else 0,
+                int(self.plays['track'].max()) + 1 if len(self.plays) else 0)
+        self.artist = numpy.zeros(size, 'i4')
+        self.length = numpy.zeros(size, 'i4')
+        self.artist[tracks[:, 0]] = tracks[:, 1]
+        self.length[tracks[:, 0]] = tracks[:, 2]
+        c.execute('''SELECT id, name FROM artist''')
+        self.names = dict(c.fetchall())
+
+    def localize(self):
+        """
+        Work out the local time of each play, one UTC offset per hour.
+        """
+        hours, inverse = numpy.unique(self.plays['date'] // 3600,
+                return_inverse=True)
+        offsets = numpy.array([utc_offset(int(hour) * 3600)
+            for hour in hours], 'i8')
+        self.local = self.plays['date'] + offsets[inverse.reshape(-1)]
+
+    def days(self):
+        """
+        The local day of each play, in days since the epoch.
+        """
+        return self.local // 86400
+
+def today():
+    return (int(time.time()) + utc_offset(int(time.time()))) // 86400
+
+def day_text(day):
+    return str(numpy.datetime64(int(day), 'D'))
+
+# Reports take a Plays and return (columns, rows) as queries would
+
+def heatmap(plays):
+    """
+    Plays by day of the week and hour of the day.
+    """
+    hour = (plays.local // 3600) % 24
+    # the epoch was a thursday
+    weekday = (plays.days() + 3) % 7
+    counts = numpy.bincount(weekday * 24 + hour, minlength=7 * 24) \
+            .reshape(7, 24)
+    return (['Day'] + ['%d' % hour for hour in range(24)],
+            [[calendar.day_name[day]] + counts[day].tolist()
+                for day in range(7)])
+
+def streaks(plays, limit=10):
+    """
+    The longest runs of days with at least one play, the latest first of
+    equally long ones.
+    """
+    columns = ['From', 'To', 'Days', 'Plays']
+    days, counts = numpy.unique(plays.days(), return_counts=True)
+    if not len(days):
+        return columns, []
+    ends = numpy.flatnonzero(numpy.diff(days) != 1)
+    starts = numpy.concatenate([[0], ends + 1])
+    ends = numpy.concatenate([ends, [len(days) - 1]])
+    lengths = days[ends] - days[starts] + 1
+    totals = numpy.add.reduceat(counts, starts)
+    best = numpy.lexsort((-starts, -lengths))[:limit]
+    return columns, [[day_text(days[starts[i]]), day_text(days[ends[i]]),
+        int(lengths[i]), int(totals[i])] for i in best]
+
+def trends(plays, months=12, limit=10):
+    """
+    Plays per month of the artists played most over the last months.
+    """
+    month = plays.days().astype('datetime64[D]').astype('datetime64[M]') \
+            .astype('i8')
+    this = numpy.datetime64(today(), 'D').astype('datetime64[M]') \
+            .astype('i8')
+    recent = (month > this - months) & (month <= this)
+    artist = plays.artist[plays.plays['track'][recent]]
+    month = month[recent] - (this - months + 1)
+    played = numpy.bincount(artist, minlength=1)
+    played[0] = 0   # no artist
+    top = numpy.argsort(-played, kind='mergesort')[:limit]
+    top = top[played[top] > 0]
+    rank = numpy.full(len(played), -1, 'i8')
+    rank[top] = numpy.arange(len(top))
+    mine = rank[artist] >= 0
+    counts = numpy.bincount(rank[artist][mine] * months + month[mine],
+            minlength=len(top) * months).reshape(len(top), months)
+    labels = [str(numpy.datetime64(int(m), 'M'))
+            for m in range(this - months + 1, this + 1)]
+    return (['Artist'] + labels + ['Total'],
+            [[plays.names.get(int(a))] + counts[i].tolist() + [int(played[a])]
+                for i, a in enumerate(top)])
+
+def skips(plays, limit=10, minimum=20):
+    """
+    How often plays stopped before SKIPPED of the track: over all plays
+    with a listen time, then for the artists skipped the most that have
+    at least minimum of those.
+    """
+    columns = ['Artist', 'Plays', 'Skipped', 'Skip Rate %']
+    length = plays.length[plays.plays['track']]
+    listentime = plays.plays['listentime']
+    timed = (listentime >= 0) & (length > 0)
+    skipped = timed & (listentime < SKIPPED * length)
+    artist = plays.artist[plays.plays['track']]
+    total = numpy.bincount(artist[timed], minlength=1)
+    by_artist = numpy.bincount(artist[skipped], minlength=len(total))
+    timed, skipped = int(timed.sum()), int(skipped.sum())
+    rows = [['All artists', timed, skipped,
+        round(100.0 * skipped / max(timed, 1), 1)]]
+    total[0] = 0    # no artist
+    enough = numpy.flatnonzero(total >= minimum)
+    rate = by_artist[enough] / total[enough].astype('f8')
+    for i in enough[numpy.argsort(-rate, kind='mergesort')[:limit]]:
+        rows.append([plays.names.get(int(i)), int(total[i]),
+            int(by_artist[i]), round(100.0 * by_artist[i] / total[i], 1)])
+    return columns, rows
+
+REPORTS = {
+    'heatmap': heatmap,
+    'streaks': streaks,
+    'trends': trends,
+    'skips': skips,
+}
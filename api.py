@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import logging
+try:
+    from Queue import Queue
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from queue import Queue
+    from urllib.parse import urlparse, parse_qs
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import dbase
+import search
+import metrics
+
+log = logging.getLogger('mpsd')
+
+# what /top/<key> returns for each of the dbase.STATS keys
+TOP = {
+    'artist': ('''SELECT artist.id AS id, artist.name AS name''',
+        '''LEFT JOIN artist ON (artist.id = top.artist)'''),
+    'album': ('''SELECT album.id AS id, album.title AS title, \
+            artist.name AS artist''',
+        '''LEFT JOIN album ON (album.id = top.album) \
+            LEFT JOIN artist ON (artist.id = album.artist)'''),
+    'track': ('''SELECT track.id AS id, track.title AS title, \
+            artist.name AS artist, album.title AS album''',
+        '''LEFT JOIN track ON (track.id = top.track) \
+            LEFT JOIN artist ON (artist.id = track.artist) \
+            LEFT JOIN album ON (album.id = track.album)'''),
+    'genre': ('''SELECT top.genre AS genre''', ''''''),
+}
+
+# plays from the union of the play tables given
+PLAY = '''SELECT datetime(play.date, 'unixepoch', 'localtime') AS date, \
+        play.date AS timestamp, nullif(play.source, '') AS source, \
+        play.listentime AS listentime, track.id AS id, \
+        track.title AS title, artist.name AS artist, album.title AS album \
+        FROM (%s) AS play LEFT JOIN track ON (track.id = play.track) \
+        LEFT JOIN artist ON (artist.id = track.artist) \
+        LEFT JOIN album ON (album.id = track.album)'''
+
+# the most archive databases attached for one request
+MAX_ATTACHED = 8
+
+class BadRequest(Exception):
+    pass
+
+class NotFound(Exception):
+    pass
+
+class NeedArchives(Exception):
+    """
+    A query needs the plays in the (year, path) archives given, which can
+    only be attached outside of a transaction.
+    """
+    pass
+
+def rows(c):
+    columns = [d[0] for d in c.description]
+    return [dict(zip(columns, row)) for row in c.fetchall()]
+
+def number(params, name, default, high=None):
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise BadRequest("%s must be a number" % name)
+    if value < 0 or (high and value > high):
+        raise BadRequest("%s must be between 0 and %s" % (name, high))
+    return value
+
+class ApiHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics':
+            body = metrics.REGISTRY.text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            etag, body = self.server.respond(url.path, parse_qs(url.query))
+        except BadRequest:
+            return self.reply(400, {'error': str(sys.exc_info()[1])})
+        except NotFound:
+            return self.reply(404, {'error': "No such resource"})
+        except dbase.sqlite3.Error:
+            log.error("API query failed: %s" % (sys.exc_info()[1]))
+            return self.reply(503, {'error': "Database error"})
+        if etag and etag == self.headers.get('If-None-Match'):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.reply(200, body, etag)
+
+    def reply(self, code, body, etag=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s" % (self.address_string(), format % args))
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    """
+    A read-only JSON view of the database for dashboards:
+
+        /now                        what each mpd server is playing
+        /recent?limit=&source=      the latest plays
+        /top/KEY?days=&limit=&by=   top artists, albums, tracks or genres,
+                                    by plays or listentime, over the last
+                                    days (all time if not given)
+        /track/ID?limit=            a track and its latest plays
+        /search?q=&limit=           artists, albums and tracks by name,
+                                    see search.search()
+        /metrics                    mpsd's metrics, for Prometheus
+
+    Plays can be limited to those at or after and before a time, in
+    seconds since the epoch, with after= and before=. Archived plays (see
+    MpsdDB.archive()) are included when the database doesn't have enough
+    plays in that range; the archives they are in are attached for the
+    request only.
+
+    Queries run on a small pool of read-only connections, which never
+    hold up the writer as the database is in WAL mode. Responses carry an
+    ETag made from the database's change counts (the changes table, see
+    dbase._count_changes()), and are kept until those change, so polling
+    an unchanged database only costs reading the counts; a matching
+    If-None-Match gets a 304.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, db_path, now_playing=None, connections=4,
+            cache_size=256):
+        HTTPServer.__init__(self, address, ApiHandler)
+        self.db_path = db_path
+        self.now_playing = now_playing or (lambda: [])
+        self.pool = Queue()
+        for i in range(connections):
+            self.pool.put(None)     # connected when first needed
+        self.cache = dbase.LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def connection(self):
+        db = self.pool.get()
+        if db == None:
+            try:
+                db = dbase.connect_readonly(self.db_path)
+            except dbase.sqlite3.Error:
+                self.pool.put(None)
+                raise
+        return db
+
+    def version(self, c):
+        """
+        The change counts of the database, None if it has none.
+        """
+        try:
+            c.execute('''SELECT group_concat(name || ':' || count) \
+                    FROM changes''')
+        except dbase.sqlite3.OperationalError:
+            return None
+        return c.fetchone()[0]
+
+    def respond(self, path, params):
+        """
+        Returns (etag, body) for a GET of path.
+        """
+        if path == '/now':
+            body = json.dumps({'players': self.now_playing()}) \
+                    .encode('utf-8')
+            return '"%s"' % hashlib.md5(body).hexdigest(), body
+
+        request = repr((path, sorted(params.items())))
+        db = self.connection()
+        c = db.cursor()
+        attached = []   # (year, schema name or None if missing)
+        try:
+            while True:
+                try:
+                    etag, body, fresh = self.snapshot(c, request, path,
+                            params, attached)
+                    break
+                except NeedArchives:
+                    for year, archive in sys.exc_info()[1].args[0]:
+                        if not os.path.exists(archive):
+                            log.warning("Archive of %d is missing: %s"
+                                    % (year, archive))
+                            attached.append((year, None))
+                            continue
+                        name = 'archive_%d' % year
+                        c.execute('''ATTACH ? AS %s''' % name, [archive])
+                        attached.append((year, name))
+        finally:
+            for year, name in attached:
+                if name:
+                    c.execute('''DETACH %s''' % name)
+            self.pool.put(db)
+        if fresh and etag:
+            with self.lock:
+                self.cache.put(request, (etag, body))
+        return etag, body
+
+    def snapshot(self, c, request, path, params, attached):
+        """
+        Returns (etag, body, whether it was just made) for a GET of path.
+        """
+        # the counts and the answer from the same snapshot
+        c.execute('''BEGIN''')
+        try:
+            version = self.version(c)
+            key = "%s %s" % (request, version)
+            if 'days' in params:
+                key += c.execute('''SELECT date('now', 'localtime')''') \
+                        .fetchone()[0]
+            etag = '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
+            with self.lock:
+                cached = self.cache.get(request)
+            if version and cached and cached[0] == etag:
+                return cached[0], cached[1], False
+            body = json.dumps(self.query(c, path, params, attached)) \
+                    .encode('utf-8')
+        finally:
+            c.execute('''COMMIT''')
+        if not version:
+            return None, body, False
+        return etag, body, True
+
+    def history(self, c, where, args, params, limit, attached):
+        """
+        The latest plays matching where, newest first, looking in archives
+        too if there aren't limit of them in the database.
+        """
+        after = number(params, 'after', 0)
+        before = number(params, 'before', 2 ** 62)
+        where = where + ['''play.date >= ?''', '''play.date < ?''']
+        args = args + [after, before]
+        tables = ['main.play'] + ['%s.play' % name
+                for year, name in attached if name]
+        # each table gives no more than it has to
+        c.execute(PLAY % ' UNION ALL '.join('''SELECT * FROM (SELECT * \
+                    FROM %s AS play WHERE %s ORDER BY date DESC LIMIT ?)'''
+                    % (table, ' AND '.join(where)) for table in tables)
+                + ''' ORDER BY play.date DESC LIMIT ?''',
+                (args + [limit]) * len(tables) + [limit])
+        found = rows(c)
+        if len(found) >= limit or len(attached) >= MAX_ATTACHED:
+            return found
+        try:
+            c.execute('''SELECT year, path FROM archive \
+                    WHERE last >= ? AND first < ? ORDER BY year DESC''',
+                    [after, before])
+        except dbase.sqlite3.OperationalError:
+            # from before there were archives
+            return found
+        years = set(year for year, name in attached)
+        needed = [row for row in c.fetchall() if row[0] not in years]
+        if needed:
+            raise NeedArchives(needed[:MAX_ATTACHED - len(attached)])
+        return found
+
+    def query(self, c, path, params, attached=()):
+        parts = path.strip('/').split('/')
+        limit = number(params, 'limit', 10, 1000)
+        if parts == ['recent']:
+            where = []
+            args = []
+            if 'source' in params:
+                where.append('''play.source = ?''')
+                args.append(params['source'][0])
+            return {'plays': self.history(c, where, args, params, limit,
+                attached)}
+        if len(parts) == 2 and parts[0] == 'top' and parts[1] in TOP:
+            return {parts[1]: self.top(c, parts[1], params, limit)}
+        if len(parts) == 2 and parts[0] == 'track' and parts[1].isdigit():
+            return self.track(c, int(parts[1]), params, limit, attached)
+        if parts == ['search']:
+            text = params.get('q', [''])[0]
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', 'replace')
+            if not search.WORD.search(text):
+                raise BadRequest("q must have a word to search for")
+            return search.search(c, text, limit)
+        raise NotFound(path)
+
+    def top(self, c, key, params, limit):
+        by = params.get('by', ['plays'])[0]
+        if by not in ('plays', 'listentime'):
+            raise BadRequest("by must be plays or listentime")
+        if 'days' in params:
+            top = '''SELECT %(key)s, sum(plays) AS plays, \
+                    sum(listentime) AS listentime FROM %(key)s_daily \
+                    WHERE day >= date('now', 'localtime', ?) \
+                    GROUP BY %(key)s ORDER BY %(by)s DESC LIMIT ?'''
+            args = ['-%d days' % number(params, 'days', 0), limit]
+        else:
+            top = '''SELECT %(key)s, plays, listentime FROM %(key)s_total \
+                    ORDER BY %(by)s DESC LIMIT ?'''
+            args = [limit]
+        columns, joins = TOP[key]
+        c.execute('''%s, top.plays AS plays, top.listentime AS listentime \
+                FROM (%s) top %s ORDER BY top.%s DESC'''
+                % (columns, top % {'key': key, 'by': by}, joins, by), args)
+        return rows(c)
+
+    def track(self, c, id, params, limit, attached):
+        c.execute('''SELECT track.id AS id, track.num AS num, \
+                track.title AS title, artist.name AS artist, \
+                album.title AS album, track.length AS length, \
+                track.genre AS genre, \
+                (SELECT plays FROM track_total WHERE track = track.id) \
+                    AS plays, \
+                (SELECT listentime FROM track_total WHERE track = track.id) \
+                    AS listentime \
+                FROM track LEFT JOIN artist ON (artist.id = track.artist) \
+                LEFT JOIN album ON (album.id = track.album) \
+                WHERE track.id = ?''', [id])
+        found = rows(c)
+        if not found:
+            raise NotFound(id)
+        found[0]['history'] = self.history(c, ['''play.track = ?'''], [id],
+                params, limit, attached)
+        return found[0]
+
+def start(port, db_path, now_playing=None, connections=4):
+    """
+    Serve the API on port from a background thread.
+    """
+    server = ApiServer(('', port), db_path, now_playing, connections)
+    thread = threading.Thread(target=server.serve_forever, name='mpsd-api')
+    thread.daemon = True
+    thread.start()
+    log.info("Serving the stats API on port %d" % port)
+    return server
@@ -0,0 +1,137 @@
+import os
+import time
+import sqlite3
+import logging
+
+import dbase
+
+log = logging.getLogger('mpsd')
+
+# Pages copied per step of the backup, and the pause between steps that
+# lets the daemon in. The source is only read while a step runs.
+STEP_PAGES = 256
+STEP_PAUSE = 0.005
+# A write by the daemon while the backup runs makes it start over. After
+# this many times, the copy is made in one read transaction instead, which
+# the daemon can keep writing through as the database is in WAL mode.
+MAX_RESTARTS = 5
+
+class Restarted(Exception):
+    pass
+
+def fingerprint(db):
+    """
+    What tells two copies of a database apart: its change counts (the
+    changes table, see dbase._count_changes()) and the migrations applied
+    to it. None if it doesn't count changes.
+    """
+    c = db.cursor()
+    try:
+        c.execute('''SELECT group_concat(name || ':' || count) \
+                FROM (SELECT name, count FROM changes ORDER BY name)''')
+    except sqlite3.OperationalError:
+        return None
+    counts = c.fetchone()[0]
+    # not PRAGMA schema_version, which copies don't keep
+    c.execute('''SELECT max(version) FROM schema_version''')
+    return '%s %s' % (counts, c.fetchone()[0])
+
+def current(db, target):
+    """
+    Whether target is a snapshot of db as it is now.
+    """
+    if not os.path.exists(target):
+        return False
+    copy = dbase.connect_readonly(target)
+    try:
+        theirs = fingerprint(copy)
+    except sqlite3.DatabaseError:
+        # not a database, eg. cut short by a crash
+        return False
+    finally:
+        copy.close()
+    return theirs != None and theirs == fingerprint(db)
+
+def remove(path):
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def copy(db_path, tmp, pages, pause):
+    """
+    Copy the database at db_path to tmp with the online backup API, a
+    few pages at a time.
+    """
+    source = dbase.connect_readonly(db_path)
+    target = sqlite3.connect(tmp)
+    left = [None, 0]     # pages left after the last step, restarts
+    def progress(status, remaining, total):
+        if left[0] != None and remaining > left[0]:
+            left[1] += 1
+            if left[1] > MAX_RESTARTS:
+                raise Restarted()
+        left[0] = remaining
+        if remaining and pause:
+            time.sleep(pause)
+    try:
+        source.backup(target, pages=pages, progress=progress)
+        # a file of its own, without a WAL next to it
+        target.execute('''PRAGMA journal_mode=DELETE''')
+    finally:
+        target.close()
+        source.close()
+
+def vacuum(db_path, tmp):
+    """
+    Copy the database at db_path to tmp in one read transaction.
+    """
+    # not read-only, VACUUM INTO is refused with query_only; it only
+    # reads db_path
+    source = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        source.execute('''VACUUM INTO ?''', [tmp])
+    finally:
+        source.close()
+    target = sqlite3.connect(tmp)
+    try:
+        target.execute('''PRAGMA journal_mode=DELETE''')
+    finally:
+        target.close()
+
+def snapshot(db_path, target, pages=STEP_PAGES, pause=STEP_PAUSE):
+    """
+    Make target a copy of the database at db_path as it was at one
+    moment, while the daemon keeps writing to it. If target is a copy of
+    the database as it is now, going by fingerprint(), it is left alone.
+    Otherwise the copy is made next to it and moved into place when
+    complete, so readers of target never see half a copy. Returns whether
+    a copy was made.
+
+    Archived plays (see MpsdDB.archive()) stay in their archives, which
+    the copy still refers to.
+    """
+    db = dbase.connect_readonly(db_path)
+    try:
+        if current(db, target):
+            return False
+    finally:
+        db.close()
+    tmp = target + '.tmp'
+    remove(tmp)
+    try:
+        if hasattr(sqlite3.Connection, 'backup'):
+            try:
+                copy(db_path, tmp, pages, pause)
+            except Restarted:
+                log.info("Database kept changing during the backup, "
+                        "copying it in one go")
+                remove(tmp)
+                vacuum(db_path, tmp)
+        else:
+            # no backup API before python 3.7
+            vacuum(db_path, tmp)
+    except:
+        remove(tmp)
+        raise
+    os.rename(tmp, target)
+    return True
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the database layer on a synthetic library and listening
+history, so schema and caching changes can be compared run to run.
+
+    python bench.py [--preset small|medium|large] [--tracks N] [--plays N]
+                    [--scrobbles N] [--seed N] [--db PATH] [--keep]
+                    [--out FILE] [--compare FILE]
+
+Play counts follow a Zipf distribution over the tracks, like a real
+library where a few tracks get most of the plays. Results are written
+as JSON to --out, and compared against an earlier run with --compare.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+from bisect import bisect
+
+import dbase
+import render
+
+PRESETS = {
+    'small': (10000, 100000),
+    'medium': (100000, 2000000),
+    'large': (1000000, 20000000),
+}
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'template.html')
+
+def library(tracks, rand):
+    """
+    mpd style library entries: albums of 8 to 14 tracks by artists of 1
+    to 5 albums, in 40 genres.
+    """
+    songs = []
+    album = artist = 0
+    while len(songs) < tracks:
+        artist += 1
+        for a in range(rand.randint(1, 5)):
+            album += 1
+            genre = 'Genre %d' % rand.randint(1, 40)
+            year = str(rand.randint(1960, 2020))
+            for num in range(1, rand.randint(8, 14) + 1):
+                songs.append({
+                    'file': 'artist%d/album%d/%02d.flac'
+                        % (artist, album, num),
+                    'last-modified': '2020-01-01T00:00:00Z',
+                    'artist': 'Artist %d' % artist,
+                    'album': 'Album %d' % album,
+                    'title': 'Track %d-%d' % (album, num),
+                    'track': str(num),
+                    'date': year,
+                    'genre': genre,
+                    'time': str(rand.randint(90, 480)),
+                })
+    return songs[:tracks]
+
+class Zipf(object):
+    """
+    Picks indexes into a list of n items, the k-th most popular being
+    picked in proportion to 1 / k**s.
+    """
+    def __init__(self, n, rand, s=1.0):
+        self.rand = rand
+        self.cumulative = []
+        total = 0.0
+        for k in range(1, n + 1):
+            total += 1.0 / k ** s
+            self.cumulative.append(total)
+        # which track is how popular
+        self.order = list(range(n))
+        rand.shuffle(self.order)
+
+    def pick(self):
+        x = self.rand.random() * self.cumulative[-1]
+        return self.order[min(bisect(self.cumulative, x),
+            len(self.order) - 1)]
+
+def history(songs, plays, zipf, rand, end):
+    """
+    (song, date, listentime) for plays spread over the years up to end,
+    oldest first, dates in seconds since the epoch.
+    """
+    # about 4 plays an hour, around the clock
+    when = end - plays * 900
+    for i in range(plays):
+        song = songs[zipf.pick()]
+        when += rand.randint(1, 1799)
+        length = int(song['time'])
+        listened = length if rand.random() < 0.8 \
+                else rand.randint(length // 2, length)
+        yield song, int(when), listened
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+def load(db, tracks, plays, rand, results):
+    songs = library(tracks, rand)
+    zipf = Zipf(len(songs), rand)
+
+    start = time.time()
+    db.build(songs)
+    results['build_s'] = round(time.time() - start, 2)
+    results['build_songs_per_s'] = round(tracks / (time.time() - start))
+
+    start = time.time()
+    for read, added, bad in db.addPlays(history(songs, plays, zipf, rand,
+            time.time() - 86400), source='bench'):
+        pass
+    results['import_s'] = round(time.time() - start, 2)
+    results['import_plays_per_s'] = round(plays / (time.time() - start))
+    return songs, zipf
+
+def scrobble(db, songs, zipf, scrobbles, results):
+    """
+    Time plays and listen time updates the way the daemon makes them, each
+    in its own transaction.
+    """
+    updates = []
+    listentimes = []
+    # a source of its own, so runs on a reused --db don't collide
+    source = 'bench %d' % time.time()
+    when = int(time.time()) - 86000
+    for i in range(scrobbles):
+        song = songs[zipf.pick()]
+        date = when + i
+        start = time.time()
+        db.update(song, date, source)
+        updates.append(time.time() - start)
+        start = time.time()
+        db.updateListentime(int(song['time']), date, source)
+        listentimes.append(time.time() - start)
+    results['scrobbles_per_s'] = round(len(updates) / sum(updates))
+    for name, times in (('update', updates), ('listentime', listentimes)):
+        results[name + '_p50_ms'] = ms(percentile(times, 50))
+        results[name + '_p99_ms'] = ms(percentile(times, 99))
+
+# (name, days back) of the ranges of plays scanned by scans()
+RANGES = [('day', 1), ('week', 7), ('month', 30), ('year', 365)]
+
+def scans(path, results):
+    """
+    Time reading every play of the last day, week, month and year.
+    """
+    db = dbase.connect_readonly(path)
+    end = int(time.time())
+    for name, days in RANGES:
+        start = time.time()
+        db.execute('''SELECT count(*), sum(listentime) FROM play \
+                WHERE date >= ?''', [end - days * 86400]).fetchone()
+        results['scan_%s_ms' % name] = ms(time.time() - start)
+    db.close()
+
+def queries(path, template, results):
+    """
+    Time each query of the stats template, uncached and then cached.
+    """
+    renderer = render.StatsRenderer(path, template)
+    start = time.time()
+    renderer.render()
+    results['render_ms'] = ms(time.time() - start)
+    results['queries'] = [{'sql': ' '.join(q.sql.split()),
+        'ms': ms(q.elapsed), 'rows': len(q.rows)}
+        for q in renderer.queries()]
+    start = time.time()
+    renderer.render()
+    results['render_cached_ms'] = ms(time.time() - start)
+    renderer.close()
+
+def compare(old, new):
+    """
+    Print the numbers of two runs side by side.
+    """
+    for key in sorted(new):
+        a, b = old.get(key), new[key]
+        if not isinstance(b, (int, float)):
+            continue
+        change = ''
+        if isinstance(a, (int, float)) and a:
+            change = ' %+.0f%%' % ((b - a) * 100.0 / a)
+        print("%-24s %12s %12s%s" % (key, a, b, change))
+    old_queries = dict((q['sql'], q) for q in old.get('queries', []))
+    for q in new.get('queries', []):
+        a = old_queries.get(q['sql'], {}).get('ms')
+        print("%12s %12s  %s" % (a, q['ms'], q['sql'][:50]))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--tracks', type=int)
+    parser.add_argument('--plays', type=int)
+    parser.add_argument('--scrobbles', type=int, default=2000,
+            help="plays and listen time updates to time one by one")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help="where to build the database, "
+            "a temporary file by default; reused if it exists")
+    parser.add_argument('--keep', action='store_true',
+            help="keep the database afterwards")
+    parser.add_argument('--template', default=TEMPLATE)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--compare', help="an earlier --out file")
+    args = parser.parse_args()
+
+    tracks, plays = PRESETS[args.preset]
+    tracks = args.tracks or tracks
+    plays = args.plays or plays
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    rand = random.Random(args.seed)
+
+    results = {'tracks': tracks, 'plays': plays, 'seed': args.seed,
+            'scrobbles': args.scrobbles,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version}
+    existed = os.path.exists(path)
+    db = dbase.MpsdDB(path)
+    db.connect()
+    if existed:
+        songs = library(tracks, rand)
+        zipf = Zipf(len(songs), rand)
+    else:
+        songs, zipf = load(db, tracks, plays, rand, results)
+    scrobble(db, songs, zipf, args.scrobbles, results)
+    db.close()
+    results['db_bytes'] = sum(os.path.getsize(path + suffix)
+            for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    scans(path, results)
+    queries(path, args.template, results)
+
+    f = open(args.out, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    if args.compare:
+        f = open(args.compare)
+        try:
+            compare(json.load(f), results)
+        finally:
+            f.close()
+    else:
+        compare({}, results)
+    if not args.keep and not args.db:
+        # the database and what sits next to it, eg. the report cache
+        shutil.rmtree(os.path.dirname(path))
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,919 @@
 import sqlite3
 import os
+import re
+import sys
 import time
 import logging
+from collections import OrderedDict
+from itertools import islice
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+import metrics
 
 log = logging.getLogger('mpsd')
 
+# time.monotonic is not available before python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
+def _dedupe(c, table, key, refs):
+    """
+    Merge rows of table that share the same key columns into the row with
+    the lowest id, pointing the (table, column) pairs in refs at it.
+    Frozen with migration 1, see MIGRATIONS.
+    """
+    c.execute('''CREATE TEMP TABLE dupes AS \
+            SELECT t.id AS old, m.id AS new FROM %(table)s t \
+            JOIN (SELECT %(key)s, min(id) AS id FROM %(table)s \
+                GROUP BY %(key)s) m USING (%(key)s) \
+            WHERE t.id != m.id''' % {'table': table, 'key': key})
+    for ref, col in refs:
+        c.execute('''UPDATE OR IGNORE %(ref)s \
+                SET %(col)s=(SELECT new FROM dupes WHERE old=%(col)s) \
+                WHERE %(col)s IN (SELECT old FROM dupes)'''
+                % {'ref': ref, 'col': col})
+        # rows that would have collided with an existing one
+        c.execute('''DELETE FROM %(ref)s \
+                WHERE %(col)s IN (SELECT old FROM dupes)'''
+                % {'ref': ref, 'col': col})
+    c.execute('''DELETE FROM %s WHERE id IN (SELECT old FROM dupes)'''
+            % table)
+    if c.rowcount > 0:
+        log.info("Merged %d duplicate rows in %s" % (c.rowcount, table))
+    c.execute('''DROP TABLE dupes''')
+
+def _add_indexes(c):
+    """
+    Index the columns update() looks rows up by
+    """
+    _dedupe(c, 'artist', 'name', [('album', 'artist'), ('track', 'artist')])
+    _dedupe(c, 'album', 'title', [('track', 'album')])
+    _dedupe(c, 'track', 'title, album', [('listened', 'track')])
+    c.execute('''CREATE UNIQUE INDEX artist_name ON artist (name)''')
+    c.execute('''CREATE UNIQUE INDEX album_title ON album (title)''')
+    c.execute('''CREATE UNIQUE INDEX track_title_album \
+            ON track (title, album)''')
+    c.execute('''CREATE INDEX listened_date ON listened (date)''')
+
+def _add_received(c):
+    """
+    Remember the last event received from each remote mpsd
+    """
+    c.execute('''CREATE TABLE received ( \
+            source      TEXT, \
+            seq         INTEGER, \
+            PRIMARY KEY (source) \
+            )''')
+
+def _add_source(c):
+    """
+    Record which mpd server each play came from
+    """
+    # the same track can play on two servers at once, so source has to be
+    # part of the primary key, which means rebuilding the table
+    c.execute('''CREATE TABLE listened_new ( \
+            track       INTEGER, \
+            date        TEXT, \
+            listentime  INTEGER, \
+            source      TEXT, \
+            FOREIGN KEY (track) REFERENCES track(id), \
+            PRIMARY KEY (track, date, source) \
+            )''')
+    c.execute('''INSERT INTO listened_new (track, date, listentime) \
+            SELECT track, date, listentime FROM listened''')
+    c.execute('''DROP TABLE listened''')
+    c.execute('''ALTER TABLE listened_new RENAME TO listened''')
+    c.execute('''CREATE INDEX listened_date ON listened (date)''')
+
+def _add_file(c):
+    """
+    Record the file and modification time of tracks
+    """
+    c.execute('''ALTER TABLE track ADD COLUMN file TEXT''')
+    c.execute('''ALTER TABLE track ADD COLUMN modified TEXT''')
+    c.execute('''CREATE INDEX track_file ON track (file)''')
+
+# Play counts and listen times are kept for tracks, artists, albums and
+# genres, per day in <key>_daily and in total in <key>_total, as (key, value
+# of the key for a row of the plays table, named play in the SQL).
+# Frozen with migrations 7 and 12, which make triggers from it.
+STATS = [
+    ('track', 'play.track'),
+    ('artist', 'track.artist'),
+    ('album', 'track.album'),
+    ('genre', 'track.genre'),
+]
+
+# SQL for the (local) day a play counts towards in the STATS tables,
+# frozen with migration 7
+DAY = "date(play.date, 'unixepoch', 'localtime')"
+
+# What the plays in a table add to <key>_daily
+STATS_DAILY = '''SELECT %(value)s AS %(key)s, %(day)s AS day, \
+            count(*) AS plays, \
+            coalesce(sum(play.listentime), 0) AS listentime \
+        FROM %(table)s AS play \
+        LEFT JOIN track ON (play.track = track.id) \
+        WHERE %(value)s IS NOT NULL \
+        GROUP BY 1, 2'''
+
+def _fill_stats(c, day, parts=False):
+    """
+    Recompute the STATS tables from play, where day is the SQL for the day
+    of a play. With parts, the rows of temp.<key>_parts
+    are added in too.
+    """
+    for key, value in STATS:
+        args = {'key': key, 'value': value, 'day': day, 'table': 'play'}
+        daily = STATS_DAILY % args
+        if parts:
+            daily = '''SELECT %s, day, sum(plays), sum(listentime) \
+                    FROM (%s UNION ALL SELECT * FROM temp.%s_parts) \
+                    GROUP BY 1, 2''' % (key, daily, key)
+        c.execute('''DELETE FROM %(key)s_daily''' % args)
+        c.execute('''INSERT INTO %s_daily %s''' % (key, daily))
+        c.execute('''DELETE FROM %(key)s_total''' % args)
+        c.execute('''INSERT INTO %(key)s_total \
+                SELECT %(key)s, sum(plays), sum(listentime) \
+                FROM %(key)s_daily GROUP BY %(key)s''' % args)
+
+def _count_stats(c, table, day=DAY):
+    """
+    Add the plays in table to the STATS tables, as the triggers do when
+    they are added to play one at a time, where day is the SQL for the day
+    of a play.
+    """
+    for key, value in STATS:
+        c.execute('''CREATE TEMP TABLE counted AS %s''' % (STATS_DAILY
+                % {'key': key, 'value': value, 'day': day, 'table': table}))
+        c.execute('''INSERT INTO %(key)s_daily SELECT * FROM temp.counted \
+                WHERE true ON CONFLICT (%(key)s, day) DO UPDATE \
+                SET plays = plays + excluded.plays, \
+                    listentime = listentime + excluded.listentime'''
+                % {'key': key})
+        c.execute('''INSERT INTO %(key)s_total \
+                SELECT %(key)s, sum(plays), sum(listentime) \
+                FROM temp.counted GROUP BY %(key)s \
+                ON CONFLICT (%(key)s) DO UPDATE \
+                SET plays = plays + excluded.plays, \
+                    listentime = listentime + excluded.listentime'''
+                % {'key': key})
+        c.execute('''DROP TABLE temp.counted''')
+
+def _stats_triggers(c, day):
+    """
+    Keep the STATS tables up to date as plays are added and their listen
+    times set. Deleted plays are not taken out of them, they stay counted
+    until the next rebuild. Plays without a track are left out. Frozen
+    with migration 7.
+    """
+    inserts = []
+    updates = []
+    for key, value in STATS:
+        if value.startswith('play.'):
+            new = value.replace('play.', 'NEW.')
+        else:
+            new = '''(SELECT %s FROM track WHERE id=NEW.track)''' \
+                    % value.split('.')[1]
+        args = {'key': key, 'new': new,
+                'day': day.replace('play.', 'NEW.')}
+        inserts.append('''INSERT OR IGNORE INTO %(key)s_daily \
+                VALUES (%(new)s, %(day)s, 0, 0); \
+            UPDATE %(key)s_daily SET plays = plays + 1, \
+                listentime = listentime + coalesce(NEW.listentime, 0) \
+                WHERE %(key)s = %(new)s AND day = %(day)s; \
+            INSERT OR IGNORE INTO %(key)s_total VALUES (%(new)s, 0, 0); \
+            UPDATE %(key)s_total SET plays = plays + 1, \
+                listentime = listentime + coalesce(NEW.listentime, 0) \
+                WHERE %(key)s = %(new)s;''' % args)
+        updates.append('''UPDATE %(key)s_daily SET listentime = listentime \
+                + coalesce(NEW.listentime, 0) - coalesce(OLD.listentime, 0) \
+                WHERE %(key)s = %(new)s AND day = %(day)s; \
+            UPDATE %(key)s_total SET listentime = listentime \
+                + coalesce(NEW.listentime, 0) - coalesce(OLD.listentime, 0) \
+                WHERE %(key)s = %(new)s;''' % args)
+    c.execute('''CREATE TRIGGER play_stats_insert \
+            AFTER INSERT ON play BEGIN %s END''' % ' '.join(inserts))
+    c.execute('''CREATE TRIGGER play_stats_update \
+            AFTER UPDATE OF listentime ON play BEGIN %s END'''
+            % ' '.join(updates))
+
+# The STATS keys and the day of a listened row migration 5 was released
+# with, before plays moved to the play table, and its helpers. Frozen.
+_LISTENED_STATS = [
+    ('track', 'listened.track'),
+    ('artist', 'track.artist'),
+    ('album', 'track.album'),
+    ('genre', 'track.genre'),
+]
+_LISTENED_DAY = 'substr(listened.date, 1, 10)'
+
+def _fill_listened_stats(c):
+    """
+    Recompute the STATS tables of migration 5 from listened.
+    """
+    for key, value in _LISTENED_STATS:
+        args = {'key': key, 'value': value, 'day': _LISTENED_DAY}
+        c.execute('''DELETE FROM %(key)s_daily''' % args)
+        c.execute('''INSERT INTO %(key)s_daily \
+                SELECT %(value)s, %(day)s, count(*), \
+                    coalesce(sum(listened.listentime), 0) \
+                FROM listened LEFT JOIN track ON (listened.track = track.id) \
+                WHERE %(value)s IS NOT NULL \
+                GROUP BY 1, 2''' % args)
+        c.execute('''DELETE FROM %(key)s_total''' % args)
+        c.execute('''INSERT INTO %(key)s_total \
+                SELECT %(key)s, sum(plays), sum(listentime) \
+                FROM %(key)s_daily GROUP BY %(key)s''' % args)
+
+def _listened_stats_triggers(c):
+    """
+    The triggers of migration 5, keeping the STATS tables up to date as
+    plays are added to listened and their listen times set.
+    """
+    inserts = []
+    updates = []
+    for key, value in _LISTENED_STATS:
+        if value.startswith('listened.'):
+            new = value.replace('listened.', 'NEW.')
+        else:
+            new = '''(SELECT %s FROM track WHERE id=NEW.track)''' \
+                    % value.split('.')[1]
+        args = {'key': key, 'new': new,
+                'day': _LISTENED_DAY.replace('listened.', 'NEW.')}
+        inserts.append('''INSERT OR IGNORE INTO %(key)s_daily \
+                VALUES (%(new)s, %(day)s, 0, 0); \
+            UPDATE %(key)s_daily SET plays = plays + 1, \
+                listentime = listentime + coalesce(NEW.listentime, 0) \
+                WHERE %(key)s = %(new)s AND day = %(day)s; \
+            INSERT OR IGNORE INTO %(key)s_total VALUES (%(new)s, 0, 0); \
+            UPDATE %(key)s_total SET plays = plays + 1, \
+                listentime = listentime + coalesce(NEW.listentime, 0) \
+                WHERE %(key)s = %(new)s;''' % args)
+        updates.append('''UPDATE %(key)s_daily SET listentime = listentime \
+                + coalesce(NEW.listentime, 0) - coalesce(OLD.listentime, 0) \
+                WHERE %(key)s = %(new)s AND day = %(day)s; \
+            UPDATE %(key)s_total SET listentime = listentime \
+                + coalesce(NEW.listentime, 0) - coalesce(OLD.listentime, 0) \
+                WHERE %(key)s = %(new)s;''' % args)
+    c.execute('''CREATE TRIGGER listened_stats_insert \
+            AFTER INSERT ON listened BEGIN %s END''' % ' '.join(inserts))
+    c.execute('''CREATE TRIGGER listened_stats_update \
+            AFTER UPDATE OF listentime ON listened BEGIN %s END'''
+            % ' '.join(updates))
+
+def _add_stats(c):
+    """
+    Keep per day and total play counts and listen times
+    """
+    for key, value in _LISTENED_STATS:
+        args = {'key': key, 'type': 'TEXT' if key == 'genre' else 'INTEGER'}
+        c.execute('''CREATE TABLE %(key)s_daily ( \
+                %(key)s     %(type)s, \
+                day         TEXT, \
+                plays       INTEGER, \
+                listentime  INTEGER, \
+                PRIMARY KEY (%(key)s, day) \
+                ) WITHOUT ROWID''' % args)
+        c.execute('''CREATE INDEX %(key)s_daily_day \
+                ON %(key)s_daily (day)''' % args)
+        c.execute('''CREATE TABLE %(key)s_total ( \
+                %(key)s     %(type)s, \
+                plays       INTEGER, \
+                listentime  INTEGER, \
+                PRIMARY KEY (%(key)s) \
+                ) WITHOUT ROWID''' % args)
+        # for top N lists
+        c.execute('''CREATE INDEX %(key)s_total_plays \
+                ON %(key)s_total (plays)''' % args)
+        c.execute('''CREATE INDEX %(key)s_total_listentime \
+                ON %(key)s_total (listentime)''' % args)
+    # dates are "YYYY-MM-DD HH:MM:SS"
+    _fill_listened_stats(c)
+    _listened_stats_triggers(c)
+
+def _count_changes(c, table):
+    """
+    Count the inserts, updates and deletes of table in the changes table.
+    Frozen with migration 7.
+    """
+    for event in ('insert', 'update', 'delete'):
+        c.execute('''CREATE TRIGGER %(table)s_changes_%(event)s \
+                AFTER %(event)s ON %(table)s BEGIN \
+                UPDATE changes SET count = count + 1 \
+                WHERE name = '%(table)s'; END'''
+                % {'table': table, 'event': event})
+
+def _add_changes(c):
+    """
+    Count inserts, updates and deletes per table
+    """
+    # so readers can tell what was modified since they last looked
+    c.execute('''CREATE TABLE changes ( \
+            name        TEXT, \
+            count       INTEGER, \
+            PRIMARY KEY (name) \
+            )''')
+    for table in ['listened', 'track', 'album', 'artist']:
+        c.execute('''INSERT INTO changes VALUES (?, 0)''', [table])
+        for event in ('insert', 'update', 'delete'):
+            c.execute('''CREATE TRIGGER %(table)s_changes_%(event)s \
+                    AFTER %(event)s ON %(table)s BEGIN \
+                    UPDATE changes SET count = count + 1 \
+                    WHERE name = '%(table)s'; END'''
+                    % {'table': table, 'event': event})
+
+def _add_play(c):
+    """
+    Store plays by their time in seconds since the epoch, ordered by it
+    """
+    # Rows are clustered on (date, source, track) with no separate rowid,
+    # so a range of dates is one contiguous run of the table and the
+    # integer dates take a few bytes rather than 19. WITHOUT ROWID means
+    # the key can't hold NULLs: an unknown source is ''.
+    c.execute('''CREATE TABLE play ( \
+            date        INTEGER NOT NULL, \
+            source      TEXT NOT NULL, \
+            track       INTEGER NOT NULL, \
+            listentime  INTEGER, \
+            FOREIGN KEY (track) REFERENCES track(id), \
+            PRIMARY KEY (date, source, track) \
+            ) WITHOUT ROWID''')
+    # listened dates are local time, in date order they go in at the end
+    c.execute('''INSERT OR IGNORE INTO play \
+            SELECT CAST(strftime('%s', date, 'utc') AS INTEGER), \
+                coalesce(source, ''), track, listentime \
+            FROM listened ORDER BY 1''')
+    copied = c.rowcount
+    c.execute('''SELECT count(*) FROM listened''')
+    dropped = c.fetchone()[0] - copied
+    if dropped:
+        log.warning("Dropped %d plays that could not be converted"
+                % dropped)
+    c.execute('''DROP TABLE listened''')
+    c.execute('''CREATE INDEX play_track ON play (track, date)''')
+    # for queries written against the old table
+    c.execute('''CREATE VIEW listened AS \
+            SELECT track, datetime(date, 'unixepoch', 'localtime') AS date, \
+                listentime, nullif(source, '') AS source \
+            FROM play''')
+    _stats_triggers(c, DAY)
+    c.execute('''UPDATE changes SET name = 'play', count = count + 1 \
+            WHERE name = 'listened' ''')
+    _count_changes(c, 'play')
+
+def _add_archive(c):
+    """
+    Remember which plays were moved to archive databases
+    """
+    c.execute('''CREATE TABLE archive ( \
+            year        INTEGER, \
+            path        TEXT, \
+            first       INTEGER, \
+            last        INTEGER, \
+            plays       INTEGER, \
+            PRIMARY KEY (year) \
+            )''')
+
+def _add_identity(c):
+    """
+    Identify tracks by file, and albums by album artist, title and date
+    """
+    # a file that was retagged ended up as a second track; the newest one
+    # keeps the file, the plays of the others stay with them
+    c.execute('''UPDATE track SET file = NULL WHERE file IS NOT NULL \
+            AND id < (SELECT max(id) FROM track AS newer \
+                WHERE newer.file = track.file)''')
+    if c.rowcount > 0:
+        log.info("Took the file off %d older tracks" % c.rowcount)
+    c.execute('''DROP INDEX track_file''')
+    c.execute('''CREATE UNIQUE INDEX track_file ON track (file)''')
+    # tracks without a file are still found by album and title, but the
+    # same title can now be on an album twice, once per file
+    c.execute('''DROP INDEX track_title_album''')
+    c.execute('''CREATE INDEX track_album_title ON track (album, title)''')
+    c.execute('''DROP INDEX album_title''')
+    c.execute('''CREATE UNIQUE INDEX album_identity \
+            ON album (artist, title, coalesce(date, 0))''')
+
+# A listening session ends when its source plays nothing for this many
+# seconds after the end of its last play, or when the player is stopped
+SESSION_GAP = 30 * 60
+
+# Write a Session.row(); a session is a full album run if every track of
+# its album (more than one) was played in it, and nothing else
+SESSION_ROW = '''INSERT OR REPLACE INTO session (id, source, start, last, \
+            end, plays, listentime, album, tracks, stopped, full_album) \
+        VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, \
+            ?8 IS NOT NULL AND ?9 > 1 \
+            AND ?9 = (SELECT count(*) FROM track WHERE album = ?8))'''
+
+class Session(object):
+    """
+    A row of the session table: plays on one source, each no more than
+    the session gap after the end of the one before (its date plus its
+    listen time), up to the player being stopped.
+    """
+    def __init__(self, source, date, album, id=None):
+        self.id = id
+        self.source = source
+        self.start = date       # date of the first play
+        self.last = date        # date of the last play
+        self.end = date         # when the last play ended
+        self.plays = 0
+        self.listentime = 0
+        self.album = album      # of every play, None if they differ
+        self.tracks = 0         # different tracks played
+        self.stopped = False
+
+    @classmethod
+    def fromRow(cls, row):
+        session = cls(row[1], row[2], row[7], row[0])
+        (session.last, session.end, session.plays, session.listentime,
+                session.tracks, session.stopped) = row[3:7] + row[8:10]
+        return session
+
+    def row(self):
+        return (self.id, self.source, self.start, self.last, self.end,
+                self.plays, self.listentime, self.album, self.tracks,
+                int(self.stopped))
+
+    def takes(self, date, gap):
+        """
+        Whether a play at date is part of this session.
+        """
+        return not self.stopped and self.last <= date <= self.end + gap
+
+    def add(self, date, album, listentime, new_track):
+        self.last = date
+        self.end = date + (listentime or 0)
+        self.plays += 1
+        self.listentime += listentime or 0
+        if album != self.album:
+            self.album = None
+        if new_track:
+            self.tracks += 1
+
+def _session_plays(c, since):
+    """
+    Yield (date, source, track, listentime) of the plays from since on,
+    archived ones included, oldest first.
+    """
+    c.execute('''SELECT path FROM archive WHERE last >= ? ORDER BY year''',
+            [since])
+    paths = [path for (path,) in c.fetchall()]
+    last = (since, '', -1)
+    for path in paths:
+        if not os.path.exists(path):
+            log.warning("Archive missing, skipped: %s" % path)
+            continue
+        # read on a connection of its own, as databases can't be attached
+        # in the transaction this runs in
+        archived = sqlite3.connect(path)
+        try:
+            for row in archived.execute('''SELECT date, source, track, \
+                    listentime FROM play WHERE date >= ? \
+                    ORDER BY date, source, track''', [last[0]]):
+                if row[:3] > last:
+                    last = row[:3]
+                    yield row
+        finally:
+            archived.close()
+    # plays can be in both after an interrupted MpsdDB.archive()
+    for row in c.connection.execute('''SELECT date, source, track, \
+            listentime FROM play WHERE date >= ? \
+            ORDER BY date, source, track''', [last[0]]):
+        if row[:3] > last:
+            last = row[:3]
+            yield row
+
+def _fill_sessions(c, gap, since=None):
+    """
+    Recompute the sessions plays from since (seconds since the epoch, all
+    of them if None) are part of, in one pass over the plays in date
+    order. Where the player was stopped is kept.
+    """
+    since = since if since != None else -1
+    # the sessions of each source that could take plays from since
+    c.execute('''SELECT source, min(min(start), ?) FROM session \
+            WHERE end >= ? GROUP BY source''', [since, since - gap])
+    cut = dict(c.fetchall())
+    c.execute('''SELECT source, last FROM session \
+            WHERE stopped AND end >= ?''', [since - gap])
+    stops = set(c.fetchall())
+    c.execute('''DELETE FROM session WHERE end >= ?''', [since - gap])
+    c.execute('''SELECT id, album FROM track''')
+    albums = dict(c.fetchall())
+
+    sessions = {}   # source -> its open session
+    played = {}     # source -> tracks played in its open session
+    rows = []
+    for date, source, track, listentime in _session_plays(c,
+            min(list(cut.values()) + [since])):
+        if date < cut.get(source, since):
+            continue
+        session = sessions.get(source)
+        if session == None or not session.takes(date, gap):
+            if session != None:
+                rows.append(session.row())
+            session = sessions[source] = Session(source, date,
+                    albums.get(track))
+            played[source] = set()
+        session.add(date, albums.get(track), listentime,
+                track not in played[source])
+        played[source].add(track)
+        session.stopped = (source, date) in stops
+        if len(rows) >= 1000:
+            c.executemany(SESSION_ROW, rows)
+            rows = []
+    rows.extend(session.row() for session in sessions.values())
+    c.executemany(SESSION_ROW, rows)
+
+def _add_sessions(c):
+    """
+    Group plays into listening sessions
+    """
+    c.execute('''CREATE TABLE session ( \
+            id          INTEGER, \
+            source      TEXT NOT NULL, \
+            start       INTEGER NOT NULL, \
+            last        INTEGER NOT NULL, \
+            end         INTEGER NOT NULL, \
+            plays       INTEGER, \
+            listentime  INTEGER, \
+            album       INTEGER, \
+            tracks      INTEGER, \
+            stopped     INTEGER, \
+            full_album  INTEGER, \
+            FOREIGN KEY (album) REFERENCES album (id), \
+            PRIMARY KEY (id) \
+            )''')
+    c.execute('''CREATE INDEX session_source_start \
+            ON session (source, start)''')
+    c.execute('''CREATE INDEX session_start ON session (start)''')
+    # with the default gap, "mpsd rebuild" redoes them with SESSION_GAP
+    # as configured
+    _fill_sessions(c, SESSION_GAP)
+    c.execute('''SELECT count(*) FROM session''')
+    log.info("Found %d sessions" % c.fetchone()[0])
+
+# Artists, albums and tracks are found by name (see search.py) in
+# <table>_search, full-text indexes of a column of their table kept up to
+# date by triggers. Words match whatever their accents or case, and
+# prefixes of 2 or 3 letters are indexed for search as you type. Frozen
+# with migration 11.
+SEARCHED = [
+    ('artist', 'name'),
+    ('album', 'title'),
+    ('track', 'title'),
+]
+
+def _fill_search(c):
+    """
+    Create the SEARCHED indexes that are missing and index every row of
+    their tables. Returns False if sqlite was built without FTS5. What it
+    creates is frozen with migration 11, the rebuild calls it too.
+    """
+    # Tried on a throwaway table first: an sqlite without FTS5 fails, and
+    # so does one from before 3.27 without remove_diacritics 2, with an
+    # error of the tokenizer's own
+    try:
+        c.execute('''CREATE VIRTUAL TABLE temp.search_probe \
+                USING fts5(name, tokenize='unicode61 remove_diacritics 2')''')
+        c.execute('''DROP TABLE temp.search_probe''')
+    except sqlite3.OperationalError:
+        log.warning("This sqlite has no FTS5 with remove_diacritics 2 "
+                "(%s), searches will read every artist, album and track"
+                % sys.exc_info()[1])
+        return False
+    for table, column in SEARCHED:
+        args = {'table': table, 'column': column}
+        c.execute('''SELECT 1 FROM sqlite_master WHERE name = ?''',
+                ['%s_search' % table])
+        if c.fetchone() == None:
+            c.execute('''CREATE VIRTUAL TABLE %(table)s_search \
+                    USING fts5(%(column)s, content=%(table)s, \
+                        content_rowid=id, prefix='2 3', \
+                        tokenize='unicode61 remove_diacritics 2')'''
+                    % args)
+            c.execute('''CREATE TRIGGER %(table)s_search_insert \
+                    AFTER INSERT ON %(table)s BEGIN \
+                    INSERT INTO %(table)s_search (rowid, %(column)s) \
+                        VALUES (NEW.id, NEW.%(column)s); END''' % args)
+            c.execute('''CREATE TRIGGER %(table)s_search_delete \
+                    AFTER DELETE ON %(table)s BEGIN \
+                    INSERT INTO %(table)s_search \
+                        (%(table)s_search, rowid, %(column)s) \
+                        VALUES ('delete', OLD.id, OLD.%(column)s); END'''
+                    % args)
+            c.execute('''CREATE TRIGGER %(table)s_search_update \
+                    AFTER UPDATE OF %(column)s ON %(table)s BEGIN \
+                    INSERT INTO %(table)s_search \
+                        (%(table)s_search, rowid, %(column)s) \
+                        VALUES ('delete', OLD.id, OLD.%(column)s); \
+                    INSERT INTO %(table)s_search (rowid, %(column)s) \
+                        VALUES (NEW.id, NEW.%(column)s); END''' % args)
+        c.execute('''INSERT INTO %(table)s_search (%(table)s_search) \
+                VALUES ('rebuild')''' % args)
+    return True
+
+def _add_search(c):
+    """
+    Index the names of artists, albums and tracks for searching
+    """
+    _fill_search(c)
+
+# Trigger statements moving the counts of a retagged track from OLD.key to
+# NEW.key in a <key>_daily or <key>_total table, for a STATS key taken from
+# track. "of" picks the row of track_daily or track_total (as moved) that
+# goes with a row of the table, "same" the other way round, and "rows" the
+# rows of the table the track has counts in. Not INSERT OR IGNORE: in a
+# trigger fired by an upsert, that fails on a conflict. Frozen with
+# migration 12.
+RETAGGED = '''INSERT INTO %(table)s \
+            SELECT NEW.%(key)s, %(columns)s FROM track_%(part)s AS moved \
+            WHERE moved.track = NEW.id AND NEW.%(key)s IS NOT NULL \
+            AND NOT EXISTS (SELECT 1 FROM %(table)s \
+                WHERE %(key)s = NEW.%(key)s %(same)s); \
+        UPDATE %(table)s SET \
+            plays = plays + (SELECT plays FROM track_%(part)s AS moved \
+                WHERE %(of)s), \
+            listentime = listentime + (SELECT listentime \
+                FROM track_%(part)s AS moved WHERE %(of)s) \
+            WHERE %(key)s = NEW.%(key)s %(rows)s; \
+        UPDATE %(table)s SET \
+            plays = plays - (SELECT plays FROM track_%(part)s AS moved \
+                WHERE %(of)s), \
+            listentime = listentime - (SELECT listentime \
+                FROM track_%(part)s AS moved WHERE %(of)s) \
+            WHERE %(key)s = OLD.%(key)s %(rows)s; \
+        DELETE FROM %(table)s \
+            WHERE %(key)s = OLD.%(key)s %(rows)s AND plays <= 0;'''
+
+def _add_retagging(c):
+    """
+    Move the stats and sessions of retagged tracks to their new tags
+    """
+    # the stats of its artist, album and genre move, those of the track stay
+    for key, value in STATS:
+        if not value.startswith('track.'):
+            continue
+        daily = RETAGGED % {'table': '%s_daily' % key, 'key': key,
+                'part': 'daily', 'columns': 'day, 0, 0',
+                'same': 'AND day = moved.day',
+                'of': 'moved.track = NEW.id AND moved.day = %s_daily.day'
+                    % key,
+                'rows': 'AND day IN (SELECT day FROM track_daily \
+                    WHERE track = NEW.id)'}
+        total = RETAGGED % {'table': '%s_total' % key, 'key': key,
+                'part': 'total', 'columns': '0, 0', 'same': '',
+                'of': 'moved.track = NEW.id',
+                'rows': 'AND EXISTS (SELECT 1 FROM track_total \
+                    WHERE track = NEW.id)'}
+        # the STATS tables count as part of play for readers
+        c.execute('''CREATE TRIGGER track_retag_%(key)s \
+                AFTER UPDATE OF %(key)s ON track \
+                WHEN OLD.%(key)s IS NOT NEW.%(key)s BEGIN %(daily)s %(total)s \
+                UPDATE changes SET count = count + 1 WHERE name = 'play'; \
+                END''' % {'key': key, 'daily': daily, 'total': total})
+    # Sessions with plays of the track get their album worked out again,
+    # and those of either album whether they played all of it. Sessions
+    # going back into the archives are left to the next rebuild.
+    c.execute('''CREATE INDEX session_album ON session (album)''')
+    played = '''SELECT (SELECT id FROM session \
+                WHERE session.source = play.source \
+                AND session.start <= play.date \
+                ORDER BY session.start DESC LIMIT 1) \
+            FROM play WHERE play.track = NEW.id'''
+    c.execute('''CREATE TRIGGER track_retag_session \
+            AFTER UPDATE OF album ON track \
+            WHEN OLD.album IS NOT NEW.album BEGIN \
+            UPDATE session SET album = (SELECT CASE \
+                    WHEN count(DISTINCT coalesce(track.album, -1)) = 1 \
+                    THEN min(track.album) END \
+                FROM play JOIN track ON (track.id = play.track) \
+                WHERE play.source = session.source \
+                AND play.date BETWEEN session.start AND session.last) \
+            WHERE id IN (%(played)s) \
+            AND start > coalesce((SELECT max(last) FROM archive), -1); \
+            UPDATE session SET full_album = album IS NOT NULL \
+                AND tracks > 1 \
+                AND tracks = (SELECT count(*) FROM track \
+                    WHERE track.album = session.album) \
+            WHERE album IN (OLD.album, NEW.album) OR id IN (%(played)s); \
+            END''' % {'played': played})
+
+def _split_albums(c):
+    """
+    Tell apart the albums of files without an album artist by their artist
+    """
+    # Such albums were keyed by the placeholder 'Unkown Artist', so albums
+    # of the same title and date by different artists were one. Those with
+    # tracks of one artist become that artist's. The tracks of the others
+    # move to an album of their artist, their stats and sessions following
+    # them (see _add_retagging).
+    placeholder = '''(SELECT id FROM artist WHERE name = 'Unkown Artist')'''
+    artist = '''(SELECT min(track.artist) FROM track \
+            WHERE track.album = album.id)'''
+    c.execute('''UPDATE album SET artist = %(artist)s \
+            WHERE artist = %(placeholder)s \
+            AND (SELECT count(DISTINCT track.artist) FROM track \
+                WHERE track.album = album.id) = 1 \
+            AND NOT EXISTS (SELECT 1 FROM album AS other \
+                WHERE other.artist = %(artist)s AND other.title = album.title \
+                AND coalesce(other.date, 0) = coalesce(album.date, 0))'''
+            % {'artist': artist, 'placeholder': placeholder})
+    c.execute('''INSERT INTO album (title, date, artist) \
+            SELECT DISTINCT album.title, album.date, track.artist \
+            FROM album JOIN track ON (track.album = album.id) \
+            WHERE album.artist = %s AND track.artist != album.artist \
+            ON CONFLICT (artist, title, coalesce(date, 0)) DO NOTHING'''
+            % placeholder)
+    c.execute('''UPDATE track SET album = (SELECT other.id \
+                FROM album JOIN album AS other \
+                    ON (other.artist = track.artist \
+                    AND other.title = album.title \
+                    AND coalesce(other.date, 0) = coalesce(album.date, 0)) \
+                WHERE album.id = track.album) \
+            WHERE album IN (SELECT id FROM album WHERE artist = %s) \
+            AND artist != (SELECT artist FROM album WHERE id = track.album)'''
+            % placeholder)
+    c.execute('''DELETE FROM album WHERE artist = %s \
+            AND NOT EXISTS (SELECT 1 FROM track \
+                WHERE track.album = album.id)'''
+            % placeholder)
+    c.execute('''UPDATE artist SET name = 'Unknown Artist' \
+            WHERE name = 'Unkown Artist' \
+            AND NOT EXISTS (SELECT 1 FROM artist \
+                WHERE name = 'Unknown Artist')''')
+
+def _add_merging(c):
+    """
+    Let merges count the stats of the plays they add in one go
+    """
+    # MpsdDB.merge() has a row in merging while it adds a batch of plays,
+    # which other connections never see as it is gone by the commit. The
+    # trigger is made again from its SQL as migrated, with a guard.
+    c.execute('''CREATE TABLE merging ( \
+            id          INTEGER, \
+            PRIMARY KEY (id) \
+            )''')
+    c.execute('''SELECT sql FROM sqlite_master \
+            WHERE type = 'trigger' AND name = 'play_stats_insert' ''')
+    sql, count = re.subn(r'AFTER\s+INSERT\s+ON\s+play\s+BEGIN',
+            'AFTER INSERT ON play WHEN NOT EXISTS (SELECT 1 FROM merging) '
+            'BEGIN', c.fetchone()[0], 1)
+    if count != 1:
+        raise sqlite3.DatabaseError("Unexpected play_stats_insert trigger")
+    c.execute('''DROP TRIGGER play_stats_insert''')
+    c.execute(sql)
+
+# Schema migrations as (version, function) pairs, applied in order by
+# MpsdDB.migrate(). Never change a released migration, add a new one. The
+# helpers and constants a migration makes its schema with are frozen with
+# it, as noted on each: a change to the schema they make goes in a new
+# migration with helpers of its own. Those filling tables in from the plays
+# are shared with the rebuild, and may change with it.
+MIGRATIONS = [
+    (1, _add_indexes),
+    (2, _add_received),
+    (3, _add_source),
+    (4, _add_file),
+    (5, _add_stats),
+    (6, _add_changes),
+    (7, _add_play),
+    (8, _add_archive),
+    (9, _add_identity),
+    (10, _add_sessions),
+    (11, _add_search),
+    (12, _add_retagging),
+    (13, _split_albums),
+    (14, _add_merging),
+]
+
+# File name of the archive of a year's plays, see MpsdDB.archive()
+ARCHIVE = 'mpsd-%d.db'
+
+# The id of the track a row of temp.resolved (see MpsdDB._addStaged()) is,
+# matched as in MpsdDB.getTrackId()
+RESOLVED_TRACK = '''coalesce( \
+        (SELECT id FROM track WHERE track.file = resolved.file), \
+        (SELECT id FROM track WHERE track.album = resolved.album_id \
+            AND track.title = resolved.title \
+            ORDER BY file IS NOT NULL, id LIMIT 1))'''
+
+# The plays of a table of an attached database from a range of dates not
+# recorded yet, with their tracks mapped by temp.merged_track. Plays of a
+# track already recorded at the same date are left out, as are all but the
+# one listened to longest of those it has at the same date. Each has the
+# day it counts towards in the STATS tables.
+MERGED_PLAYS = '''SELECT other.date AS date, other.source AS source, \
+            map.new AS track, max(other.listentime) AS listentime, \
+            %(day)s AS day \
+        FROM %(table)s AS other \
+        JOIN temp.merged_track AS map ON (map.old = other.track) \
+        WHERE other.date >= ? AND other.date < ? \
+        AND NOT EXISTS (SELECT 1 FROM main.play \
+            WHERE play.track = map.new AND play.date = other.date) \
+        GROUP BY other.date, map.new'''
+
+def epoch(date):
+    """
+    Seconds since the epoch of a play date, given as such or as the local
+    time "YYYY-MM-DD HH:MM:SS" strings older versions recorded.
+    """
+    if isinstance(date, (str, type(u''))):
+        return int(time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S')))
+    return int(date)
+
+def connect_readonly(path):
+    """
+    A connection to the database at path that cannot write to it.
+    """
+    try:
+        db = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(path)),
+                uri=True, isolation_level=None, check_same_thread=False)
+    except TypeError:
+        # no uri support before python 3.4
+        db = sqlite3.connect(path, isolation_level=None,
+                check_same_thread=False)
+        db.execute('''PRAGMA query_only = ON''')
+    return db
+
+def schema_version(path):
+    """
+    The last of MIGRATIONS applied to the database at path, 0 if none were.
+    """
+    db = connect_readonly(path)
+    try:
+        c = db.cursor()
+        c.execute('''SELECT max(version) FROM schema_version''')
+        return c.fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        db.close()
+
+class LRUCache(object):
+    """
+    A bounded mapping that forgets the least recently used key first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
 class MpsdDB(object):
-    def __init__(self, path):
+    """
+    The stats database. Writes are grouped into transactions that are
+    committed once commit_events writes are pending, or commit_interval
+    seconds after the first of them, whichever comes first. Plays are
+    grouped into sessions as they are recorded, ended by session_gap
+    seconds without a play (see Session).
+    """
+    def __init__(self, path, cache_size=1024, commit_interval=0,
+            commit_events=1, session_gap=SESSION_GAP):
         self.path = path
+        self.session_gap = session_gap
+        # trackKey() -> (track id, tagRow()) of recently played tracks
+        self.cache = LRUCache(cache_size)
+        self.data_version = None
+
+        self.commit_interval = commit_interval
+        self.commit_events = commit_events
+        self.transaction = False    # whether we have a transaction open
+        self.pending = 0            # writes in the open transaction
+        self.batch_start = None     # monotonic time it was opened
 
-    def connect(self):
+    def connect(self, warm_cache=False):
         """
-        Connect to the specified database
+        Connect to the specified database, optionally filling the id cache
+        with the most recently played tracks.
         """
         dne = False
         c = None
@@ -19,14 +921,25 @@ class MpsdDB(object):
         if not (os.access(self.path, os.F_OK)):
             dne = True
         try:
-            self.db = sqlite3.connect(self.path)
+            # transactions are handled by begin() and flush()
+            self.db = sqlite3.connect(self.path, isolation_level=None)
             c = self.db.cursor()
         except sqlite3.Error as err:
             log.error("%s" % (err.args[0]))
             return None
 
         c.execute('''PRAGMA foreign_key = ON''')
+        # In WAL mode readers never block the writer (nor the other way
+        # round), and with synchronous=NORMAL a commit does not fsync; the
+        # WAL is synced at checkpoints. A crash of mpsd loses nothing that
+        # was committed, a power loss can lose the last few commits but
+        # never corrupts the database.
+        c.execute('''PRAGMA journal_mode=WAL''')
+        if c.fetchone()[0].lower() != 'wal':
+            log.warning("Could not enable WAL mode for %s" % self.path)
+        c.execute('''PRAGMA synchronous=NORMAL''')
         if dne:
+            c.execute('''BEGIN''')
             c.execute('''CREATE TABLE artist (
                     id          INTEGER, \
                     name        TEXT, \
@@ -60,7 +973,102 @@ class MpsdDB(object):
                     PRIMARY KEY (track, date) \
                     )''')
                     #Dates are stored "YYYY-MM-DD HH:MM:SS"
-            self.db.commit()
+            c.execute('''COMMIT''')
+        self.migrate()
+        if warm_cache:
+            self.warmCache()
+
+    def migrate(self):
+        """
+        Bring the schema up to date, applying each missing migration in
+        its own transaction.
+        """
+        c = self.db.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version ( \
+                version     INTEGER, \
+                applied     TEXT, \
+                PRIMARY KEY (version) \
+                )''')
+        c.execute('''SELECT max(version) FROM schema_version''')
+        current = c.fetchone()[0] or 0
+
+        for version, migration in MIGRATIONS:
+            if version <= current:
+                continue
+            log.info("Migrating database to version %d: %s"
+                    % (version, migration.__doc__.strip()))
+            c.execute('''BEGIN''')
+            try:
+                migration(c)
+                c.execute('''INSERT INTO schema_version VALUES (?, ?)''',
+                        (version, time.strftime('%Y-%m-%d %H:%M:%S')))
+            except sqlite3.Error:
+                c.execute('''ROLLBACK''')
+                raise
+            c.execute('''COMMIT''')
+
+    def begin(self):
+        """
+        Open a transaction for the next write, unless one is open already.
+        """
+        if not self.transaction:
+            self.db.execute('''BEGIN''')
+            self.transaction = True
+            self.batch_start = monotonic()
+
+    def written(self):
+        """
+        Count a write in the open transaction, committing it if that fills
+        up the group commit window.
+        """
+        self.pending += 1
+        if self.pending >= self.commit_events \
+                or monotonic() - self.batch_start >= self.commit_interval:
+            self.flush()
+
+    def commitTimeout(self):
+        """
+        Seconds until the pending writes are due to be committed, or None
+        if there are none.
+        """
+        if not self.pending:
+            return None
+        return max(self.batch_start + self.commit_interval - monotonic(), 0)
+
+    def commitIfDue(self):
+        """
+        Commit the pending writes if their commit_interval has passed.
+        """
+        if self.pending and self.commitTimeout() == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit the open transaction.
+        """
+        if self.transaction:
+            with metrics.DB_COMMIT_SECONDS.time():
+                self.db.execute('''COMMIT''')
+            log.debug("Committed %d writes" % self.pending)
+        self.transaction = False
+        self.pending = 0
+
+    def rollback(self):
+        """
+        Throw away the open transaction.
+        """
+        if self.transaction:
+            self.db.execute('''ROLLBACK''')
+        self.transaction = False
+        self.pending = 0
+        self.cache.clear()
+
+    def close(self):
+        """
+        Commit anything pending and close the database.
+        """
+        self.flush()
+        self.db.close()
 
     def getInfo(self, info):
         """
@@ -71,14 +1079,23 @@ class MpsdDB(object):
 
         rval = {}
         # artist/albumartist
-        rval['albumartist'] = info.get('albumartist', 'Unkown Artist')
-        rval['artist'] = info.get('artist', rval['albumartist'])
+        rval['artist'] = info.get('artist',
+                info.get('albumartist', 'Unknown Artist'))
+        # most files have no album artist, their albums are told apart by
+        # the artist
+        rval['albumartist'] = info.get('albumartist', rval['artist'])
         # date
         rval['date'] = info.get('date', '')
-        rval['date'] = int(rval['date'].rsplit('-')[0])
+        try:
+            rval['date'] = int(rval['date'].rsplit('-')[0])
+        except ValueError:
+            rval['date'] = None
         # track
         rval['track'] = info.get('track', '0')
-        rval['track'] = int(rval['track'].rsplit('/')[0])
+        try:
+            rval['track'] = int(rval['track'].rsplit('/')[0])
+        except ValueError:
+            rval['track'] = 0
         # genre
         rval['genre'] = info.get('genre', 'Unknown')
         if isinstance(rval['genre'], (list, tuple)):
@@ -87,82 +1104,724 @@ class MpsdDB(object):
         rval['title'] = info.get('title', 'Unknown Track')
         rval['album'] = info.get('album', 'Unknown Album')
         rval['time'] = int(info['time'])
+        # where mpd has the file, and when it last changed
+        rval['file'] = info.get('file')
+        rval['modified'] = info.get('last-modified')
 
         return rval
 
-    def update(self, track):
+    def infoRow(self, info):
         """
-        Update the database with the given info
+        The fields of a getInfo() dict in the column order of staging
+        """
+        return (info['file'], info['modified'], info['artist'],
+                info['albumartist'], info['album'], info['date'],
+                info['track'], info['title'], info['time'], info['genre'])
+
+    def warmCache(self):
+        """
+        Fill the id cache with the most recently played tracks.
         """
-        id = {}
-        info = self.getInfo(track)
         c = self.db.cursor()
-        # Artist and AlbumArtist
-        for a in ("artist", "albumartist"):
-            c.execute('''SELECT id FROM artist \
-                    WHERE name=?''', [info[a]])
+        c.execute('''SELECT track FROM play \
+                ORDER BY date DESC LIMIT ?''', [self.cache.size])
+        recent = []
+        for (track,) in c.fetchall():
+            if track not in recent:
+                recent.append(track)
+        # oldest first, so the most recent end up most recently used
+        for track in reversed(recent):
+            c.execute('''SELECT track.id, track.file, track.num, track.title, \
+                    artist.name, albumartist.name, album.title, album.date, \
+                    track.length, track.genre \
+                    FROM track \
+                    JOIN album ON (track.album = album.id) \
+                    JOIN artist ON (track.artist = artist.id) \
+                    JOIN artist albumartist ON (album.artist = albumartist.id) \
+                    WHERE track.id=?''', [track])
             row = c.fetchone()
             if row == None:
-                #add the artist
-                c.execute('''INSERT INTO artist VALUES \
-                        (?,?)''', (None, info[a]))
-                self.db.commit()
-                id[a] = c.lastrowid
-                log.debug("Adding new %s: %s, id: %s" % (a, info[a], id[a]))
-            else:
-                id[a] = int(row[0])
-
-            if(info['artist'] == info['albumartist']):
-                #Must be a better way...
-                id['albumartist'] = id[a]
-                break
-        # Album
-        c.execute('''SELECT id FROM album WHERE title=?''', [info['album']])
-        row = c.fetchone()
-        if row == None:
-            # add the album
-            c.execute('''INSERT INTO album VALUES \
-                     (?, ?, ?, ?)''',
-                     (None, info['album'], info['date'],
-                        id['albumartist']))
-            self.db.commit()
-            id['album'] = c.lastrowid
-            log.debug("Adding new album: %s, id: %s"
-                    % (info['album'], id['album']))
+                continue
+            tags = tuple(row[2:])
+            self.cache.put(self.trackKey(row[1], tags), (row[0], tags))
+        self.checkDataVersion()
+        log.debug("Warmed id cache with %d entries" % len(self.cache))
+
+    def checkDataVersion(self):
+        """
+        Drop the id cache if another connection has changed the database
+        since we last looked, as it may have removed or merged rows.
+        """
+        c = self.db.cursor()
+        c.execute('''PRAGMA data_version''')
+        version = c.fetchone()[0]
+        if self.data_version != None and version != self.data_version:
+            log.debug("Database changed externally, clearing id cache")
+            self.cache.clear()
+        self.data_version = version
+
+    def trackKey(self, file, tags):
+        """
+        The id cache key of a track with the tags of tagRow().
+        """
+        if file:
+            return ('track', file)
+        # title, album artist, album and date
+        return ('track',) + tags[1:2] + tags[3:6]
+
+    def tagRow(self, info):
+        """
+        The tags of a getInfo() dict that are kept with a track, its album
+        and their artists.
+        """
+        return (info['track'], info['title'], info['artist'],
+                info['albumartist'], info['album'], info['date'],
+                info['time'], info['genre'])
+
+    def getTrackId(self, c, info):
+        """
+        Find the track id for the info from getInfo(), adding its artists,
+        album and track as needed. A track is identified by the file mpd
+        has it in and updated if its tags changed, or by album and title
+        where there is no file. An album is identified by album artist,
+        title and date. Unless the track is cached with the same tags,
+        this takes the same few statements, each an index lookup.
+        """
+        tags = self.tagRow(info)
+        key = self.trackKey(info['file'], tags)
+        cached = self.cache.get(key)
+        if cached != None and cached[1] == tags:
+            return cached[0]
+        c.execute('''INSERT INTO artist (name) VALUES (?), (?) \
+                ON CONFLICT (name) DO NOTHING''',
+                (info['artist'], info['albumartist']))
+        c.execute('''INSERT INTO album (title, date, artist) \
+                VALUES (?, ?, (SELECT id FROM artist WHERE name=?)) \
+                ON CONFLICT (artist, title, coalesce(date, 0)) DO NOTHING''',
+                (info['album'], info['date'], info['albumartist']))
+        album = '''(SELECT id FROM album \
+                WHERE artist=(SELECT id FROM artist WHERE name=?) \
+                AND title=? AND coalesce(date, 0)=coalesce(?, 0))'''
+        album_args = (info['albumartist'], info['album'], info['date'])
+        if info['file']:
+            # a track recorded before its file was takes the file
+            c.execute('''UPDATE track SET file=? \
+                    WHERE id=(SELECT id FROM track WHERE album=%s \
+                        AND title=? AND file IS NULL LIMIT 1) \
+                    AND NOT EXISTS (SELECT 1 FROM track WHERE file=?)'''
+                    % album, (info['file'],) + album_args
+                    + (info['title'], info['file']))
+            c.execute('''INSERT INTO track \
+                    (file, num, title, artist, length, genre, album) \
+                    VALUES (?, ?, ?, (SELECT id FROM artist WHERE name=?), \
+                        ?, ?, %s) \
+                    ON CONFLICT (file) DO UPDATE SET num=excluded.num, \
+                        title=excluded.title, artist=excluded.artist, \
+                        length=excluded.length, genre=excluded.genre, \
+                        album=excluded.album \
+                    WHERE num IS NOT excluded.num \
+                        OR title IS NOT excluded.title \
+                        OR artist IS NOT excluded.artist \
+                        OR length IS NOT excluded.length \
+                        OR genre IS NOT excluded.genre \
+                        OR album IS NOT excluded.album''' % album,
+                    (info['file'], info['track'], info['title'],
+                        info['artist'], info['time'], info['genre'])
+                    + album_args)
+            c.execute('''SELECT id FROM track WHERE file=?''',
+                    [info['file']])
         else:
-            id['album'] = int(row[0])
-        # Track
-        c.execute('''SELECT id,title \
-               FROM track \
-               WHERE title=? AND album=?''',
-               (info['title'], id['album']))
+            # the library's track if there is one, rather than a new one
+            c.execute('''SELECT id FROM track WHERE album=%s AND title=? \
+                    ORDER BY file IS NOT NULL, id LIMIT 1''' % album,
+                    album_args + (info['title'],))
         row = c.fetchone()
-        if row == None:
-            # add the track
-            c.execute('''INSERT INTO track VALUES (?,?,?,?,?,?,?)''',
-                     (None, info['track'], info['title'], id['artist'],
-                      info['time'], info['genre'], id['album']))
-            self.db.commit()
-            id['track'] = c.lastrowid
-            log.debug("Adding new track: %s. %s, id: %s"
-                    % (info['track'], info['title'], id['track']))
+        if row != None:
+            id = row[0]
         else:
-            id['track'] = int(row[0])
-
-        # Listened Table insert
-        t = time.strftime('%Y-%m-%d %H:%M:%S')
-        c.execute('''INSERT INTO listened VALUES \
-                 (?, ?, 0)''',
-                 (id['track'], t))
-        self.db.commit()
+            c.execute('''INSERT INTO track \
+                    (num, title, artist, length, genre, album) \
+                    VALUES (?, ?, (SELECT id FROM artist WHERE name=?), \
+                        ?, ?, %s)''' % album,
+                    (info['track'], info['title'], info['artist'],
+                        info['time'], info['genre']) + album_args)
+            id = c.lastrowid
+            log.debug("Adding new track: %s. %s, id: %s"
+                    % (info['track'], info['title'], id))
+        self.cache.put(key, (id, tags))
+        return id
+
+    def update(self, track, date=None, source=None):
+        """
+        Update the database with the given info, recording it as played at
+        date (seconds since the epoch, default now) on the mpd server source.
+        Returns the date.
+        """
+        info = self.getInfo(track)
+        t = epoch(date) if date != None else int(time.time())
+        start = monotonic()
+        self.checkDataVersion()
+        self.begin()
+        c = self.db.cursor()
+        # everything for one play goes in or nothing does, without
+        # throwing away other writes waiting in the same transaction
+        c.execute('''SAVEPOINT scrobble''')
+        try:
+            track = self.getTrackId(c, info)
+            c.execute('''INSERT INTO play (date, source, track, listentime) \
+                    VALUES (?, ?, ?, 0)''', (t, source or '', track))
+            self.addToSession(c, t, source or '', track)
+        except sqlite3.Error:
+            c.execute('''ROLLBACK TO scrobble''')
+            c.execute('''RELEASE scrobble''')
+            # the cache may hold ids of rows that were just rolled back
+            self.cache.clear()
+            raise
+        c.execute('''RELEASE scrobble''')
+        metrics.DB_SECONDS.observe(monotonic() - start, op='play')
+        self.written()
         log.info("Added track: %(artist)s - %(album)s - %(track)s. %(title)s"
                 % info)
+        log.debug("Id cache: %d hits, %d misses"
+                % (self.cache.hits, self.cache.misses))
         return t
 
-    def updateListentime(self, total, date):
+    def latestSession(self, c, source, before=None):
+        """
+        The latest session of source, of those starting no later than
+        before if given, or None.
+        """
+        c.execute('''SELECT id, source, start, last, end, plays, \
+                listentime, album, tracks, stopped FROM session \
+                WHERE source = ? AND start <= ? \
+                ORDER BY start DESC LIMIT 1''',
+                [source, before if before != None else 2 ** 62])
+        row = c.fetchone()
+        return Session.fromRow(row) if row != None else None
+
+    def addToSession(self, c, date, source, track):
+        """
+        Add the play of track just recorded to the session of source it
+        is part of, or a new one.
+        """
+        session = self.latestSession(c, source)
+        if session != None and date < session.last:
+            # recorded out of order, eg. by a remote mpsd catching up
+            _fill_sessions(c, self.session_gap, date)
+            return
+        c.execute('''SELECT album FROM track WHERE id=?''', [track])
+        album = c.fetchone()[0]
+        if session == None or not session.takes(date, self.session_gap):
+            session = Session(source, date, album)
+            new_track = True
+        else:
+            c.execute('''SELECT 1 FROM play WHERE track = ? AND source = ? \
+                    AND date >= ? AND date < ?''',
+                    [track, source, session.start, date])
+            new_track = c.fetchone() == None
+        session.add(date, album, 0, new_track)
+        c.execute(SESSION_ROW, session.row())
+
+    def updateListentime(self, total, date, source=None, stopped=False):
+        """
+        Set the listen time of the play recorded at date on source, and
+        end its session if the player stopped after it.
+        """
+        start = monotonic()
+        self.begin()
         c = self.db.cursor()
-        c.execute('''UPDATE listened SET listentime=? WHERE date=?''',
-                (total, date))
-        self.db.commit()
+        date, source = epoch(date), source or ''
+        session = self.latestSession(c, source, date)
+        if session != None and session.last >= date:
+            c.execute('''SELECT count(*), coalesce(sum(listentime), 0) \
+                    FROM play WHERE date=? AND source=?''', (date, source))
+            plays, before = c.fetchone()
+            session.listentime += plays * total - before
+            if session.last == date:
+                session.end = date + total
+                session.stopped = session.stopped or stopped
+            c.execute(SESSION_ROW, session.row())
+        c.execute('''UPDATE play SET listentime=? \
+                WHERE date=? AND source=?''', (total, date, source))
+        metrics.DB_SECONDS.observe(monotonic() - start, op='listentime')
+        self.written()
         log.debug("Updated listentime to %d" % (total))
 
+    def build(self, songs, batch_size=5000):
+        """
+        Add the artists, albums and tracks of songs (mpd library entries)
+        in bulk, without recording any plays. Songs whose file was already
+        added with the same modification time are skipped, so this can be
+        re-run to pick up changes. Returns the number of songs added or
+        updated, skipped as unchanged, and skipped as unusable.
+        """
+        self.flush()
+        c = self.db.cursor()
+        c.execute('''BEGIN''')
+        try:
+            added, unchanged, bad = self._build(c, songs, batch_size)
+        except:
+            c.execute('''ROLLBACK''')
+            c.execute('''DROP TABLE IF EXISTS temp.adopted''')
+            c.execute('''DROP TABLE IF EXISTS temp.resolved''')
+            c.execute('''DROP TABLE IF EXISTS temp.staging''')
+            raise
+        c.execute('''COMMIT''')
+        # ids may have moved if this ran against a database in use
+        self.cache.clear()
+        return added, unchanged, bad
+
+    def _build(self, c, songs, batch_size):
+        # songs are staged in sqlite rather than in memory, and resolved
+        # to ids set-wise once they are all in
+        bad = [0]
+        def rows():
+            for song in songs:
+                try:
+                    yield self.infoRow(self.getInfo(song))
+                except (KeyError, ValueError):
+                    log.debug("Skipping %s: %s" % (song.get('file'),
+                            sys.exc_info()[1]))
+                    bad[0] += 1
+        self._stage(c, rows(), (), batch_size)
+
+        c.execute('''DELETE FROM staging WHERE EXISTS (SELECT 1 \
+                FROM track WHERE track.file = staging.file \
+                AND track.modified = staging.modified)''')
+        unchanged = c.rowcount
+        c.execute('''SELECT count(*) FROM staging''')
+        added = c.fetchone()[0]
+
+        # with nothing to match against, indexes are cheaper to build
+        # at the end than to keep up to date along the way
+        fresh = c.execute('''SELECT 1 FROM track LIMIT 1''').fetchone() \
+                == None
+        indexes = []
+        if fresh:
+            c.execute('''SELECT name, sql FROM sqlite_master \
+                    WHERE type='index' AND sql IS NOT NULL \
+                    AND tbl_name IN ('artist', 'album', 'track')''')
+            indexes = c.fetchall()
+            for name, sql in indexes:
+                c.execute('''DROP INDEX %s''' % name)
+
+        self._addStaged(c, update=not fresh)
+
+        for name, sql in indexes:
+            c.execute(sql)
+        c.execute('''DROP TABLE resolved''')
+        c.execute('''DROP TABLE staging''')
+        return added, unchanged, bad[0]
+
+    def addPlays(self, plays, source=None, batch_size=50000):
+        """
+        Record plays in bulk from an iterable of (song, date, listentime)
+        tuples, dates in seconds since the epoch, adding any artists, albums
+        and tracks they need. Plays of a track already recorded at the same
+        date are skipped. Each batch
+        is written in one transaction, after which (plays read, plays
+        added, plays skipped as unusable) so far is yielded. The sessions
+        from the earliest play on are worked out again once all are in.
+        """
+        self.flush()
+        read = [0, 0]
+        first = [2 ** 62]   # the earliest play read
+        def rows():
+            for song, date, listentime in plays:
+                read[0] += 1
+                try:
+                    row = self.infoRow(self.getInfo(song)) \
+                            + (epoch(date), listentime)
+                    first[0] = min(first[0], row[-2])
+                    yield row
+                except (KeyError, ValueError):
+                    log.debug("Skipping play of %s: %s"
+                            % (song, sys.exc_info()[1]))
+                    read[1] += 1
+        rows = rows()
+        added = 0
+        c = self.db.cursor()
+        while True:
+            before = read[0]
+            c.execute('''BEGIN''')
+            try:
+                self._stage(c, islice(rows, batch_size),
+                        ('played', 'listentime'), batch_size)
+                self._addStaged(c)
+                c.execute('''INSERT INTO play \
+                        (date, source, track, listentime) \
+                        SELECT played, ?, track, listentime FROM ( \
+                            SELECT played, listentime, %s AS track \
+                            FROM resolved) AS resolved \
+                        WHERE NOT EXISTS (SELECT 1 FROM play \
+                            WHERE play.date = resolved.played \
+                            AND play.track = resolved.track) \
+                        GROUP BY played, track''' % RESOLVED_TRACK,
+                        [source or ''])
+                added += c.rowcount
+                c.execute('''DROP TABLE resolved''')
+                c.execute('''DROP TABLE staging''')
+                if read[0] == before and added:
+                    _fill_sessions(c, self.session_gap, first[0])
+            except:
+                c.execute('''ROLLBACK''')
+                c.execute('''DROP TABLE IF EXISTS temp.adopted''')
+                c.execute('''DROP TABLE IF EXISTS temp.resolved''')
+                c.execute('''DROP TABLE IF EXISTS temp.staging''')
+                self.cache.clear()
+                raise
+            c.execute('''COMMIT''')
+            if read[0] == before:
+                break
+            yield read[0], added, read[1]
+
+    def rebuildStats(self):
+        """
+        Recompute the per day stats tables and the sessions from the full
+        listening history, archived plays included, and the search indexes.
+        """
+        self.flush()
+        c = self.db.cursor()
+        # databases can't be attached inside a transaction, so what the
+        # archives add up to is gathered beforehand
+        for key, value in STATS:
+            c.execute('''CREATE TEMP TABLE %s_parts \
+                    (%s, day, plays, listentime)''' % (key, key))
+        try:
+            for year, path in self.archives():
+                if not os.path.exists(path):
+                    raise IOError("Archive of %d is missing: %s"
+                            % (year, path))
+                c.execute('''ATTACH ? AS archived''', [path])
+                try:
+                    for key, value in STATS:
+                        c.execute('''INSERT INTO temp.%s_parts %s''' % (key,
+                                STATS_DAILY % {'key': key, 'value': value,
+                                    'day': DAY, 'table': 'archived.play'}))
+                finally:
+                    c.execute('''DETACH archived''')
+            c.execute('''BEGIN''')
+            try:
+                _fill_stats(c, DAY, parts=True)
+                _fill_sessions(c, self.session_gap)
+                _fill_search(c)
+                # the STATS tables count as part of play for readers
+                c.execute('''UPDATE changes SET count = count + 1 \
+                        WHERE name = 'play' ''')
+            except sqlite3.Error:
+                c.execute('''ROLLBACK''')
+                raise
+            c.execute('''COMMIT''')
+        finally:
+            for key, value in STATS:
+                c.execute('''DROP TABLE temp.%s_parts''' % key)
+
+    def archives(self):
+        """
+        (year, path) of each archive database, newest first.
+        """
+        c = self.db.cursor()
+        c.execute('''SELECT year, path FROM archive ORDER BY year DESC''')
+        return c.fetchall()
+
+    def archive(self, directory, before):
+        """
+        Move the plays from before (seconds since the epoch) out of the
+        database, into a database per year (local time) in directory named
+        after ARCHIVE. Their play counts and listen times stay in the stats
+        tables. Returns {year: plays moved}.
+        """
+        self.flush()
+        c = self.db.cursor()
+        moved = {}
+        while True:
+            c.execute('''SELECT min(date) FROM play''')
+            first = c.fetchone()[0]
+            if first == None or first >= before:
+                break
+            year = time.localtime(first).tm_year
+            end = min(before, int(time.mktime((year + 1, 1, 1, 0, 0, 0,
+                0, 0, -1))))
+            path = os.path.join(os.path.abspath(directory), ARCHIVE % year)
+            c.execute('''ATTACH ? AS archived''', [path])
+            try:
+                c.execute('''CREATE TABLE IF NOT EXISTS archived.play ( \
+                        date        INTEGER NOT NULL, \
+                        source      TEXT NOT NULL, \
+                        track       INTEGER NOT NULL, \
+                        listentime  INTEGER, \
+                        PRIMARY KEY (date, source, track) \
+                        ) WITHOUT ROWID''')
+                c.execute('''CREATE INDEX IF NOT EXISTS archived.play_track \
+                        ON play (track, date)''')
+                # A transaction over a WAL database and an attached one is
+                # not atomic across the two. Copying and deleting in turn
+                # means a crash in between leaves plays in both, which the
+                # next run puts right, rather than in neither.
+                c.execute('''BEGIN''')
+                try:
+                    c.execute('''INSERT OR IGNORE INTO archived.play \
+                            SELECT * FROM main.play \
+                            WHERE date >= ? AND date < ?''', [first, end])
+                except sqlite3.Error:
+                    c.execute('''ROLLBACK''')
+                    raise
+                c.execute('''COMMIT''')
+                c.execute('''BEGIN''')
+                try:
+                    c.execute('''DELETE FROM main.play \
+                            WHERE date >= ? AND date < ?''', [first, end])
+                    moved[year] = moved.get(year, 0) + c.rowcount
+                    c.execute('''INSERT OR REPLACE INTO main.archive \
+                            SELECT ?, ?, min(date), max(date), count(*) \
+                            FROM archived.play''', [year, path])
+                except sqlite3.Error:
+                    c.execute('''ROLLBACK''')
+                    raise
+                c.execute('''COMMIT''')
+            finally:
+                c.execute('''DETACH archived''')
+            log.info("Archived %d plays of %d to %s"
+                    % (moved[year], year, path))
+        return moved
+
+    def merge(self, path, batch_size=50000):
+        """
+        Add the plays of another mpsd database at path, and of its archives,
+        with the artists, albums and tracks they need. Its tracks are
+        matched to ours as build() matches songs, all at once, and its
+        plays are copied a range of dates at a time, each range in one
+        transaction, after which (plays read, plays added) so far is
+        yielded. Plays of a track already recorded at the same date are
+        skipped, so merging the same database again only adds what is new.
+        The database at path is only read, and has to be at the current
+        schema version (see schema_version()); merge a migrated copy of an
+        older one.
+        """
+        if not os.path.exists(path):
+            raise IOError("No such database: %s" % path)
+        if os.path.samefile(path, self.path):
+            raise ValueError("Can't merge %s into itself" % path)
+        version = schema_version(path)
+        if version != MIGRATIONS[-1][0]:
+            raise ValueError("%s is at schema version %d, not %d"
+                    % (path, version, MIGRATIONS[-1][0]))
+        self.flush()
+        c = self.db.cursor()
+        c.execute('''ATTACH ? AS merged''', [path])
+        try:
+            c.execute('''SELECT path FROM merged.archive ORDER BY year''')
+            archives = [row[0] for row in c.fetchall()]
+            c.execute('''BEGIN''')
+            try:
+                self._mapTracks(c)
+            except:
+                c.execute('''ROLLBACK''')
+                c.execute('''DROP TABLE IF EXISTS temp.adopted''')
+                c.execute('''DROP TABLE IF EXISTS temp.resolved''')
+                c.execute('''DROP TABLE IF EXISTS temp.staging''')
+                c.execute('''DROP TABLE IF EXISTS temp.merged_track''')
+                raise
+            c.execute('''COMMIT''')
+            # ids may have moved if this ran against a database in use
+            self.cache.clear()
+            read = added = 0
+            first = 2 ** 62     # the earliest date plays were added from
+            for archive in [None] + archives:
+                if archive != None and not os.path.exists(archive):
+                    log.warning("Archive %s is missing, its plays were "
+                            "not merged" % archive)
+                    continue
+                if archive != None:
+                    c.execute('''ATTACH ? AS archived''', [archive])
+                try:
+                    table = 'archived.play' if archive else 'merged.play'
+                    for batch, new, start in self._mergePlays(c, table,
+                            batch_size):
+                        read += batch
+                        added += new
+                        if new:
+                            first = min(first, start)
+                        yield read, added
+                finally:
+                    if archive != None:
+                        c.execute('''DETACH archived''')
+            if added:
+                c.execute('''BEGIN''')
+                try:
+                    _fill_sessions(c, self.session_gap, first)
+                except sqlite3.Error:
+                    c.execute('''ROLLBACK''')
+                    raise
+                c.execute('''COMMIT''')
+        finally:
+            c.execute('''DROP TABLE IF EXISTS temp.merged_track''')
+            c.execute('''DETACH merged''')
+
+    def _mapTracks(self, c):
+        """
+        Add the artists, albums and tracks of the attached database merged
+        that are missing, leaving the id each of its tracks has here in
+        temp.merged_track as (old, new).
+        """
+        self._stage(c, (), ('merged',), 1)
+        c.execute('''INSERT INTO staging \
+                SELECT track.file, track.modified, artist.name, \
+                    coalesce(albumartist.name, artist.name), album.title, \
+                    album.date, track.num, \
+                    track.title, track.length, track.genre, track.id \
+                FROM merged.track \
+                LEFT JOIN merged.album ON (album.id = track.album) \
+                LEFT JOIN merged.artist ON (artist.id = track.artist) \
+                LEFT JOIN merged.artist AS albumartist \
+                    ON (albumartist.id = album.artist)''')
+        self._addStaged(c)
+        c.execute('''CREATE TEMP TABLE merged_track ( \
+                old         INTEGER, \
+                new         INTEGER, \
+                PRIMARY KEY (old) \
+                )''')
+        c.execute('''INSERT INTO merged_track SELECT merged, %s FROM resolved'''
+                % RESOLVED_TRACK)
+        c.execute('''DROP TABLE resolved''')
+        c.execute('''DROP TABLE staging''')
+        c.execute('''SELECT count(*) FROM merged.track \
+                WHERE id NOT IN (SELECT old FROM merged_track)''')
+        missing = c.fetchone()[0]
+        if missing:
+            log.warning("%d tracks have no artist or album, their plays "
+                    "were not merged" % missing)
+
+    def _mergePlays(self, c, table, batch_size):
+        """
+        Copy the plays of table (see MERGED_PLAYS) about batch_size at a
+        time, yielding (plays read, plays added, first date) of each batch.
+        """
+        c.execute('''SELECT min(date) FROM %s''' % table)
+        start = c.fetchone()[0]
+        while start != None:
+            # every play of the first date, and up to batch_size - 1 after
+            c.execute('''SELECT date FROM %s WHERE date > ? \
+                    ORDER BY date LIMIT 1 OFFSET ?''' % table,
+                    [start, batch_size - 1])
+            row = c.fetchone()
+            end = row[0] if row != None else 2 ** 62
+            c.execute('''BEGIN''')
+            try:
+                c.execute('''SELECT count(*) FROM %s \
+                        WHERE date >= ? AND date < ?''' % table, [start, end])
+                read = c.fetchone()[0]
+                c.execute('''CREATE TEMP TABLE merged_play AS %s'''
+                        % (MERGED_PLAYS % {'table': table,
+                            'day': DAY.replace('play.', 'other.')}),
+                        [start, end])
+                # Counting the plays set-wise is several times quicker than
+                # the stats triggers a play at a time, which the row in
+                # merging holds off (see _add_merging)
+                c.execute('''INSERT INTO merging VALUES (1)''')
+                c.execute('''INSERT INTO main.play \
+                        (date, source, track, listentime) \
+                        SELECT date, source, track, listentime \
+                        FROM temp.merged_play ORDER BY date''')
+                added = c.rowcount
+                _count_stats(c, 'temp.merged_play', 'play.day')
+                c.execute('''DELETE FROM merging''')
+                c.execute('''DROP TABLE temp.merged_play''')
+            except sqlite3.Error:
+                c.execute('''ROLLBACK''')
+                c.execute('''DROP TABLE IF EXISTS temp.merged_play''')
+                raise
+            c.execute('''COMMIT''')
+            yield read, added, start
+            start = row[0] if row != None else None
+
+    def _stage(self, c, rows, columns, batch_size):
+        """
+        Fill temp.staging with rows in batches, the first columns of them
+        being getInfo() fields and the rest extra columns.
+        """
+        c.execute('''CREATE TEMP TABLE staging (file, modified, artist, \
+                albumartist, album, date, num, title, length, genre%s)'''
+                % ''.join(', ' + col for col in columns))
+        insert = '''INSERT INTO staging VALUES (%s)''' \
+                % ','.join('?' * (10 + len(columns)))
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                c.executemany(insert, batch)
+                batch = []
+        c.executemany(insert, batch)
+
+    def _addStaged(self, c, update=False):
+        """
+        Add the artists, albums and tracks in temp.staging that are missing,
+        leaving the rows of staging with their artist and album ids in
+        temp.resolved. Tracks are matched as in getTrackId(); with update,
+        those matched by file get the tags of staging.
+        """
+        c.execute('''INSERT INTO artist (name) \
+                SELECT artist FROM staging \
+                UNION SELECT albumartist FROM staging \
+                EXCEPT SELECT name FROM artist''')
+        c.execute('''INSERT INTO album (title, date, artist) \
+                SELECT DISTINCT staging.album, staging.date, artist.id \
+                FROM staging \
+                JOIN artist ON (artist.name = staging.albumartist) \
+                WHERE true ON CONFLICT DO NOTHING''')
+        c.execute('''CREATE TEMP TABLE resolved AS \
+                SELECT staging.*, artist.id AS artist_id, \
+                    album.id AS album_id \
+                FROM staging \
+                JOIN artist ON (artist.name = staging.artist) \
+                JOIN artist albumartist \
+                    ON (albumartist.name = staging.albumartist) \
+                JOIN album ON (album.artist = albumartist.id \
+                    AND album.title = staging.album \
+                    AND coalesce(album.date, 0) = coalesce(staging.date, 0))''')
+        # tracks recorded before their file was take it, one file each
+        c.execute('''CREATE TEMP TABLE adopted AS \
+                SELECT min(id) AS id, file FROM ( \
+                    SELECT track.id AS id, min(resolved.file) AS file \
+                    FROM resolved JOIN track \
+                        ON (track.album = resolved.album_id \
+                        AND track.title = resolved.title) \
+                    WHERE track.file IS NULL AND resolved.file IS NOT NULL \
+                    AND NOT EXISTS (SELECT 1 FROM track AS owner \
+                        WHERE owner.file = resolved.file) \
+                    GROUP BY track.id) \
+                GROUP BY file''')
+        c.execute('''UPDATE track SET file = (SELECT file FROM adopted \
+                WHERE adopted.id = track.id) \
+                WHERE id IN (SELECT id FROM adopted)''')
+        c.execute('''DROP TABLE adopted''')
+        upsert = ''
+        if update:
+            upsert = ''' ON CONFLICT (file) DO UPDATE SET \
+                    num=excluded.num, title=excluded.title, \
+                    artist=excluded.artist, length=excluded.length, \
+                    genre=excluded.genre, album=excluded.album, \
+                    modified=excluded.modified \
+                WHERE num IS NOT excluded.num \
+                    OR title IS NOT excluded.title \
+                    OR artist IS NOT excluded.artist \
+                    OR length IS NOT excluded.length \
+                    OR genre IS NOT excluded.genre \
+                    OR album IS NOT excluded.album \
+                    OR modified IS NOT excluded.modified'''
+        # without the upsert this doesn't need the unique index on file,
+        # which build() drops while there are no tracks to update
+        c.execute('''INSERT OR IGNORE INTO track \
+                (num, title, artist, length, genre, album, file, modified) \
+                SELECT num, title, artist_id, length, genre, album_id, \
+                    file, modified \
+                FROM resolved WHERE file IS NOT NULL GROUP BY file%s'''
+                % upsert)
+        c.execute('''INSERT INTO track \
+                (num, title, artist, length, genre, album) \
+                SELECT num, title, artist_id, length, genre, album_id \
+                FROM resolved \
+                WHERE file IS NULL AND NOT EXISTS (SELECT 1 FROM track \
+                    WHERE track.album = resolved.album_id \
+                    AND track.title = resolved.title) \
+                GROUP BY album_id, title''')
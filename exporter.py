@@ -0,0 +1,186 @@
+import io
+import os
+import sys
+import csv
+import json
+import gzip
+import sqlite3
+import logging
+from collections import OrderedDict
+
+import dbase
+
+log = logging.getLogger('mpsd')
+
+# The columns of an export, named so "mpsd import csv" reads them back
+COLUMNS = ['timestamp', 'artist', 'title', 'album', 'albumartist', 'length',
+        'genre', 'file', 'listentime', 'source']
+
+# dicts keep their order from python 3.7
+ordered = dict if sys.version_info >= (3, 7) else OrderedDict
+
+# Plays after a cursor, the last (date, source, track) read, in the order
+# of the play table's primary key so they stream straight off it. Queries
+# passed to chunks() select from a play table given as %s, end their
+# columns with its key and are followed by this.
+AFTER = ''' WHERE play.date >= ? AND (play.date > ? OR play.source > ? \
+            OR (play.source = ? AND play.track > ?)) \
+        ORDER BY play.date, play.source, play.track'''
+
+PLAYS = '''SELECT play.date, artist.name, track.title, album.title, \
+        albumartist.name, track.length, track.genre, track.file, \
+        play.listentime, nullif(play.source, ''), \
+        play.date, play.source, play.track \
+        FROM %s AS play \
+        LEFT JOIN track ON (track.id = play.track) \
+        LEFT JOIN artist ON (artist.id = track.artist) \
+        LEFT JOIN album ON (album.id = track.album) \
+        LEFT JOIN artist albumartist ON (albumartist.id = album.artist)'''
+
+def text(value):
+    """
+    A field value as utf-8 bytes for the python 2 csv module.
+    """
+    if isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+# Writers take the rows of a chunk at a time, each row holding COLUMNS
+
+class CsvWriter(object):
+    def __init__(self, f):
+        if sys.version_info[0] < 3:
+            self.f = None
+            self.writer = csv.writer(f)
+        else:
+            self.f = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            self.writer = csv.writer(self.f)
+        self.write([COLUMNS])
+
+    def write(self, rows):
+        if self.f == None:
+            rows = [[text(value) for value in row] for row in rows]
+        self.writer.writerows(rows)
+
+    def close(self):
+        if self.f != None:
+            # leaves the underlying file to the caller
+            self.f.flush()
+            self.f.detach()
+
+class JsonlWriter(object):
+    def __init__(self, f):
+        self.f = f
+        self.encode = json.JSONEncoder().encode
+
+    def write(self, rows):
+        self.f.write(u''.join(u'%s\n' % self.encode(ordered(zip(COLUMNS,
+            row))) for row in rows).encode('utf-8'))
+
+    def close(self):
+        pass
+
+FORMATS = {
+    'csv': CsvWriter,
+    'jsonl': JsonlWriter,
+}
+
+def read_cursor(path):
+    """
+    The (date, source, track) saved at path, or one before any play.
+    """
+    if not path or not os.path.exists(path):
+        return (-1, '', -1)
+    f = open(path)
+    try:
+        saved = json.load(f)
+    finally:
+        f.close()
+    return (saved['date'], saved['source'], saved['track'])
+
+def write_cursor(path, cursor):
+    tmp = path + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        json.dump(dict(zip(('date', 'source', 'track'), cursor)), f)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def open_output(path, buffer_size=1 << 16):
+    """
+    A binary file to write an export to: stdout for "-", gzip compressed
+    if path ends in ".gz". Returns it and the files to close afterwards.
+    """
+    if path == '-':
+        return getattr(sys.stdout, 'buffer', sys.stdout), []
+    f = io.open(path, 'wb', buffering=buffer_size)
+    if path.endswith('.gz'):
+        compressed = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+        return compressed, [compressed, f]
+    return f, [f]
+
+def chunks(db, query, cursor, chunk_size=1000):
+    """
+    Yield the rows of query (see AFTER) for the plays after cursor in
+    the archives, oldest first, and then the database, as (rows, cursor
+    after them) for up to chunk_size rows at a time.
+    """
+    c = db.cursor()
+    try:
+        c.execute('''SELECT path FROM archive WHERE last >= ? \
+                ORDER BY year''', [cursor[0]])
+        tables = [archive for (archive,) in c.fetchall()]
+    except sqlite3.OperationalError:
+        # from before there were archives
+        tables = []
+    tables.append(None)
+    for archive in tables:
+        if archive != None:
+            if not os.path.exists(archive):
+                log.warning("Archive missing, skipped: %s" % archive)
+                continue
+            c.execute('''ATTACH ? AS archived''', [archive])
+        try:
+            c.execute(query % ('archived.play' if archive else 'main.play')
+                    + AFTER, [cursor[0], cursor[0], cursor[1], cursor[1],
+                        cursor[2]])
+            while True:
+                rows = c.fetchmany(chunk_size)
+                if not rows:
+                    break
+                cursor = tuple(rows[-1][-3:])
+                yield rows, cursor
+        finally:
+            if archive != None:
+                c.execute('''DETACH archived''')
+
+def export_plays(db_path, format, path, cursor_path=None, chunk_size=1000):
+    """
+    Write the plays in the database at db_path, archived ones included,
+    to path in one of FORMATS, oldest first. With cursor_path, only the
+    plays after the last one exported with the same cursor_path are
+    written, and it is moved on once the export is complete. Plays
+    recorded later with an earlier date (eg. imported) are not picked up
+    by a cursor past them. Returns the number of plays written.
+
+    Rows are fetched chunk_size at a time, so memory use doesn't grow
+    with the size of the history.
+    """
+    cursor = read_cursor(cursor_path)
+    db = dbase.connect_readonly(db_path)
+    f, files = open_output(path)
+    writer = FORMATS[format](f)
+    written = 0
+    try:
+        for rows, cursor in chunks(db, PLAYS, cursor, chunk_size):
+            writer.write([row[:-3] for row in rows])
+            written += len(rows)
+        writer.close()
+    finally:
+        for opened in files:
+            opened.close()
+        db.close()
+    if cursor_path:
+        write_cursor(cursor_path, cursor)
+    return written
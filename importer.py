@@ -0,0 +1,235 @@
+import io
+import sys
+import csv
+import json
+import time
+import calendar
+import logging
+from itertools import chain
+
+log = logging.getLogger('mpsd')
+
+def skipped(entry):
+    log.warning("Skipping unreadable entry: %s" % (entry,))
+
+def parse_time(value):
+    """
+    Seconds since the epoch from the timestamp formats found in exports:
+    epoch seconds, ISO 8601 and Last.fm's "31 Jan 2020 12:00" (both UTC),
+    or mpsd's own "YYYY-MM-DD HH:MM:SS" (local time).
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%d %b %Y %H:%M',
+            '%d %b %Y, %H:%M'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    return int(time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S')))
+
+def text(value):
+    """
+    An mpd style tag value (a string) from an exported field.
+    """
+    if value == None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if not isinstance(value, type(u'')):
+        return u'%s' % value
+    return value
+
+def song(artist, title, album=None, length=None, **tags):
+    """
+    A song dict like mpd's currentsong, leaving out missing tags.
+    """
+    tags.update({'artist': artist, 'title': title, 'album': album,
+            'time': length if length != None else '0'})
+    return dict((k, text(v)) for k, v in tags.items() if v not in (None, ''))
+
+def json_objects(f, chunk_size=65536):
+    """
+    Yield the JSON objects in f one at a time, whether it holds one per
+    line or a single array of them, without reading it all in.
+    """
+    decoder = json.JSONDecoder()
+    skip = u' \t\r\n,[]'
+    buf = u''
+    for chunk in iter(lambda: f.read(chunk_size), u''):
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in skip:
+                pos += 1
+            if pos == len(buf):
+                break
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the object is not complete yet
+                break
+            yield obj
+        buf = buf[pos:]
+    if buf.strip(skip):
+        raise ValueError("Could not parse JSON near: %s" % buf[:80])
+
+def read_listenbrainz(path):
+    """
+    ListenBrainz exports, a JSON array or JSON lines of listens.
+    """
+    f = io.open(path, encoding='utf-8')
+    try:
+        for listen in json_objects(f):
+            try:
+                meta = listen['track_metadata']
+                info = meta.get('additional_info') or {}
+                length = info.get('duration_ms')
+                if length != None:
+                    length = int(length) // 1000
+                yield song(meta['artist_name'], meta['track_name'],
+                        meta.get('release_name'), length,
+                        track=info.get('tracknumber')), \
+                        int(listen['listened_at'])
+            except (KeyError, ValueError, TypeError):
+                skipped(listen)
+    finally:
+        f.close()
+
+def read_lastfm(path):
+    """
+    Last.fm JSON exports, pages of user.getRecentTracks or an array of
+    the tracks in them.
+    """
+    def tracks(obj):
+        if 'recenttracks' in obj:
+            for track in obj['recenttracks']['track']:
+                yield track
+        else:
+            yield obj
+
+    def name(field):
+        if isinstance(field, dict):
+            return field.get('#text') or field.get('name')
+        return field
+
+    f = io.open(path, encoding='utf-8')
+    try:
+        for obj in json_objects(f):
+            for track in tracks(obj):
+                if 'date' not in track:
+                    # the track playing when the export was made
+                    continue
+                try:
+                    date = track['date']
+                    if isinstance(date, dict):
+                        played = int(date['uts'])
+                    else:
+                        played = parse_time(date)
+                    yield song(name(track['artist']), track['name'],
+                            name(track.get('album'))), played
+                except (KeyError, ValueError, TypeError):
+                    skipped(track)
+    finally:
+        f.close()
+
+def read_mpdscribble(path):
+    """
+    mpdscribble journals, blocks of "key = value" lines.
+    """
+    fields = {'a': 'artist', 't': 'title', 'b': 'album', 'l': 'length',
+            'n': 'track', 'i': 'time'}
+    f = io.open(path, encoding='utf-8')
+    try:
+        entry = {}
+        for line in f:
+            line = line.strip()
+            if line and '=' in line:
+                key, value = line.split('=', 1)
+                if key.strip() in fields:
+                    entry[fields[key.strip()]] = value.strip()
+                continue
+            if entry:
+                yield entry
+                entry = {}
+        if entry:
+            yield entry
+    finally:
+        f.close()
+
+def read_mpdscribble_plays(path):
+    for entry in read_mpdscribble(path):
+        try:
+            played = parse_time(entry.pop('time'))
+            yield song(**entry), played
+        except (KeyError, ValueError, TypeError):
+            skipped(entry)
+
+def read_csv(path):
+    """
+    CSV files. With a header row, columns are picked by name (artist,
+    title, album, albumartist, length, genre and timestamp or date),
+    otherwise they are taken to be artist, album, title, date like the
+    Last.fm CSV exporters write.
+    """
+    aliases = {'track': 'title', 'track_name': 'title', 'name': 'title',
+            'artist_name': 'artist', 'release_name': 'album',
+            'uts': 'timestamp', 'date': 'timestamp', 'time': 'timestamp',
+            'listened_at': 'timestamp', 'duration': 'length'}
+    if sys.version_info[0] < 3:
+        f = open(path, 'rb')
+    else:
+        f = io.open(path, encoding='utf-8', newline='')
+    try:
+        rows = csv.reader(f)
+        first = next(rows)
+        header = [text(v).strip().lower() for v in first]
+        header = [aliases.get(col, col) for col in header]
+        if 'artist' in header and 'title' in header \
+                and 'timestamp' in header:
+            pending = []
+        else:
+            header = ['artist', 'album', 'title', 'timestamp']
+            pending = [first]
+        for row in chain(pending, rows):
+            try:
+                entry = dict(zip(header, [text(v) for v in row]))
+                played = parse_time(entry.pop('timestamp'))
+                tags = dict((k, v) for k, v in entry.items() if k in
+                        ('albumartist', 'genre'))
+                yield song(entry['artist'], entry['title'],
+                        entry.get('album'), entry.get('length'),
+                        **tags), played
+            except (KeyError, ValueError):
+                skipped(row)
+    finally:
+        f.close()
+
+FORMATS = {
+    'listenbrainz': read_listenbrainz,
+    'lastfm': read_lastfm,
+    'mpdscribble': read_mpdscribble_plays,
+    'csv': read_csv,
+}
+
+def import_plays(db, format, paths, batch_size=50000, out=sys.stderr):
+    """
+    Import the plays in paths, files in one of FORMATS, into db, writing
+    progress to out after every batch. Returns the number of plays added.
+    """
+    reader = FORMATS[format]
+    def plays():
+        for path in paths:
+            for song, played in reader(path):
+                # exports don't say how much of a track was listened to
+                yield song, played, None
+
+    start = time.time()
+    added = 0
+    for read, added, bad in db.addPlays(plays(), source=format,
+            batch_size=batch_size):
+        elapsed = max(time.time() - start, 0.001)
+        out.write("%d plays read, %d added, %d unusable, %.0f plays/s\n"
+                % (read, added, bad, read / elapsed))
+    return added
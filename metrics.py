@@ -0,0 +1,329 @@
+import os
+import sys
+import time
+import signal
+import threading
+import logging
+import traceback
+from collections import defaultdict
+try:
+    import cProfile as profile
+except ImportError:
+    import profile
+try:
+    import tracemalloc
+except ImportError:
+    # python 3.4 and up only
+    tracemalloc = None
+
+log = logging.getLogger('mpsd')
+
+# time.monotonic is not available before python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
+# seconds, from well under a millisecond (cached sqlite statements, mpd on
+# localhost) to the long tail of a disk sync or a far away mpd
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10)
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in sorted(labels))
+
+def number(value):
+    if isinstance(value, int):
+        return '%d' % value
+    # repr keeps every digit, %g would round eg. timestamps
+    return repr(float(value))
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def lines(self):
+        return []
+
+    def text(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.kind)]
+        return '\n'.join(lines + self.lines())
+
+class Counter(Metric):
+    """
+    A count that only goes up, per set of labels.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        Metric.__init__(self, name, help)
+        self.values = defaultdict(int)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] += amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def lines(self):
+        with self.lock:
+            return ['%s%s %s' % (self.name, label_text(key), number(value))
+                    for key, value in sorted(self.values.items())]
+
+class Gauge(Metric):
+    """
+    A value read when the metrics are, from a function returning either a
+    number or a dict of {((label, value), ...): number}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, kind='gauge'):
+        Metric.__init__(self, name, help)
+        self.read = read
+        # 'counter' for totals kept elsewhere
+        self.kind = kind
+
+    def lines(self):
+        try:
+            value = self.read()
+        except Exception:
+            log.debug("Could not read %s: %s" % (self.name, sys.exc_info()[1]))
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return ['%s%s %s' % (self.name, label_text(key), number(v))
+                for key, v in sorted(value.items()) if v != None]
+
+class Histogram(Metric):
+    """
+    How many observations fell in each of buckets, per set of labels.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = buckets
+        # labels -> [count per bucket..., count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts == None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) \
+                        + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def lines(self):
+        lines = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                total = 0
+                for bound, count in zip(self.buckets, counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (self.name,
+                        label_text(key + (('le', '%g' % bound),)), total))
+                lines.append('%s_bucket%s %d' % (self.name,
+                    label_text(key + (('le', '+Inf'),)), counts[-2]))
+                lines.append('%s_count%s %d' % (self.name, label_text(key),
+                    counts[-2]))
+                lines.append('%s_sum%s %s' % (self.name, label_text(key),
+                    number(counts[-1])))
+        return lines
+
+class Timer(object):
+    """
+    Observes how long a with block took, even if it raised.
+    """
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(monotonic() - self.start, **self.labels)
+        return False
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, read, kind='gauge'):
+        return self.add(Gauge(name, help, read, kind))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def text(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return '\n'.join(metric.text() for metric in metrics) + '\n'
+
+    def write(self, path):
+        """
+        Write text() to path, replacing it only once complete, eg. for the
+        node_exporter textfile collector.
+        """
+        tmp = path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write(self.text())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+def rss():
+    """
+    Resident set size of this process in bytes.
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        import resource
+        # the peak rather than the current size, in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+REGISTRY = Registry()
+
+MPD_SECONDS = REGISTRY.histogram('mpsd_mpd_request_seconds',
+        "Round trip time of mpd commands.")
+MPD_RECONNECTS = REGISTRY.counter('mpsd_mpd_reconnects_total',
+        "Times the connection to an mpd server was lost and re-established.")
+TRACKER_RESTARTS = REGISTRY.counter('mpsd_tracker_restarts_total',
+        "Times following an mpd server failed and its tracker started over.")
+LOOP_LAG = REGISTRY.histogram('mpsd_loop_lag_seconds',
+        "How much later than intended the tracker woke up to look at mpd.")
+DB_SECONDS = REGISTRY.histogram('mpsd_db_statement_seconds',
+        "Time spent writing a play or listen time, excluding the commit.")
+DB_COMMIT_SECONDS = REGISTRY.histogram('mpsd_db_commit_seconds',
+        "Time spent committing a transaction.")
+PLAYS = REGISTRY.counter('mpsd_plays_total',
+        "Plays written to the database.")
+REGISTRY.gauge('mpsd_resident_memory_bytes',
+        "Resident set size of the mpsd process.", rss)
+STARTED = time.time()
+REGISTRY.gauge('mpsd_start_time_seconds',
+        "When mpsd started, in seconds since the epoch.", lambda: STARTED)
+
+class Profiler(object):
+    """
+    Profiles the running daemon between two signals. The first starts a
+    cProfile of the main thread, a sampler of the stacks of every thread
+    and, where available, tracemalloc. The second stops them and writes
+    what they found to files in directory:
+
+        mpsd-TIME.prof      cProfile stats, for pstats or snakeviz
+        mpsd-TIME.stacks    sampled stacks, one "frame;frame;... count"
+                            line each, for flamegraph.pl
+        mpsd-TIME.memory    the lines holding the most allocated memory
+    """
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.profile = None
+        self.samples = None
+        self.sampler = None
+        self.sampling = threading.Event()
+
+    def install(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.toggle)
+
+    def toggle(self, signum=None, frame=None):
+        if self.profile == None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        log.info("Profiling started")
+        self.samples = defaultdict(int)
+        self.sampling.set()
+        self.sampler = threading.Thread(target=self.sample,
+                name='mpsd-profiler')
+        self.sampler.daemon = True
+        self.sampler.start()
+        if tracemalloc:
+            tracemalloc.start()
+        # signal handlers run in the main thread, as does the tracker
+        self.profile = profile.Profile()
+        self.profile.enable()
+
+    def sample(self):
+        me = threading.current_thread().ident
+        names = {}
+        while self.sampling.is_set():
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = traceback.extract_stack(frame)
+                key = ';'.join([names.get(ident, str(ident))]
+                        + ['%s:%s' % (entry[2], entry[1]) for entry in stack])
+                self.samples[key] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.profile.disable()
+        profiler, self.profile = self.profile, None
+        self.sampling.clear()
+        self.sampler.join()
+        base = os.path.join(self.directory, 'mpsd-%s'
+                % time.strftime('%Y%m%d-%H%M%S'))
+        try:
+            profiler.dump_stats(base + '.prof')
+            f = open(base + '.stacks', 'w')
+            try:
+                for stack, count in sorted(self.samples.items()):
+                    f.write('%s %d\n' % (stack, count))
+            finally:
+                f.close()
+            if tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                f = open(base + '.memory', 'w')
+                try:
+                    for stat in snapshot.statistics('lineno')[:100]:
+                        f.write('%s\n' % stat)
+                finally:
+                    f.close()
+        except (IOError, OSError):
+            log.error("Could not write profile: %s" % (sys.exc_info()[1]))
+            return
+        log.info("Profile written to %s.*" % base)
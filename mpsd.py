@@ -4,14 +4,27 @@ import sys
 import time
 import mpd
 import os
+import errno
+import select
+import signal
+import socket
+import threading
 import logging
 import logging.handlers
-from sqlite3 import Error as SqlError
 from socket import error as SocketError
 from socket import timeout as SocketTimeout
 
 import dbase
 import daemon
+import writer
+import sink
+import importer
+import exporter
+import backup
+import search
+import render
+import api
+import metrics
 
 #-------------------------------------------
 # Change the following to suit your system
@@ -23,6 +36,19 @@ PORT = '6600'
 #If no password, set to None
 PASSWORD = None
 
+# To follow several mpd servers from one mpsd, list them here as
+# (host, port, password) tuples. HOST, PORT and PASSWORD are then unused.
+# Plays are recorded with the "host:port" of the server they came from.
+SERVERS = []
+
+# Longest wait (in seconds) between attempts to reconnect to a server
+RECONNECT_MAX = 60
+
+# Seconds a connection to a server may be silent (eg. waiting in idle)
+# before TCP keepalive probes check that it is still there, so a server
+# that went away unannounced is noticed. None to not send probes.
+KEEPALIVE = 60
+
 DB_PATH = "/var/local/mpsd.db"
 LOG_FILE = "/var/log/mpd/mpsd.log"
 PID_FILE = "/tmp/mpsd.pid"
@@ -32,16 +58,76 @@ PID_FILE = "/tmp/mpsd.pid"
 # will be, but will use more resources.
 POLL_FREQUENCY = 1
 
+# How to follow the player: "idle" waits for MPD to report player changes
+# and only wakes up when needed, "poll" checks MPD every POLL_FREQUENCY
+# seconds. Servers without idle support always fall back to polling.
+TRACKING_MODE = "idle"
+
 # How far into the song to add it as a fraction of the songlength
 # Make sure < 1, and remember that poll frequency may cause innaccuracies
 # as well, if threshold is high.
 # to add at beginning of a song, set to 0
 ADD_THRESHOLD = 0.2
 
+# Number of artist, album and track ids to keep in memory, saving
+# database lookups when recording plays
+ID_CACHE_SIZE = 1024
+
+# Plays are grouped into listening sessions, which end when the player is
+# stopped or nothing is played for SESSION_GAP seconds after the end of
+# the last play. Run "mpsd rebuild" after changing it.
+SESSION_GAP = 30 * 60
+
+# Group commit: plays and listen times are committed to the database
+# once COMMIT_EVENTS of them are pending, or COMMIT_INTERVAL seconds after
+# the first one, whichever comes first. The defaults commit every write.
+# Larger values mean fewer disk syncs (less wear on SD cards), at the cost
+# of losing up to that many uncommitted plays if mpsd is killed with
+# SIGKILL or the machine loses power; a normal stop commits them.
+COMMIT_INTERVAL = 0
+COMMIT_EVENTS = 1
+
+# Also send plays to a central mpsd running "mpsd receive", eg.
+# "http://stats.example.com:6601/". They are kept in SPOOL_PATH until the
+# server has them. If None, stats are only kept in DB_PATH.
+REMOTE_URL = None
+SPOOL_PATH = "/var/local/mpsd.spool"
+# Port "mpsd receive" listens on
+RECEIVE_PORT = 6601
+
+# How many plays and listen time updates may wait for the database
+# before the tracker has to wait for it
+WRITE_QUEUE_SIZE = 1000
+
 # The default stats template
 STATS_TEMPLATE = "/home/marc/projects/mpsd/template.html"
-# Path to stats generation script, default "sqltd"
-STATS_SCRIPT = "sqltd"
+# Where the running daemon keeps the rendered stats template, re-rendered
+# every STATS_INTERVAL seconds. If None, stats are only made by "mpsd stats"
+STATS_OUTPUT = None
+STATS_INTERVAL = 300
+
+# Port of the JSON stats API served by the daemon, None to not serve it
+API_PORT = None
+# How many read-only database connections the API may use at once
+API_CONNECTIONS = 4
+
+# Where to write metrics in the Prometheus text format every
+# METRICS_INTERVAL seconds, None to not write them. With API_PORT set they
+# are also served at /metrics.
+METRICS_FILE = None
+METRICS_INTERVAL = 60
+# Where "kill -USR1" profiles of the running daemon are written
+PROFILE_DIR = "/tmp"
+
+# "mpsd archive" moves plays older than ARCHIVE_AFTER days out of DB_PATH
+# into a database per year in ARCHIVE_DIR (next to DB_PATH if None).
+# Their counts stay in the stats tables.
+ARCHIVE_DIR = None
+ARCHIVE_AFTER = 730
+
+# Where "mpsd snapshot" copies DB_PATH to, and what "mpsd stats" and "mpsd
+# export" read with --snapshot (DB_PATH + ".snapshot" if None)
+SNAPSHOT_PATH = None
 
 #
 # Configuration ends here
@@ -52,18 +138,52 @@ LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(levelname)s\t%(asctime)s\t%(module)s %(lineno)d\t%(message)s'
 STDOUT_FORMAT = '%(levelname)s\t%(module)s\t%(message)s'
 
+ACTIONS = ('start', 'stop', 'restart', 'stats', 'receive', 'build',
+        'import', 'export', 'rebuild', 'archive', 'snapshot', 'search',
+        'merge')
+
+# time.monotonic is not available before python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
 def usage():
     print "Usage:"
-    print "  %s [OPTIONS] (start|stop|restart|stats)\n" % sys.argv[0]
+    print "  %s [OPTIONS] ACTION [ARGS]\n" % sys.argv[0]
     print "Music Player Stats Daemon - a daemon for recording stats from MPD"
 
     print "\nRequired Arguments:"
-    print "  One of (start|stop|restart|stats):"
+    print "  One of:"
     print "    start\n\tStart mpsd"
     print "    stop\n\tStop the currently running mpsd instance"
     print "    restart\n\tRestart the currently running mpsd instance"
     print "    stats [stats_template]"
     print "    \tGenerate statistics using the specified template file."
+    print "    build"
+    print "    \tAdd every song in the mpd library(s) to the database."
+    print "    import FORMAT FILE..."
+    print "    \tImport plays from other scrobblers. FORMAT is one of",
+    print ", ".join(sorted(importer.FORMATS)) + "."
+    print "    export FORMAT FILE [CURSOR_FILE]"
+    print "    \tWrite the play history to FILE (- for stdout, gzipped if it"
+    print "    \tends in .gz) as",
+    print " or ".join(sorted(exporter.FORMATS)) + ". With CURSOR_FILE, only"
+    print "    \tthe plays since the last export with it are written."
+    print "    rebuild"
+    print "    \tRecompute the per day play counts and the listening"
+    print "    \tsessions from the full history."
+    print "    archive [days]"
+    print "    \tMove plays older than days (default ARCHIVE_AFTER) into"
+    print "    \tyearly archive databases."
+    print "    snapshot [FILE]"
+    print "    \tCopy the database to FILE (default SNAPSHOT_PATH) while mpsd"
+    print "    \tkeeps running. Nothing is copied if FILE is up to date."
+    print "    merge FILE..."
+    print "    \tAdd the plays of other mpsd databases (and their archives)"
+    print "    \tthat are not in this one yet."
+    print "    search WORD..."
+    print "    \tFind artists, albums and tracks with names that have words"
+    print "    \tstarting with each WORD, with their play counts."
+    print "    receive [port]"
+    print "    \tRecord plays sent by other mpsd instances (see REMOTE_URL)."
 
     print "\nOptional Arguments:"
     print "  -c, --config <FILE>\n\tSpecify the config file (not implemented)"
@@ -71,6 +191,8 @@ def usage():
     print "  --fg\n\tRun mpsd in the foreground"
     print "  --template TEMPLATE_FILE\n\tThe template file to use when ",
     print "generating statistics."
+    print "  --snapshot\n\tHave stats and export read a snapshot of the",
+    print "database, brought up to date first, rather than the database."
     print "  -h, --help\n\tShow this help message"
 
 def initialize_logger(logfile, log_level=logging.INFO, stdout=False):
@@ -86,11 +208,23 @@ def initialize_logger(logfile, log_level=logging.INFO, stdout=False):
         log.addHandler(shandler)
 
 class MPD(object):
-    def __init__(self, host=None, port=None, password=None):
+    def __init__(self, host=None, port=None, password=None,
+            keepalive=KEEPALIVE):
         self.host = host
         self.port = port
         self.password = password
+        self.keepalive = keepalive
         self.client = mpd.MPDClient()
+        self.server = "%s:%s" % (host, port)
+        # the decoded current song and its songid, while it stays current
+        self.song = {}
+        self.songID = None
+
+    def request(self, command):
+        """
+        Time an mpd command, for use in a with block.
+        """
+        return metrics.MPD_SECONDS.time(command=command, server=self.server)
 
     def connect(self):
         """
@@ -106,8 +240,31 @@ class MPD(object):
             return False
         else:
             log.info("Connected to %s:%s" % (self.host, self.port))
-            return True
-        return self.authenticate() if self.password else True
+            # songids start over when mpd restarts
+            self.song = {}
+            self.songID = None
+            self.setKeepalive()
+            return self.authenticate() if self.password else True
+
+    def setKeepalive(self):
+        """
+        Turn on TCP keepalive probes after keepalive seconds of silence.
+        """
+        sock = getattr(self.client, '_sock', None)
+        if not self.keepalive or sock == None or sock.family not in \
+                (socket.AF_INET, getattr(socket, 'AF_INET6', None)):
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # not every platform lets these be set
+            for option, value in (('TCP_KEEPIDLE', self.keepalive),
+                    ('TCP_KEEPINTVL', max(self.keepalive // 4, 1)),
+                    ('TCP_KEEPCNT', 4)):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP,
+                            getattr(socket, option), value)
+        except SocketError:
+            log.debug("Could not set keepalive: %s" % (sys.exc_info()[1]))
 
     def authenticate(self):
         """
@@ -128,27 +285,69 @@ class MPD(object):
             log.info("Authenticated")
             return True
 
-    def getCurrentSong(self):
+    def getCurrentSong(self, songid=None):
         """
-        Get the current song from the mpd server
+        Get the current song from the mpd server, or from the last one it
+        sent if that is still songid (from the status).
         """
+        if songid != None and songid == self.songID:
+            return self.song
         try:
-            curSong = self.client.currentsong()
-            for k in curSong.keys():
-                if isinstance(curSong[k], (tuple, list)):
-                    curSong[k] = curSong[k][0]
-                curSong[k] = unicode(curSong[k], 'utf-8')
-            return curSong
+            with self.request('currentsong'):
+                song = self.client.currentsong()
         except (mpd.MPDError, SocketTimeout):
             log.error("Could not get status: %s" % (sys.exc_info()[1]))
             return {}
+        return self.cacheSong(song.get('id'), song)
+
+    def cacheSong(self, songid, song):
+        """
+        Keep song as the current one, decoding it unless it already is.
+        """
+        if songid == None or songid != self.songID:
+            self.song = self.songInfo(song)
+            self.songID = songid
+        return self.song
 
-    def getStatus(self):
+    def songInfo(self, song):
         """
-        Get the status of the mpd server
+        Decode a song dict from mpd, keeping the first of repeated tags
+        """
+        for k in song.keys():
+            if isinstance(song[k], (tuple, list)):
+                song[k] = song[k][0]
+            song[k] = unicode(song[k], 'utf-8')
+        return song
+
+    def listAllInfo(self):
+        """
+        Yield the info of every song in the mpd library, as it arrives
+        """
+        self.client.iterate = True
+        try:
+            for entry in self.client.listallinfo():
+                if 'file' in entry:
+                    yield self.songInfo(entry)
+        finally:
+            self.client.iterate = False
+
+    def getStatus(self, song=False):
+        """
+        Get the status of the mpd server. With song, the current song is
+        asked for in the same command list, so a getCurrentSong() right
+        after costs no round trip of its own.
         """
         try:
-            return self.client.status()
+            if not song:
+                with self.request('status'):
+                    return self.client.status()
+            with self.request('status,currentsong'):
+                self.client.command_list_ok_begin()
+                self.client.status()
+                self.client.currentsong()
+                status, current = self.client.command_list_end()
+            self.cacheSong(status.get('songid'), current)
+            return status
         except mpd.CommandError:
             log.error("Could not get status")
             return False
@@ -161,15 +360,304 @@ class MPD(object):
         else:
             return True
 
+    def supportsIdle(self):
+        """
+        Check whether the mpd server understands the idle command
+        """
+        try:
+            return 'idle' in self.client.commands()
+        except (mpd.MPDError, SocketError):
+            log.error("Could not get commands: %s" % (sys.exc_info()[1]))
+            return False
+
+    def idle(self, subsystems, timeout=None):
+        """
+        Wait until one of the given subsystems changes, or until timeout
+        seconds have passed. Returns the list of changed subsystems, an
+        empty list on timeout, or None if the connection failed.
+        """
+        try:
+            self.client.send_idle(*subsystems)
+            ready = self.wait(timeout)
+            if ready:
+                return self.client.fetch_idle()
+            # noidle makes mpd answer the pending idle straight away
+            with self.request('noidle'):
+                return self.client.noidle()
+        except (mpd.MPDError, SocketError, select.error):
+            log.error("Idle failed: %s" % (sys.exc_info()[1]))
+            return None
+
+    def wait(self, timeout):
+        """
+        Wait for mpd to answer, for up to timeout seconds. Signals (eg.
+        SIGUSR1 for a profile) don't cut the wait short.
+        """
+        deadline = None if timeout == None else monotonic() + timeout
+        while True:
+            try:
+                return select.select([self.client], [], [], None
+                        if deadline == None
+                        else max(deadline - monotonic(), 0))[0]
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+
     def disconnect(self):
         """
         Disconect from the mpd server
         """
         self.client.disconnect()
 
+class TrackState(object):
+    """
+    What the tracker knows about the song currently playing on a server.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.songID = None      # mpd's id of the current song
+        self.song = {}          # currentsong info of songID
+        self.trackID = None     # the songID that has been added
+        self.total = 0          # seconds listened to the current song
+        self.prevDate = None    # the time when the current song was added
+        self.playStart = None   # monotonic time playback was last resumed
+
+    def suspend(self, now):
+        """
+        Add the time played since playStart to total and stop counting.
+        """
+        if self.playStart != None:
+            self.total += max(now - self.playStart, 0)
+            self.playStart = None
+
+    def length(self):
+        """
+        Length of the current song in seconds, 0 if unknown (eg. streams).
+        """
+        try:
+            return int(self.song.get('time', 0))
+        except ValueError:
+            return 0
+
+    def timeout(self, threshold):
+        """
+        Seconds until the current song crosses the add threshold, or None
+        if nothing is going to happen without a player event.
+        """
+        if self.playStart == None or self.trackID == self.songID \
+                or not self.length():
+            return None
+        return max(threshold * self.length() - self.total, 0)
+
+def elapsed(status):
+    """
+    Seconds into the current song, from an mpd status dict.
+    """
+    if 'elapsed' in status:
+        return float(status['elapsed'])
+    return int(status.get('time', '0').split(':')[0])
+
+class Tracker(object):
+    """
+    Follows the player of one mpd server, queueing its plays and listen
+    times on a DBWriter tagged with the server they came from.
+    """
+    def __init__(self, server, writer, poll_frequency=POLL_FREQUENCY,
+            add_threshold=ADD_THRESHOLD, tracking_mode=TRACKING_MODE):
+        self.mpd = server
+        self.writer = writer
+        self.source = "%s:%s" % (server.host, server.port)
+        self.poll_frequency = poll_frequency
+        self.add_threshold = add_threshold
+        self.tracking_mode = tracking_mode
+        self.now = None         # the song playing and the player state
+        self.up = False         # whether it is following the player
+
+    def nowPlaying(self):
+        """
+        What the server is playing, for the stats API.
+        """
+        now = self.now
+        return dict(now or {'state': 'stop', 'song': None},
+                source=self.source)
+
+    def reconnect(self):
+        """
+        Drop the current mpd connection and block until mpd is back.
+        """
+        metrics.MPD_RECONNECTS.inc(server=self.source)
+        try:
+            self.mpd.disconnect()
+        except (mpd.MPDError, SocketError):
+            pass
+        self.connect()
+
+    def connect(self):
+        """
+        Block until connected to mpd, waiting longer between each attempt.
+        """
+        delay = self.poll_frequency
+        while not self.mpd.connect():
+            log.debug("Attempting reconnect to %s in %ds"
+                    % (self.source, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+        log.debug("Connected!")
+
+    def eventLoop(self):
+        """
+        The main event loop for a server.
+        """
+        if self.tracking_mode == 'idle':
+            if self.mpd.supportsIdle():
+                return self.idleLoop()
+            log.info("Server does not support idle, polling instead")
+        self.pollLoop()
+
+    def idleLoop(self):
+        """
+        Follow the player with mpd's idle command. Sleeps until the player
+        changes, waking up early only when the playing song is due to
+        cross the add threshold.
+        """
+        state = TrackState()
+        changed = ['player']    # what idle last woke up for
+        while True:
+            # the song has usually changed along with the player, so ask
+            # for both in one round trip
+            status = self.mpd.getStatus(song=bool(changed))
+            if not status:
+                state.suspend(monotonic())
+                self.reconnect()
+                continue
+            self.observe(state, status, monotonic())
+            timeout = state.timeout(self.add_threshold)
+            start = monotonic()
+            changed = self.mpd.idle(['player'], timeout)
+            if changed == None:
+                state.suspend(monotonic())
+                self.reconnect()
+                changed = ['player']
+            elif not changed:
+                # woke up to add the song, how late was that
+                metrics.LOOP_LAG.observe(max(monotonic() - start - timeout,
+                    0), server=self.source)
+
+    def observe(self, state, status, now):
+        """
+        Bring state up to date with a fresh mpd status, recording listen
+        time and new plays as needed.
+        """
+        state.suspend(now)
+        if status['state'] == 'stop':
+            if state.prevDate != None:
+                self.writer.listentime(int(state.total), state.prevDate,
+                        self.source, stopped=True)
+            state.reset()
+            self.now = None
+            return
+
+        if status.get('songid') != state.songID:
+            if state.prevDate != None:
+                #New track
+                self.writer.listentime(int(state.total), state.prevDate,
+                        self.source)
+            state.reset()
+            state.songID = status.get('songid')
+            state.song = self.mpd.getCurrentSong(state.songID)
+            state.total = elapsed(status)
+        if status['state'] == 'play':
+            state.playStart = now
+        self.now = {'state': status['state'], 'song': state.song}
+
+        if state.trackID != state.songID and state.length() \
+                and state.total >= self.add_threshold*state.length():
+            print state.song.get('title', 'Unknown Title')
+            state.prevDate = self.writer.play(state.song, self.source)
+            state.trackID = state.songID
+
+    def pollLoop(self):
+        """
+        Follow the player by polling mpd every poll_frequency seconds.
+        """
+        trackID = None  # the id of the playing track
+        total = 0       # total time played in the track
+        prevDate = None # the time when the previous was added
+        last = None     # when the last round started
+        while True:
+            now = monotonic()
+            if last != None:
+                metrics.LOOP_LAG.observe(max(now - last
+                    - self.poll_frequency, 0), server=self.source)
+            last = now
+            status = self.mpd.getStatus()
+            if not status:
+                self.reconnect()
+            elif status['state'] == 'play':
+                # only fetched again when the song changes
+                currentSong = self.mpd.getCurrentSong(status.get('songid'))
+                self.now = {'state': 'play', 'song': currentSong}
+                total = total + self.poll_frequency
+                if currentSong['id'] != trackID:
+                    if prevDate != None:
+                        #New track
+                        self.writer.listentime(total, prevDate, self.source)
+                        total = int(status['time'].rsplit(':')[0])
+                        prevDate = None
+                    if total >= self.add_threshold*int(currentSong['time']):
+                        print currentSong.get('title', 'Unknown Title')
+                        prevDate = self.writer.play(currentSong,
+                                self.source)
+                        trackID = currentSong['id']
+            elif status['state'] == 'pause':
+                self.now = {'state': 'pause',
+                        'song': self.mpd.getCurrentSong(status.get('songid'))}
+            elif status['state'] == 'stop':
+                self.now = None
+                if prevDate != None:
+                    self.writer.listentime(total, prevDate, self.source,
+                            stopped=True)
+                    total = 0
+                    prevDate = None
+            time.sleep(self.poll_frequency)
+
+    def run(self):
+        """
+        Connect to the server and follow it until mpsd exits. If following
+        it fails, the error is logged and the tracker starts over on a new
+        connection, waiting longer each time it fails again soon after.
+        """
+        delay = self.poll_frequency
+        while True:
+            self.connect()
+            print "Connected to %s!" % self.source
+            self.up = True
+            start = monotonic()
+            try:
+                self.eventLoop()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                log.exception("%s: %s, starting over in %ds"
+                        % (self.source, sys.exc_info()[1], delay))
+            finally:
+                self.up = False
+            self.now = None
+            metrics.TRACKER_RESTARTS.inc(server=self.source)
+            try:
+                self.mpd.disconnect()
+            except (mpd.MPDError, SocketError):
+                pass
+            if monotonic() - start > RECONNECT_MAX:
+                delay = self.poll_frequency
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
 class mpdStatsDaemon(daemon.Daemon):
     def __init__(self, template=STATS_TEMPLATE, fork=True,
-            log_level=logging.INFO,
+            log_level=logging.INFO, snapshot=False,
             stdin='/dev/null', stdout='/dev/null', stderr='/dev/null'):
         # daemon settings
         self.stdin = stdin
@@ -181,12 +669,53 @@ class mpdStatsDaemon(daemon.Daemon):
         # config options
         self.log_file = LOG_FILE
         self.poll_frequency = POLL_FREQUENCY
+        self.tracking_mode = TRACKING_MODE
         self.add_threshold = ADD_THRESHOLD
-        self.stats_script = STATS_SCRIPT
         self.template = template
+        self.read_snapshot = snapshot
+        self.snapshot_path = SNAPSHOT_PATH or DB_PATH + '.snapshot'
+        self.stats_output = STATS_OUTPUT
+        self.stats_interval = STATS_INTERVAL
+        self.api_port = API_PORT
+        self.metrics_file = METRICS_FILE
+        self.metrics_interval = METRICS_INTERVAL
+        self.profiler = metrics.Profiler(PROFILE_DIR)
 
-        self.mpd = MPD(HOST, PORT, PASSWORD)
-        self.db = dbase.MpsdDB(DB_PATH)
+        self.db = dbase.MpsdDB(DB_PATH, cache_size=ID_CACHE_SIZE,
+                commit_interval=COMMIT_INTERVAL, commit_events=COMMIT_EVENTS,
+                session_gap=SESSION_GAP)
+        sinks = []
+        if REMOTE_URL:
+            sinks.append(sink.RemoteSink(SPOOL_PATH, REMOTE_URL,
+                commit_interval=COMMIT_INTERVAL, commit_events=COMMIT_EVENTS))
+        self.writer = writer.DBWriter(self.db, queue_size=WRITE_QUEUE_SIZE,
+                warm_cache=True, sinks=sinks)
+        self.trackers = [Tracker(MPD(host, port, password), self.writer,
+                poll_frequency=self.poll_frequency,
+                add_threshold=self.add_threshold,
+                tracking_mode=self.tracking_mode)
+            for host, port, password in SERVERS or [(HOST, PORT, PASSWORD)]]
+
+        metrics.REGISTRY.gauge('mpsd_write_queue_depth',
+                "Plays and listen times waiting to be written.",
+                self.writer.queue.qsize)
+        metrics.REGISTRY.gauge('mpsd_write_events_total',
+                "Events the writer handled, by what became of them.",
+                lambda: dict(((('outcome', k),), v) for k, v in
+                    self.writer.stats().items()
+                    if k in ('written', 'failed', 'dropped')),
+                kind='counter')
+        metrics.REGISTRY.gauge('mpsd_tracker_up',
+                "Whether the tracker of a server is following its player "
+                "(0 while it connects or starts over after an error).",
+                lambda: dict(((('server', t.source),), int(t.up))
+                    for t in self.trackers))
+        metrics.REGISTRY.gauge('mpsd_id_cache_requests_total',
+                "Artist, album and track id lookups, by whether the cache "
+                "had them.",
+                lambda: {(('result', 'hit'),): self.db.cache.hits,
+                    (('result', 'miss'),): self.db.cache.misses},
+                kind='counter')
 
         # set up logging
         initialize_logger(self.log_file, log_level=log_level, stdout=not fork)
@@ -205,77 +734,265 @@ class mpdStatsDaemon(daemon.Daemon):
         return is_valid
 
     def generateStats(self):
+        """
+        Print the stats template, filled in from the database.
+        """
         if not os.access(self.template, os.F_OK):
             print >> sys.stderr, "Invalid template file %s" % self.template
-        cmd = self.stats_script if self.stats_script else "sqltd"
-        rc = os.system("%s %s < %s" % (cmd, self.db.path, self.template))
-        if rc == 127:
-            print "Error: %s could not be found." % cmd
             exit(1)
-        elif rc != 0:
-            print "Error: Could not generate statistics"
+        renderer = render.StatsRenderer(self.readPath(), self.template)
+        try:
+            sys.stdout.write(renderer.render().encode('utf-8'))
+        except dbase.sqlite3.Error as err:
+            print >> sys.stderr, "Error: Could not generate statistics: %s" \
+                    % err
             exit(1)
+        finally:
+            renderer.close()
 
-    def eventLoop(self):
+    def statsLoop(self):
         """
-        The main event loop for mpsd.
+        Keep STATS_OUTPUT up to date. Queries whose tables have not changed
+        since the last time are not run again.
         """
-        trackID = None  # the id of the playing track
-        total = 0       # total time played in the track
-        prevDate = None # the time when the previous was added
+        renderer = render.StatsRenderer(self.db.path, self.template)
         while True:
-            status = self.mpd.getStatus()
-            if not status:
-                mpd.disconnect()
-                while not self.mpd.connect():
-                    log.debug("Attempting reconnect")
-                    time.sleep(self.poll_frequency)
-                log.debug("Connected!")
-                if self.password:
-                    self.mpd.authenticate(self.password)
-            elif status['state'] == 'play':
-                currentSong = self.mpd.getCurrentSong()
-                total = total + self.poll_frequency
-                if currentSong['id'] != trackID:
-                    if prevDate != None:
-                        #New track
-                        self.db.updateListentime(total, prevDate)
-                        total = int(status['time'].rsplit(':')[0])
-                        prevDate = None
-                    if total >= self.add_threshold*int(currentSong['time']):
-                        print currentSong.get('title', 'Unknown Title')
-                        try:
-                            prevDate = self.db.update(currentSong)
-                        except SqlError as e:
-                            log.error("Sqlite3 Error: %s\nAdding track: %s\n"
-                                    % (e, currentSong))
-                        trackID = currentSong['id']
-            elif status['state'] == 'stop':
-                if prevDate != None:
-                    self.db.updateListentime(total, prevDate)
-                    total = 0
-                    prevDate = None
-            time.sleep(self.poll_frequency)
+            try:
+                renderer.write(self.stats_output)
+                log.debug("Rendered %s: %d queries run, %d cached"
+                        % (self.stats_output, renderer.runs, renderer.hits))
+            except (IOError, OSError, dbase.sqlite3.Error) as err:
+                log.error("Could not render stats: %s" % err)
+                renderer.close()
+            time.sleep(self.stats_interval)
+
+    def metricsLoop(self):
+        """
+        Keep METRICS_FILE up to date.
+        """
+        while True:
+            try:
+                metrics.REGISTRY.write(self.metrics_file)
+            except (IOError, OSError) as err:
+                log.error("Could not write metrics: %s" % err)
+            time.sleep(self.metrics_interval)
+
+    def terminate(self, signum, frame):
+        """
+        Signal handler, exits through run() so queued writes get committed.
+        """
+        # Daemon.stop() keeps signalling until we are gone, don't let that
+        # interrupt the writer draining its queue
+        signal.signal(signum, signal.SIG_IGN)
+        log.info("Caught signal %d, exiting" % signum)
+        sys.exit(0)
+
+    def build(self):
+        """
+        Add every song in the library of each server to the database.
+        """
+        self.db.connect()
+        for tracker in self.trackers:
+            tracker.connect()
+            start = time.time()
+            added, unchanged, bad = self.db.build(tracker.mpd.listAllInfo())
+            print "%s: added %d songs, %d unchanged, %d skipped in %.1fs" \
+                    % (tracker.source, added, unchanged, bad,
+                        time.time() - start)
+            tracker.mpd.disconnect()
+        self.db.close()
+
+    def importPlays(self, format, paths):
+        """
+        Import plays exported from other scrobblers.
+        """
+        if format not in importer.FORMATS:
+            print "Unknown import format %s" % format
+            exit(1)
+        self.db.connect()
+        added = importer.import_plays(self.db, format, paths)
+        print "Imported %d plays" % added
+        self.db.close()
+
+    def exportPlays(self, format, path, cursor=None):
+        """
+        Export the play history for other tools.
+        """
+        if format not in exporter.FORMATS:
+            print >> sys.stderr, "Unknown export format %s" % format
+            exit(1)
+        start = time.time()
+        written = exporter.export_plays(self.readPath(), format, path,
+                cursor)
+        print >> sys.stderr, "Exported %d plays in %.1fs" \
+                % (written, time.time() - start)
+
+    def merge(self, paths):
+        """
+        Add the plays of other mpsd databases to ours.
+        """
+        self.db.connect()
+        for path in paths:
+            start = time.time()
+            merged = path
+            if os.path.exists(path) \
+                    and dbase.schema_version(path) < dbase.MIGRATIONS[-1][0]:
+                # older databases are migrated, but not in place
+                merged = self.db.path + '.merging'
+                print >> sys.stderr, "Migrating a copy of %s to %s" \
+                        % (path, merged)
+                backup.snapshot(path, merged)
+                copy = dbase.MpsdDB(merged)
+                copy.connect()
+                copy.close()
+            read = added = 0
+            try:
+                for read, added in self.db.merge(merged):
+                    elapsed = max(time.time() - start, 0.001)
+                    print >> sys.stderr, \
+                            "%d plays read, %d added, %.0f plays/s" \
+                            % (read, added, read / elapsed)
+            finally:
+                if merged != path:
+                    backup.remove(merged)
+            print "%s: %d plays read, %d added in %.1fs" \
+                    % (path, read, added, time.time() - start)
+        self.db.close()
+
+    def searchNames(self, words, limit=10):
+        """
+        Print the artists, albums and tracks found by search.search().
+        """
+        text = u' '.join(word.decode('utf-8') for word in words)
+        db = dbase.connect_readonly(self.readPath())
+        try:
+            start = time.time()
+            found = search.search(db.cursor(), text, limit)
+            elapsed = time.time() - start
+        finally:
+            db.close()
+        for table, column in dbase.SEARCHED:
+            print "%ss" % table.capitalize()
+            for row in found[table]:
+                names = [row[key] or u'?'
+                        for key in (column, 'artist', 'album') if key in row]
+                if row['last_played']:
+                    played = u"%d plays, last %s" % (row['plays'],
+                            row['last_played'])
+                else:
+                    played = u"never played"
+                sys.stdout.write((u"  %s (%s)\n" % (u' - '.join(names),
+                    played)).encode('utf-8'))
+        print >> sys.stderr, "Searched in %.1f ms" % (elapsed * 1000)
+
+    def rebuildStats(self):
+        """
+        Recompute the per day stats tables used by the stats template,
+        and the listening sessions.
+        """
+        self.db.connect()
+        start = time.time()
+        self.db.rebuildStats()
+        print "Rebuilt stats in %.1fs" % (time.time() - start)
+        self.db.close()
+
+    def archive(self, days=ARCHIVE_AFTER):
+        """
+        Move plays older than days out of the database into yearly archives.
+        """
+        directory = ARCHIVE_DIR or os.path.dirname(os.path.abspath(
+                self.db.path))
+        self.db.connect()
+        start = time.time()
+        moved = self.db.archive(directory, int(time.time()) - days * 86400)
+        for year in sorted(moved):
+            print "%d: archived %d plays to %s" % (year, moved[year],
+                    os.path.join(directory, dbase.ARCHIVE % year))
+        print "Archived %d plays in %.1fs" % (sum(moved.values()),
+                time.time() - start)
+        self.db.close()
+
+    def snapshot(self, path=None):
+        """
+        Copy the database while it is in use.
+        """
+        path = path or self.snapshot_path
+        start = time.time()
+        if backup.snapshot(self.db.path, path):
+            print >> sys.stderr, "Snapshot written to %s in %.1fs" \
+                    % (path, time.time() - start)
+        else:
+            print >> sys.stderr, "%s is up to date" % path
+
+    def readPath(self):
+        """
+        The database stats and exports read: the live one, or with
+        --snapshot its snapshot, brought up to date.
+        """
+        if not self.read_snapshot:
+            return self.db.path
+        self.snapshot()
+        return self.snapshot_path
+
+    def receive(self, port=RECEIVE_PORT):
+        """
+        Record plays shipped by other mpsd instances into our database.
+        """
+        sink.serve(self.db.path, port, self.db.session_gap)
 
     def run(self):
         """
         Main application run in Daemon
         """
-        self.db.connect()
+        signal.signal(signal.SIGTERM, self.terminate)
+        self.profiler.install(signal.SIGUSR1)
+        self.writer.start()
+        if self.stats_output:
+            thread = threading.Thread(target=self.statsLoop,
+                    name='mpsd-stats')
+            thread.daemon = True
+            thread.start()
+        if self.api_port:
+            api.start(self.api_port, self.db.path,
+                    lambda: [t.nowPlaying() for t in self.trackers],
+                    API_CONNECTIONS)
+        if self.metrics_file:
+            thread = threading.Thread(target=self.metricsLoop,
+                    name='mpsd-metrics')
+            thread.daemon = True
+            thread.start()
 
-        while not self.mpd.connect():
-            print "Attempting reconnect"
-            time.sleep(self.poll_frequency)
-        print "Connected!"
         try:
-            self.eventLoop()
+            if len(self.trackers) == 1:
+                self.trackers[0].run()
+            else:
+                threads = []
+                for tracker in self.trackers:
+                    thread = threading.Thread(target=tracker.run,
+                            name=tracker.source)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                # signals are only delivered to the main thread
+                while True:
+                    time.sleep(60)
+                    for thread in threads:
+                        if not thread.is_alive():
+                            # as a single tracker stopping ends mpsd
+                            raise SystemExit("Tracker of %s stopped"
+                                    % thread.name)
+        except SystemExit:
+            raise
         except:
             log.error("%s" % (sys.exc_info()[1]))
             raise   # For now, re-raise this exception so mpsd quits
-        self.mpd.disconnect()
+        finally:
+            self.writer.stop()
+            log.info("Write queue: %s" % self.writer.stats())
 
 if __name__ == "__main__":
     action = None
+    action_args = []
 
     args = {}
 
@@ -288,18 +1005,22 @@ if __name__ == "__main__":
             args['fork'] = False
         elif arg == '-d' or arg == '--debug':
             args['log_level'] = logging.DEBUG
+        elif arg == '--snapshot':
+            args['snapshot'] = True
         elif arg == '--template':
             args['template'] = argv.next()
             if not args['template']:
                 print "No template file specified for --template."
                 exit(1)
-        elif arg in ('start', 'stop', 'restart', 'stats'):
+        elif arg in ACTIONS:
             if action:
                 usage()
                 print "\nError: Can only specify one of ",
-                print "start, stop, restart or stats."
+                print ", ".join(ACTIONS) + "."
                 exit(1)
             action = arg
+        elif action and not arg.startswith('-'):
+            action_args.append(arg)
         else:
             usage()
             print"\nInvalid argument '%s'." % arg
@@ -316,5 +1037,47 @@ if __name__ == "__main__":
     elif action == 'restart':
         mpsd.restart()
     elif action == 'stats':
+        if action_args:
+            mpsd.template = action_args[0]
         mpsd.generateStats()
+    elif action == 'build':
+        mpsd.build()
+    elif action == 'import':
+        if len(action_args) < 2:
+            usage()
+            print "\nError: import needs a format and a file."
+            exit(1)
+        mpsd.importPlays(action_args[0], action_args[1:])
+    elif action == 'export':
+        if len(action_args) not in (2, 3):
+            usage()
+            print "\nError: export needs a format and a file."
+            exit(1)
+        mpsd.exportPlays(*action_args)
+    elif action == 'rebuild':
+        mpsd.rebuildStats()
+    elif action == 'archive':
+        if action_args:
+            mpsd.archive(int(action_args[0]))
+        else:
+            mpsd.archive()
+    elif action == 'snapshot':
+        mpsd.snapshot(*action_args[:1])
+    elif action == 'merge':
+        if not action_args:
+            usage()
+            print "\nError: merge needs a database to merge."
+            exit(1)
+        mpsd.merge(action_args)
+    elif action == 'search':
+        if not action_args:
+            usage()
+            print "\nError: search needs a word to search for."
+            exit(1)
+        mpsd.searchNames(action_args)
+    elif action == 'receive':
+        if action_args:
+            mpsd.receive(int(action_args[0]))
+        else:
+            mpsd.receive()
 
@@ -0,0 +1,298 @@
+import os
+import re
+import time
+import logging
+
+import dbase
+import analytics
+
+log = logging.getLogger('mpsd')
+
+SQL = re.compile(r'<(sql|report)>(.*?)</\1>', re.DOTALL | re.IGNORECASE)
+WORD = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+# tables derived from play, see dbase.STATS and dbase.Session, and its
+# listened view
+DERIVED = re.compile(r'^(listened|all_plays|session|(%s)_(daily|total))$'
+        % '|'.join(key for key, value in dbase.STATS))
+
+def escape(value):
+    if value == None:
+        return u''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, type(u'')):
+        value = u'%s' % (value,)
+    return value.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+            .replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+
+class Query(object):
+    """
+    One <sql> block of a template and its last result.
+    """
+    def __init__(self, sql):
+        self.sql = sql.strip()
+        # compared against the database's tables once connected
+        self.words = set(word.lower() for word in WORD.findall(self.sql))
+        # date('now') and friends give a different answer every day
+        self.dated = 'now' in self.words
+        self.key = None
+        self.columns = None
+        self.rows = None
+        self.elapsed = 0.0
+        self.cached = False
+
+class Report(Query):
+    """
+    One <report> block of a template, naming one of analytics.REPORTS,
+    and its last result.
+    """
+    def __init__(self, name):
+        Query.__init__(self, name)
+        self.name = self.sql.lower()
+        # what analytics.Plays reads
+        self.words = set(['play', 'track', 'artist'])
+        # streaks and trends run up to today
+        self.dated = True
+
+class StatsRenderer(object):
+    """
+    Fills in the <sql> blocks of a stats template with HTML tables of
+    their results, and its <report> blocks with those of the reports in
+    analytics.
+
+    The template is parsed once (and again if the file changes), and the
+    queries run on a read-only connection that is kept open. Each result
+    is kept until one of the tables it reads has changed, going by the
+    change counts in the changes table, so after a play only the queries
+    reading play and its stats tables are run again. Queries reading
+    tables that are not counted are re-run whenever anything changed.
+    The plays the reports work on are refreshed at most once per render.
+
+    While it renders a template reading all_plays, the archives (see
+    MpsdDB.archive()) are attached and that temporary view has their
+    plays together with those of the play table.
+    """
+    def __init__(self, db_path, template):
+        self.db_path = db_path
+        self.template = template
+        self.mtime = None
+        self.parts = []     # template text and Query objects, in order
+        self.db = None
+        self.data_version = None
+        self.tables = None
+        self.attached = []  # schema names of the archives attached
+        self.counts = {}    # table -> change count when last read
+        self.runs = 0       # queries run, rather than served from cache
+        self.hits = 0
+        self.plays = None   # analytics.Plays, once a report needs them
+        self.plays_version = None
+
+    def load(self):
+        mtime = os.stat(self.template).st_mtime
+        if mtime == self.mtime:
+            return
+        f = open(self.template, 'rb')
+        try:
+            text = f.read().decode('utf-8')
+        finally:
+            f.close()
+        self.parts = []
+        pos = 0
+        for match in SQL.finditer(text):
+            self.parts.append(text[pos:match.start()])
+            if match.group(1).lower() == 'report':
+                self.parts.append(Report(match.group(2)))
+            else:
+                self.parts.append(Query(match.group(2)))
+            pos = match.end()
+        self.parts.append(text[pos:])
+        self.mtime = mtime
+        log.debug("Loaded %d queries from %s" % (len(self.queries()),
+                self.template))
+
+    def queries(self):
+        return [part for part in self.parts if isinstance(part, Query)]
+
+    def connect(self):
+        self.db = dbase.connect_readonly(self.db_path)
+        self.data_version = None
+        self.tables = None
+        self.attached = []
+        self.plays_version = None
+
+    def attach(self):
+        """
+        Attach every archive and create the all_plays view over them and
+        the play table. Attaching can't be done inside a transaction.
+        """
+        c = self.db.cursor()
+        try:
+            c.execute('''SELECT year, path, last FROM archive ORDER BY year''')
+            archives = c.fetchall()
+        except dbase.sqlite3.OperationalError:
+            # from before archiving
+            archives = []
+        selects = ['''SELECT date, source, track, listentime FROM main.play''']
+        for year, path, last in archives:
+            if not os.path.exists(path):
+                log.warning("Archive of %d is missing: %s" % (year, path))
+                continue
+            name = 'archive_%d' % year
+            # past the most databases sqlite attaches this fails, rather
+            # than all_plays leaving years out
+            c.execute('''ATTACH ? AS %s''' % name, [path])
+            self.attached.append(name)
+            # plays copied by an archive run cut short before it updated the
+            # archive table are still in the play table too
+            selects.append('''SELECT date, source, track, listentime \
+                    FROM %s.play WHERE date <= %d''' % (name, last or 0))
+        self.temp('''CREATE TEMP VIEW all_plays AS %s'''
+                % ' UNION ALL '.join(selects))
+
+    def detach(self):
+        self.temp('''DROP VIEW IF EXISTS temp.all_plays''')
+        for name in self.attached:
+            self.db.execute('''DETACH %s''' % name)
+        self.attached = []
+
+    def temp(self, sql):
+        """
+        Run sql, which only changes the temp schema. query_only (see
+        dbase.connect_readonly) refuses that too, so it is off meanwhile.
+        """
+        c = self.db.cursor()
+        c.execute('''PRAGMA query_only''')
+        query_only = c.fetchone()[0]
+        c.execute('''PRAGMA query_only = OFF''')
+        try:
+            c.execute(sql)
+        finally:
+            c.execute('''PRAGMA query_only = %s''' % ('ON' if query_only
+                    else 'OFF'))
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def refresh(self):
+        """
+        Read the change counts if the database changed since last time.
+        Returns the data_version, which changes with every commit made by
+        another connection.
+        """
+        c = self.db.cursor()
+        c.execute('''PRAGMA data_version''')
+        version = c.fetchone()[0]
+        if version == self.data_version:
+            return version
+        c.execute('''SELECT name FROM sqlite_master \
+                WHERE type IN ('table', 'view')''')
+        self.tables = set(row[0].lower() for row in c.fetchall())
+        # there whenever a query reads it, see attach()
+        self.tables.add('all_plays')
+        self.counts = {}
+        if 'changes' in self.tables:
+            c.execute('''SELECT name, count FROM changes''')
+            self.counts = dict(c.fetchall())
+        self.data_version = version
+        return version
+
+    def cacheKey(self, query):
+        """
+        What query's result depends on: the change counts of the tables
+        it reads, or the data_version if it reads any that aren't counted.
+        """
+        key = []
+        tables = set('play' if DERIVED.match(table) else table
+                for table in query.words & self.tables)
+        for table in sorted(tables):
+            if table not in self.counts:
+                key = [('data_version', self.data_version)]
+                break
+            key.append((table, self.counts[table]))
+        if query.dated:
+            key.append(('day', time.strftime('%Y-%m-%d')))
+        return tuple(key)
+
+    def run(self, query):
+        key = self.cacheKey(query)
+        if key == query.key:
+            query.cached = True
+            self.hits += 1
+            return
+        start = time.time()
+        if isinstance(query, Report):
+            query.columns, query.rows = self.report(query)
+        else:
+            c = self.db.cursor()
+            c.execute(query.sql)
+            query.columns = [d[0] for d in c.description or ()]
+            query.rows = c.fetchall()
+        query.elapsed = time.time() - start
+        query.key = key
+        query.cached = False
+        self.runs += 1
+
+    def report(self, query):
+        if analytics.numpy == None:
+            return [u'Report'], [[u'The %s report needs numpy' % query.name]]
+        if query.name not in analytics.REPORTS:
+            return [u'Report'], [[u'There is no %s report' % query.name]]
+        if self.plays == None:
+            self.plays = analytics.Plays(self.db_path)
+        if self.plays_version != self.data_version:
+            self.plays.refresh()
+            self.plays_version = self.data_version
+        return analytics.REPORTS[query.name](self.plays)
+
+    def table(self, query):
+        out = [u'<table>\n<tr>']
+        out.extend(u'<th>%s</th>' % escape(col) for col in query.columns)
+        out.append(u'</tr>\n')
+        for row in query.rows:
+            out.append(u'<tr>')
+            out.extend(u'<td>%s</td>' % escape(value) for value in row)
+            out.append(u'</tr>\n')
+        out.append(u'</table>\n<p class="query-time">%.1f ms%s</p>'
+                % (query.elapsed * 1000, u', cached' if query.cached else u''))
+        return u''.join(out)
+
+    def render(self):
+        """
+        Returns the filled in template.
+        """
+        self.load()
+        if not self.db:
+            self.connect()
+        archived = any('all_plays' in query.words
+                for query in self.queries())
+        try:
+            if archived:
+                self.attach()
+            # every query sees the same snapshot of the database
+            self.db.execute('''BEGIN''')
+            try:
+                self.refresh()
+                for query in self.queries():
+                    self.run(query)
+            finally:
+                self.db.execute('''COMMIT''')
+        finally:
+            if archived:
+                self.detach()
+        return u''.join(part if not isinstance(part, Query)
+                else self.table(part) for part in self.parts)
+
+    def write(self, path):
+        """
+        Render to path, replacing it only once the new page is complete.
+        """
+        html = self.render()
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(html.encode('utf-8'))
+        finally:
+            f.close()
+        os.rename(tmp, path)
@@ -0,0 +1,671 @@
+#!/usr/bin/env python2
+"""
+Replays a trace of listening against the tracker, through a fake mpd
+server and on a virtual clock, and checks what it recorded against what
+was actually played.
+
+    python2 replay.py [--trace FILE | --hours N] [--seed N]
+                      [--mode idle,poll] [--poll-frequency 1,5]
+                      [--threshold F] [--save-trace FILE] [--out FILE]
+
+Days of listening replay in seconds: whenever the tracker sleeps or
+waits for mpd, the clock jumps ahead to when it would wake up. The
+results have, for each tracking mode and poll frequency, the plays and
+listen time recorded against the ground truth, and the tracker's cost
+per simulated hour: CPU time, mpd commands, round trips and wakeups.
+
+A trace is a text file of songs and timed player events:
+
+    song LENGTH TITLE           a playlist entry, in playlist order
+    TIME play [POS]             play playlist entry POS from the start,
+                                or resume playing
+    TIME pause
+    TIME seek SECONDS           jump to SECONDS into the current song
+    TIME stop
+    TIME disconnect SECONDS     mpd unreachable for SECONDS, playing on
+    TIME end                    the end of the trace
+
+TIME is seconds from the start of the trace. Songs play through to the
+next playlist entry like they do in mpd, and playback stops after the
+last one.
+"""
+import os
+import sys
+import json
+import time
+import random
+import select
+import socket
+import logging
+import argparse
+import resource
+import threading
+
+import mpsd
+
+log = logging.getLogger('mpsd')
+
+# when the virtual clock starts, so dates look like real ones
+EPOCH = 1500000000.0
+# real seconds to wait for the other side of a socket before giving up
+REAL_TIMEOUT = 5
+# the shortest a sleep or select takes on the virtual clock; a wait never
+# returns without time having passed, which tiny timeouts lost to float
+# rounding would otherwise do
+MIN_WAIT = 0.001
+
+class StopReplay(Exception):
+    """
+    Raised in the tracker when the clock reaches the end of the trace.
+    """
+
+def read_trace(path):
+    """
+    Returns (songs, events, end) of a trace file.
+    """
+    songs, events, end = [], [], 0
+    f = open(path)
+    try:
+        for number, line in enumerate(f):
+            fields = line.split(None, 2)
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                if fields[0] == 'song':
+                    songs.append({'time': int(fields[1]),
+                        'title': fields[2].strip()})
+                elif fields[1] == 'end':
+                    end = float(fields[0])
+                else:
+                    arg = float(fields[2]) if len(fields) > 2 else None
+                    events.append((float(fields[0]), fields[1], arg))
+            except (IndexError, ValueError):
+                raise ValueError("%s:%d: bad line %r"
+                        % (path, number + 1, line))
+    finally:
+        f.close()
+    events.sort(key=lambda event: event[0])
+    return songs, events, end or (events[-1][0] if events else 0)
+
+def write_trace(path, songs, events, end):
+    f = open(path, 'w')
+    try:
+        for song in songs:
+            f.write("song %d %s\n" % (song['time'], song['title']))
+        for when, action, arg in events:
+            if arg == None:
+                f.write("%.1f %s\n" % (when, action))
+            else:
+                f.write("%.1f %s %g\n" % (when, action, arg))
+        f.write("%.1f end\n" % end)
+    finally:
+        f.close()
+
+def generate_trace(hours, rand):
+    """
+    A trace of sessions of a few hours listening through a playlist of
+    albums, skipping, pausing and seeking now and then, with mpd going
+    away about once a day.
+    """
+    songs = []
+    for album in range(1, 41):
+        for num in range(1, rand.randint(8, 14) + 1):
+            songs.append({'time': rand.randint(90, 480),
+                'title': 'Album %d - Track %d' % (album, num)})
+    events = []
+    now = 0.0
+    end = hours * 3600.0
+    while now < end:
+        # a listening session
+        pos = rand.randrange(len(songs))
+        events.append((now, 'play', pos))
+        stop = now + rand.uniform(0.5, 4) * 3600
+        while now < stop and pos < len(songs):
+            length = songs[pos]['time']
+            dice = rand.random()
+            if dice < 0.15:
+                # skip to another song part way in
+                now += rand.uniform(1, length)
+                pos = rand.randrange(len(songs))
+                events.append((now, 'play', pos))
+                continue
+            elif dice < 0.18:
+                paused = rand.uniform(1, length * 0.9)
+                events.append((now + paused, 'pause', None))
+                now += paused + rand.uniform(10, 1800)
+                events.append((now, 'play', None))
+                now += length - paused
+            elif dice < 0.21:
+                at = rand.uniform(1, length * 0.5)
+                to = rand.uniform(0, length * 0.95)
+                events.append((now + at, 'seek', to))
+                now += at + length - to
+            else:
+                now += length
+            if rand.random() < 0.02:
+                events.append((now - rand.uniform(0, length), 'disconnect',
+                    rand.uniform(5, 600)))
+            pos += 1
+        events.append((now + rand.uniform(0, 60), 'stop', None))
+        now += rand.uniform(1, 16) * 3600
+    events = [event for event in events if event[0] < end]
+    events.sort(key=lambda event: event[0])
+    return songs, events, end
+
+class Occurrence(object):
+    """
+    A playlist entry from when it became the current song until another
+    one did, and how long it really played. The ground truth.
+    """
+    def __init__(self, pos, song, start):
+        self.pos = pos
+        self.song = song
+        self.start = start
+        self.end = None
+        self.listened = 0.0
+
+class Connection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.idling = False
+        self.pending = set()    # subsystems changed since the last idle
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            try:
+                self.sock.sendall(text.encode('utf-8'))
+            except socket.error:
+                pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def serve(self):
+        self.write(u"OK MPD 0.21.0\n")
+        f = self.sock.makefile('rb')
+        command_list = None
+        try:
+            for line in f:
+                line = line.decode('utf-8').rstrip('\n')
+                command = line.split(' ', 1)[0]
+                if command in ('command_list_begin', 'command_list_ok_begin'):
+                    command_list = (command, [])
+                    continue
+                if command_list and command != 'command_list_end':
+                    command_list[1].append(line)
+                    continue
+                if command == 'command_list_end':
+                    self.server.requests += 1
+                    ok, lines = command_list
+                    command_list = None
+                    out = []
+                    for line in lines:
+                        reply = self.server.command(self, line)
+                        if reply.startswith(u'ACK'):
+                            out.append(reply)
+                            break
+                        out.append(reply)
+                        if ok == 'command_list_ok_begin':
+                            out.append(u"list_OK\n")
+                    else:
+                        out.append(u"OK\n")
+                    self.write(u''.join(out))
+                    continue
+                if command == 'close':
+                    break
+                self.server.requests += 1
+                reply = self.server.command(self, line)
+                if reply != None:
+                    self.write(reply + u"OK\n"
+                            if not reply.startswith(u'ACK') else reply)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            self.server.dropped(self)
+            self.close()
+
+class FakeMPD(object):
+    """
+    Enough of an mpd server for the tracker, playing a trace on a virtual
+    clock. The clock only moves in advance(), which the tracker calls
+    through VirtualTime and VirtualSelect whenever it would wait.
+    """
+    def __init__(self, songs, events, end, port=0):
+        self.songs = songs
+        self.events = list(events)
+        self.end = end
+        self.now = 0.0
+        self.state = 'stop'
+        self.pos = 0
+        self.offset = 0.0       # position in the song at self.since
+        self.since = 0.0
+        self.down_until = -1
+        self.occurrences = []
+        self.connections = []
+        self.lock = threading.RLock()
+        self.commands = 0
+        self.requests = 0       # round trips, a command list being one
+        self.connects = 0
+        self.idled = threading.Event()
+        self.idle_answered = False
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.acceptLoop, name='fake-mpd')
+        thread.daemon = True
+        thread.start()
+
+    def acceptLoop(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.connects += 1
+                if self.now < self.down_until:
+                    sock.close()
+                    continue
+                conn = Connection(self, sock)
+                self.connections.append(conn)
+            thread = threading.Thread(target=conn.serve, name='fake-mpd-conn')
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.listener.close()
+        with self.lock:
+            for conn in list(self.connections):
+                conn.close()
+
+    def dropped(self, conn):
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+
+    # the player
+
+    def position(self):
+        if self.state == 'play':
+            return self.offset + self.now - self.since
+        return self.offset
+
+    def startSong(self, pos):
+        self.endSong()
+        self.pos = pos
+        self.offset = 0.0
+        self.occurrences.append(Occurrence(pos, self.songs[pos], self.now))
+
+    def endSong(self):
+        if self.occurrences and self.occurrences[-1].end == None:
+            self.occurrences[-1].end = self.now
+
+    def songEnd(self):
+        """
+        When the current song will finish playing, None if it isn't.
+        """
+        if self.state != 'play':
+            return None
+        return self.since + self.songs[self.pos]['time'] - self.offset
+
+    def apply(self, action, arg):
+        if self.state == 'play' and self.occurrences:
+            self.occurrences[-1].listened += self.now - self.since
+        self.offset = self.position()
+        self.since = self.now
+        if action == 'play':
+            if arg != None:
+                self.startSong(int(arg))
+            elif self.state == 'stop':
+                self.startSong(self.pos)
+            self.state = 'play'
+        elif action == 'pause':
+            if self.state == 'play':
+                self.state = 'pause'
+        elif action == 'seek':
+            if self.state != 'stop':
+                self.offset = min(arg, self.songs[self.pos]['time'])
+        elif action == 'next' and self.pos + 1 < len(self.songs):
+            self.startSong(self.pos + 1)
+        elif action in ('stop', 'next'):
+            self.endSong()
+            self.state = 'stop'
+            self.offset = 0.0
+
+    def disconnect(self, seconds):
+        """
+        Drop every client and refuse new ones for seconds. Returns whether
+        one of them was idling, it will notice straight away.
+        """
+        self.down_until = self.now + seconds
+        idling = any(conn.idling for conn in self.connections)
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+        return idling
+
+    def changed(self):
+        """
+        Tell idling clients the player changed. Returns True if any were.
+        """
+        notified = False
+        for conn in self.connections:
+            if conn.idling:
+                conn.idling = False
+                conn.write(u"changed: player\nOK\n")
+                notified = True
+            else:
+                conn.pending.add('player')
+        return notified
+
+    def advance(self, until, wake=False):
+        """
+        Play the trace up to until, or if wake is set only until an idling
+        client is told about a change. Returns whether one was.
+        """
+        with self.lock:
+            while True:
+                nexts = []
+                if self.events:
+                    nexts.append((self.events[0][0], 0))
+                end = self.songEnd()
+                if end != None:
+                    nexts.append((end, 1))
+                if not nexts or min(nexts)[0] > until:
+                    if until > self.end:
+                        self.now = self.end
+                        self.apply('end', None)
+                        raise StopReplay()
+                    self.now = max(self.now, until)
+                    return False
+                when, kind = min(nexts)
+                self.now = max(self.now, when)
+                if kind == 0:
+                    when, action, arg = self.events.pop(0)
+                else:
+                    action, arg = 'next', None
+                if action == 'disconnect':
+                    woken = self.disconnect(arg)
+                else:
+                    self.apply(action, arg)
+                    woken = self.changed()
+                if woken and wake:
+                    return True
+
+    # the protocol
+
+    def command(self, conn, line):
+        with self.lock:
+            self.commands += 1
+            fields = line.split(' ', 1)
+            name = fields[0]
+            if name == 'status':
+                return self.status()
+            if name == 'currentsong':
+                return self.currentSong()
+            if name == 'idle':
+                if conn.pending:
+                    reply = u''.join(u"changed: %s\n" % s
+                            for s in sorted(conn.pending))
+                    conn.pending.clear()
+                    self.idle_answered = True
+                    self.idled.set()
+                    return reply
+                conn.idling = True
+                self.idle_answered = False
+                self.idled.set()
+                return None
+            if name == 'noidle':
+                if conn.idling:
+                    conn.idling = False
+                    return u''
+                return None
+            if name in ('ping', 'password'):
+                return u''
+            if name == 'commands':
+                return u''.join(u"command: %s\n" % c for c in ('close',
+                    'command_list_begin', 'command_list_ok_begin',
+                    'commands', 'currentsong', 'idle', 'noidle', 'password',
+                    'ping', 'status'))
+            return u"ACK [5@0] {%s} unknown command \"%s\"\n" % (name, name)
+
+    def status(self):
+        lines = [u"volume: 100", u"repeat: 0", u"random: 0", u"single: 0",
+            u"consume: 0", u"playlist: 2",
+            u"playlistlength: %d" % len(self.songs),
+            u"state: %s" % self.state]
+        if self.state != 'stop' or self.occurrences:
+            lines += [u"song: %d" % self.pos, u"songid: %d" % (self.pos + 1)]
+        if self.state != 'stop':
+            length = self.songs[self.pos]['time']
+            position = self.position()
+            lines += [u"time: %d:%d" % (position, length),
+                u"elapsed: %.3f" % position, u"duration: %.3f" % length,
+                u"bitrate: 320", u"audio: 44100:24:2"]
+        return u''.join(line + u"\n" for line in lines)
+
+    def currentSong(self):
+        if self.state == 'stop' and not self.occurrences:
+            return u''
+        song = self.songs[self.pos]
+        artist, title = song['title'].split(' - ', 1) \
+                if ' - ' in song['title'] else (u'Artist', song['title'])
+        return (u"file: music/%d.flac\nArtist: %s\nTitle: %s\nAlbum: %s\n"
+                u"Time: %d\nDuration: %d.000\nPos: %d\nId: %d\n"
+                % (self.pos, artist, title, artist, song['time'],
+                    song['time'], self.pos, self.pos + 1))
+
+class VirtualTime(object):
+    """
+    Stands in for the time module in mpsd, sleeping on the virtual clock.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.waits = 0
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return EPOCH + self.server.now
+
+    def monotonic(self):
+        return self.server.now
+
+    def sleep(self, seconds):
+        self.waits += 1
+        self.server.advance(self.server.now + max(seconds, MIN_WAIT))
+
+    def localtime(self, secs=None):
+        return time.localtime(self.time() if secs == None else secs)
+
+    def strftime(self, format, t=None):
+        return time.strftime(format, t or self.localtime())
+
+class VirtualSelect(object):
+    """
+    Stands in for the select module in mpsd. mpsd only selects on its mpd
+    connection while idling, so a select waits on the virtual clock for
+    the server to report a change, then on the socket for the report.
+    """
+    error = select.error
+
+    def __init__(self, server, clock):
+        self.server = server
+        self.clock = clock
+
+    def select(self, r, w, x, timeout=None):
+        self.clock.waits += 1
+        if not self.server.idled.wait(REAL_TIMEOUT):
+            raise StopReplay("the tracker did not send idle")
+        self.server.idled.clear()
+        if not self.server.idle_answered:
+            until = float('inf') if timeout == None \
+                    else self.server.now + max(timeout, MIN_WAIT)
+            if not self.server.advance(until, wake=True):
+                return [], [], []
+        return select.select(r, w, x, REAL_TIMEOUT)
+
+class Recorder(object):
+    """
+    Stands in for the DBWriter, keeping what the tracker records.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.plays = []
+        self.dates = {}
+
+    def play(self, song, source):
+        date = self.clock.time()
+        play = {'file': song.get('file'), 'date': date - EPOCH,
+            'listentime': None}
+        self.plays.append(play)
+        self.dates[date] = play
+        return date
+
+    def listentime(self, total, date, source, stopped=False):
+        if date in self.dates:
+            self.dates[date]['listentime'] = total
+
+def thread_cpu():
+    """
+    CPU seconds used by the calling thread, or the process where that
+    can't be told apart.
+    """
+    # RUSAGE_THREAD is 1 on Linux, the constant is missing before 3.2
+    who = getattr(resource, 'RUSAGE_THREAD',
+            1 if sys.platform.startswith('linux') else resource.RUSAGE_SELF)
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def score(occurrences, plays, threshold):
+    """
+    Compare recorded plays with the occurrences that should have been
+    recorded: those played for threshold of their length.
+    """
+    expected = [o for o in occurrences
+            if o.listened >= threshold * o.song['time']]
+    unmatched = list(plays)
+    matched, missed, errors = 0, 0, []
+    for o in expected:
+        end = o.end if o.end != None else float('inf')
+        for play in unmatched:
+            if play['file'] == u"music/%d.flac" % o.pos \
+                    and o.start <= play['date'] <= end:
+                unmatched.remove(play)
+                matched += 1
+                if play['listentime'] != None:
+                    errors.append(play['listentime'] - o.listened)
+                break
+        else:
+            missed += 1
+    errors.sort()
+    return {
+        'expected_plays': len(expected),
+        'recorded_plays': len(plays),
+        'matched_plays': matched,
+        'missed_plays': missed,
+        'extra_plays': len(unmatched),
+        'listentime_true_s': int(sum(o.listened for o in occurrences)),
+        'listentime_recorded_s': sum(p['listentime'] or 0 for p in plays),
+        'listentime_mean_abs_error_s': round(sum(abs(e) for e in errors)
+            / len(errors), 2) if errors else None,
+        'listentime_max_error_s': round(max(errors, key=abs), 2)
+            if errors else None,
+    }
+
+def replay(songs, events, end, mode, poll_frequency, threshold):
+    """
+    Run a Tracker against the trace, returns its results.
+    """
+    server = FakeMPD(songs, events, end)
+    clock = VirtualTime(server)
+    recorder = Recorder(clock)
+    saved = mpsd.time, mpsd.monotonic, mpsd.select, sys.stdout
+    mpsd.time = clock
+    mpsd.monotonic = clock.monotonic
+    mpsd.select = VirtualSelect(server, clock)
+    # the tracker prints every play
+    sys.stdout = open(os.devnull, 'w')
+    tracker = mpsd.Tracker(mpsd.MPD('127.0.0.1', server.port, None),
+            recorder, poll_frequency=poll_frequency,
+            add_threshold=threshold, tracking_mode=mode)
+    start = time.time()
+    cpu = thread_cpu()
+    try:
+        tracker.run()
+    except StopReplay:
+        pass
+    finally:
+        cpu = thread_cpu() - cpu
+        sys.stdout.close()
+        mpsd.time, mpsd.monotonic, mpsd.select, sys.stdout = saved
+        server.close()
+
+    hours = end / 3600.0
+    results = {'mode': mode, 'poll_frequency': poll_frequency,
+        'threshold': threshold, 'simulated_hours': round(hours, 1),
+        'real_s': round(time.time() - start, 2),
+        'cpu_ms_per_hour': round(cpu * 1000 / hours, 2),
+        'commands_per_hour': round(server.commands / hours, 1),
+        'round_trips_per_hour': round(server.requests / hours, 1),
+        'wakeups_per_hour': round(clock.waits / hours, 1),
+        'connects': server.connects}
+    # each round trip is at least a send and a receive
+    results['syscalls_per_hour_est'] = round((2 * server.requests
+        + clock.waits + 4 * server.connects) / hours, 1)
+    results.update(score(server.occurrences, recorder.plays, threshold))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--trace', help="a trace file to replay")
+    parser.add_argument('--hours', type=float, default=48,
+            help="length of the generated trace without --trace")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mode', default='idle,poll',
+            help="tracking modes to replay, comma separated")
+    parser.add_argument('--poll-frequency', default='1',
+            help="poll frequencies to replay, comma separated")
+    parser.add_argument('--threshold', type=float,
+            default=mpsd.ADD_THRESHOLD)
+    parser.add_argument('--save-trace', help="write the trace used here")
+    parser.add_argument('--out', default='replay.json')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+            else logging.CRITICAL)
+    if args.trace:
+        songs, events, end = read_trace(args.trace)
+    else:
+        songs, events, end = generate_trace(args.hours,
+                random.Random(args.seed))
+    if args.save_trace:
+        write_trace(args.save_trace, songs, events, end)
+
+    runs = []
+    for mode in args.mode.split(','):
+        for frequency in args.poll_frequency.split(','):
+            result = replay(songs, events, end, mode, float(frequency),
+                    args.threshold)
+            runs.append(result)
+            sys.stderr.write("%s\n" % json.dumps(result, sort_keys=True))
+    f = open(args.out, 'w')
+    try:
+        json.dump(runs, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import re
+import logging
+
+import dbase
+
+log = logging.getLogger('mpsd')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# What is shown of each of the dbase.SEARCHED tables, found as "found"
+SHOWN = {
+    'artist': ('''SELECT artist.id AS id, artist.name AS name''',
+        ''''''),
+    'album': ('''SELECT album.id AS id, album.title AS title, \
+            artist.name AS artist, album.date AS date''',
+        '''LEFT JOIN artist ON (artist.id = album.artist)'''),
+    'track': ('''SELECT track.id AS id, track.title AS title, \
+            artist.name AS artist, album.title AS album''',
+        '''LEFT JOIN artist ON (artist.id = track.artist) \
+            LEFT JOIN album ON (album.id = track.album)'''),
+}
+
+# The matches of a search in one of the SEARCHED tables, with their play
+# counts and listen times (see dbase.STATS) and the last day they were
+# played, the most played first. Only the rows shown are looked up.
+FOUND = '''%(columns)s, found.plays AS plays, \
+            found.listentime AS listentime, \
+            (SELECT max(day) FROM %(table)s_daily \
+                WHERE %(table)s = found.id) AS last_played \
+        FROM (SELECT matched.id AS id, coalesce(total.plays, 0) AS plays, \
+                coalesce(total.listentime, 0) AS listentime \
+            FROM (%(matches)s) AS matched \
+            LEFT JOIN %(table)s_total AS total \
+                ON (total.%(table)s = matched.id) \
+            ORDER BY 2 DESC, 1 LIMIT ?) AS found \
+        JOIN %(table)s ON (%(table)s.id = found.id) %(joins)s \
+        ORDER BY found.plays DESC, found.id'''
+
+# The ids of the rows matching, from the full-text index. Its rank (bm25)
+# isn't used, working it out for every match costs more than the rest.
+MATCHES = '''SELECT rowid AS id FROM %(table)s_search \
+        WHERE %(table)s_search MATCH ?'''
+
+# without one, every row is read
+SCAN = '''SELECT id FROM %(table)s WHERE %(where)s'''
+
+def indexed(c):
+    c.execute('''SELECT count(*) FROM sqlite_master WHERE name IN (%s)'''
+            % ','.join('?' * len(dbase.SEARCHED)),
+            ['%s_search' % table for table, column in dbase.SEARCHED])
+    return c.fetchone()[0] == len(dbase.SEARCHED)
+
+def search(c, text, limit=10):
+    """
+    The artists, albums and tracks (as {table: [row dicts]}) whose names
+    have words starting with each of the words of text, up to limit of
+    each, the most played first.
+    """
+    terms = WORD.findall(text)
+    if not terms:
+        return dict((table, []) for table, column in dbase.SEARCHED)
+    fts = indexed(c)
+    if fts:
+        # quoted, so words like "and" or "near" aren't operators
+        args = [u' '.join(u'"%s"*' % term for term in terms)]
+    else:
+        args = [u'%%%s%%' % term for term in terms]
+    found = {}
+    for table, column in dbase.SEARCHED:
+        if fts:
+            matches = MATCHES % {'table': table}
+        else:
+            matches = SCAN % {'table': table, 'where': ' AND '.join(
+                '''%s LIKE ?''' % column for term in terms)}
+        columns, joins = SHOWN[table]
+        c.execute(FOUND % {'table': table, 'columns': columns,
+            'joins': joins, 'matches': matches}, args + [limit])
+        names = [d[0] for d in c.description]
+        found[table] = [dict(zip(names, row)) for row in c.fetchall()]
+    return found
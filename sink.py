@@ -0,0 +1,351 @@
+import os
+import sys
+import time
+import json
+import gzip
+import socket
+import threading
+import logging
+from io import BytesIO
+try:
+    from urllib2 import urlopen, Request, URLError
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import dbase
+
+log = logging.getLogger('mpsd')
+
+# time.monotonic is not available before python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
+
+def compress(data):
+    buf = BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=BytesIO(data), mode='rb').read()
+
+class Spool(object):
+    """
+    An append-only file of events, one JSON object per line, each with a
+    sequence number. How far it has been shipped is kept in a file next
+    to it, so shipping picks up where it left off after a restart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.lock = threading.Lock()
+        self.file = None
+        self.seq = 0            # sequence number of the last event appended
+        self.shipped = 0        # byte offset up to which events are shipped
+        self.shipped_seq = 0    # sequence number of the last shipped event
+        self.unsynced = 0       # events appended since the last fsync
+
+    def open(self):
+        try:
+            f = open(self.offset_path)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            self.shipped, self.shipped_seq = state['offset'], state['seq']
+        except (IOError, OSError, ValueError, KeyError):
+            self.shipped, self.shipped_seq = 0, 0
+
+        self.file = open(self.path, 'ab')
+        size = os.path.getsize(self.path)
+        if self.shipped > size:
+            self.shipped = 0
+        # sequence numbers the server has seen are never given out again
+        self.seq = self.shipped_seq
+        end = self.shipped
+        for event, end in self.read(self.shipped):
+            if event['seq'] <= self.shipped_seq:
+                # shipped, but the spool wasn't emptied after saying so
+                self.shipped = end
+            self.seq = max(self.seq, event['seq'])
+        if end < size:
+            log.warning("Dropping incomplete event at the end of %s"
+                    % self.path)
+            self.file.truncate(end)
+        log.debug("Spool %s: %d events unshipped"
+                % (self.path, self.seq - self.shipped_seq))
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def append(self, event):
+        """
+        Append event, giving it the next sequence number.
+        """
+        with self.lock:
+            self.seq += 1
+            event['seq'] = self.seq
+            self.file.write((json.dumps(event) + '\n').encode('utf-8'))
+            self.file.flush()
+            self.unsynced += 1
+
+    def sync(self):
+        """
+        Make sure everything appended so far is on disk.
+        """
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def read(self, offset, limit=None):
+        """
+        Yield (event, offset after it) for up to limit events from offset.
+        """
+        count = 0
+        f = open(self.path, 'rb')
+        try:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n') or count == limit:
+                    break
+                offset += len(line)
+                count += 1
+                yield json.loads(line.decode('utf-8')), offset
+        finally:
+            f.close()
+
+    def markShipped(self, offset, seq):
+        """
+        Record that the events up to offset have been shipped, emptying
+        the spool once everything in it has been.
+        """
+        with self.lock:
+            # The offset goes to disk before the spool is emptied: a crash
+            # in between leaves shipped events in the spool, which open()
+            # skips by their sequence numbers, rather than an offset past
+            # the end of an empty spool and a sequence number gone back.
+            empty = seq == self.seq
+            if empty:
+                offset = 0
+            tmp = self.offset_path + '.tmp'
+            f = open(tmp, 'w')
+            try:
+                json.dump({'offset': offset, 'seq': seq}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp, self.offset_path)
+            if empty:
+                self.file.truncate(0)
+            self.shipped, self.shipped_seq = offset, seq
+
+class RemoteSink(object):
+    """
+    Sends plays and listen times to a central mpsd (see Receiver). It is
+    written to like a MpsdDB: events are appended to a local spool, which
+    is synced like a group commit, and shipped from a separate thread in
+    gzipped batches. Events survive the server being unreachable and mpsd
+    restarts, and carry sequence numbers so the server can skip any it
+    already has after a batch is sent twice.
+    """
+    def __init__(self, spool_path, url, source=None, batch_size=1000,
+            commit_interval=0, commit_events=1, retry_max=300):
+        self.spool = Spool(spool_path)
+        self.url = url
+        self.source = source or socket.gethostname()
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.commit_events = commit_events
+        # longest wait between attempts to reach the server
+        self.retry_max = retry_max
+        self.batch_start = None
+        self.wake = threading.Event()
+        self.stopping = False
+        self.shipper = threading.Thread(target=self.shipLoop,
+                name='mpsd-shipper')
+        self.shipper.daemon = True
+
+    def connect(self, warm_cache=False):
+        self.spool.open()
+        self.shipper.start()
+
+    def update(self, track, date=None, source=None):
+        date = date or int(time.time())
+        self.spool.append({'type': 'play', 'date': date, 'song': track,
+                'source': source})
+        self.written()
+        return date
+
+    def updateListentime(self, total, date, source=None, stopped=False):
+        self.spool.append({'type': 'listentime', 'total': total,
+                'date': date, 'source': source, 'stopped': stopped})
+        self.written()
+
+    def written(self):
+        if self.spool.unsynced == 1:
+            self.batch_start = monotonic()
+        if self.spool.unsynced >= self.commit_events \
+                or monotonic() - self.batch_start >= self.commit_interval:
+            self.flush()
+
+    def commitTimeout(self):
+        if not self.spool.unsynced:
+            return None
+        return max(self.batch_start + self.commit_interval - monotonic(), 0)
+
+    def commitIfDue(self):
+        if self.spool.unsynced and self.commitTimeout() == 0:
+            self.flush()
+
+    def flush(self):
+        self.spool.sync()
+        self.wake.set()
+
+    def close(self):
+        """
+        Sync the spool and stop shipping, after one last attempt.
+        """
+        self.stopping = True
+        self.flush()
+        self.shipper.join()
+        self.spool.close()
+
+    def ship(self):
+        """
+        Send one batch of unshipped events. Returns how many were sent.
+        """
+        events = []
+        for event, end in self.spool.read(self.spool.shipped,
+                self.batch_size):
+            events.append(event)
+        if not events:
+            return 0
+        body = compress(json.dumps({'source': self.source,
+                'events': events}).encode('utf-8'))
+        request = Request(self.url, body, {'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip'})
+        urlopen(request, timeout=30).read()
+        self.spool.markShipped(end, events[-1]['seq'])
+        log.debug("Shipped %d events to %s" % (len(events), self.url))
+        return len(events)
+
+    def shipLoop(self):
+        delay = 1
+        while True:
+            self.wake.clear()
+            try:
+                sent = self.ship()
+            except (URLError, IOError, socket.error):
+                if self.stopping:
+                    break
+                log.warning("Could not ship to %s: %s, retrying in %ds"
+                        % (self.url, sys.exc_info()[1], delay))
+                self.wake.wait(delay)
+                delay = min(delay * 2, self.retry_max)
+                continue
+            delay = 1
+            if self.stopping:
+                break
+            if sent < self.batch_size:
+                self.wake.wait(self.retry_max)
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = decompress(body)
+            batch = json.loads(body.decode('utf-8'))
+            applied = self.server.apply(batch['source'], batch['events'])
+        except (ValueError, KeyError, TypeError, IOError):
+            self.send_error(400, str(sys.exc_info()[1]))
+            return
+        except dbase.sqlite3.Error:
+            log.error("Could not apply batch: %s" % (sys.exc_info()[1]))
+            self.send_error(503, "Database error")
+            return
+        reply = json.dumps({'applied': applied}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        log.debug("%s %s" % (self.address_string(), format % args))
+
+class Receiver(HTTPServer):
+    """
+    Records the events shipped by RemoteSinks in a MpsdDB. Each batch is
+    applied in a single transaction together with the last sequence
+    number received from its source, so replayed events are skipped.
+    """
+    def __init__(self, address, db):
+        HTTPServer.__init__(self, address, ReceiverHandler)
+        self.db = db
+        self.lock = threading.Lock()
+
+    def applyEvent(self, source, event):
+        # plays are tagged with the sending host and its mpd server
+        tag = source
+        if event.get('source'):
+            tag = "%s/%s" % (source, event['source'])
+        try:
+            if event['type'] == 'play':
+                self.db.update(event['song'], event['date'], tag)
+            elif event['type'] == 'listentime':
+                # sent without stopped by older versions
+                self.db.updateListentime(event['total'], event['date'], tag,
+                        event.get('stopped', False))
+        except dbase.sqlite3.IntegrityError:
+            log.debug("Already have play at %s from %s"
+                    % (event['date'], source))
+        except (KeyError, ValueError, TypeError):
+            # retrying would not help, so skip it
+            log.error("Skipping bad event %d from %s: %s"
+                    % (event['seq'], source, sys.exc_info()[1]))
+
+    def apply(self, source, events):
+        with self.lock:
+            c = self.db.db.cursor()
+            c.execute('''SELECT seq FROM received WHERE source=?''', [source])
+            row = c.fetchone()
+            last = row[0] if row else 0
+            applied = 0
+            self.db.begin()
+            try:
+                for event in events:
+                    if event['seq'] <= last:
+                        continue
+                    self.applyEvent(source, event)
+                    last = event['seq']
+                    applied += 1
+                c.execute('''INSERT OR REPLACE INTO received VALUES (?, ?)''',
+                        (source, last))
+            except dbase.sqlite3.Error:
+                self.db.rollback()
+                raise
+            self.db.flush()
+            log.info("Received %d events from %s" % (applied, source))
+            return applied
+
+def serve(path, port, session_gap=dbase.SESSION_GAP):
+    """
+    Receive events from remote mpsd instances into the database at path.
+    """
+    # batches are committed by Receiver.apply
+    db = dbase.MpsdDB(path, commit_interval=sys.maxsize,
+            commit_events=sys.maxsize, session_gap=session_gap)
+    db.connect()
+    server = Receiver(('', port), db)
+    log.info("Receiving on port %d" % port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        db.close()
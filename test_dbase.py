@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Checks of the database layer on small throwaway databases.
+
+    python -m unittest test_dbase
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import dbase
+
+def song(file, title, album, artist, date='2001', **tags):
+    """
+    A song as mpd describes it.
+    """
+    info = {'file': file, 'title': title, 'album': album, 'artist': artist,
+            'date': date, 'genre': 'Pop', 'time': '100', 'track': '1'}
+    info.update(tags)
+    return info
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mpsd.db')
+        self.db = self.open(self.path)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def open(self, path):
+        db = dbase.MpsdDB(path)
+        db.connect()
+        return db
+
+    def rows(self, sql, db=None):
+        c = (db or self.db).db.cursor()
+        c.execute(sql)
+        return c.fetchall()
+
+    def derived(self, db=None):
+        """
+        The rows of the tables kept from the plays by triggers.
+        """
+        tables = ['%s_%s' % (key, part) for key, value in dbase.STATS
+                for part in ('daily', 'total')]
+        rows = [self.rows('''SELECT * FROM %s ORDER BY 1, 2''' % table, db)
+                for table in tables]
+        rows.append(self.rows('''SELECT source, start, last, end, plays, \
+                listentime, album, tracks, stopped, full_album FROM session \
+                ORDER BY start''', db))
+        return rows
+
+    def assertRebuilt(self, db=None):
+        """
+        Check the stats and sessions are what a rebuild makes of the plays.
+        """
+        kept = self.derived(db)
+        (db or self.db).rebuildStats()
+        self.assertEqual(kept, self.derived(db))
+
+class AlbumTest(DatabaseTest):
+    def albums(self):
+        return dict(self.rows('''SELECT title, album FROM track'''))
+
+    def testSameTitleAndDateByTwoArtists(self):
+        self.db.update(song('a.mp3', 'A', 'Greatest Hits', 'A'), 1000000)
+        self.db.update(song('b.mp3', 'B', 'Greatest Hits', 'B'), 1000100)
+        list(self.db.build([song('c.mp3', 'C', 'Greatest Hits', 'C')]))
+        list(self.db.addPlays([(song('d.mp3', 'D', 'Greatest Hits', 'D'),
+                1000200, 50)]))
+        self.db.flush()
+        self.assertEqual(len(set(self.albums().values())), 4)
+
+    def testAlbumArtist(self):
+        self.db.update(song('a.mp3', 'A', 'Hits', 'A', albumartist='VA'),
+                1000000)
+        self.db.update(song('b.mp3', 'B', 'Hits', 'B', albumartist='VA'),
+                1000100)
+        self.db.flush()
+        albums = self.albums()
+        self.assertEqual(albums['A'], albums['B'])
+
+# The schema of the first mpsd, before MIGRATIONS
+BASELINE = [
+    '''CREATE TABLE artist (id INTEGER, name TEXT, PRIMARY KEY (id))''',
+    '''CREATE TABLE album (id INTEGER, title TEXT, date INTEGER, \
+            artist INTEGER, FOREIGN KEY (artist) REFERENCES artist (id), \
+            PRIMARY KEY (id))''',
+    '''CREATE TABLE track (id INTEGER, num INTEGER, title TEXT, \
+            artist INTEGER, length INTEGER, genre TEXT, album INTEGER, \
+            FOREIGN KEY (album) REFERENCES album (id), \
+            FOREIGN KEY (artist) REFERENCES artist (id) PRIMARY KEY (id))''',
+    '''CREATE TABLE listened (track INTEGER, date TEXT, listentime INTEGER, \
+            FOREIGN KEY (track) REFERENCES track(id), \
+            PRIMARY KEY (track, date))''',
+]
+
+class MigrationTest(DatabaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mpsd.db')
+        db = sqlite3.connect(self.path)
+        for sql in BASELINE:
+            db.execute(sql)
+        # two artists' albums of one title, keyed by the placeholder album
+        # artist, and an artist recorded twice
+        db.executemany('''INSERT INTO artist VALUES (?, ?)''',
+                [(1, 'A'), (2, 'B'), (3, 'Unkown Artist'), (4, 'A')])
+        db.executemany('''INSERT INTO album VALUES (?, ?, ?, ?)''',
+                [(1, 'Greatest Hits', 2001, 3), (2, 'Solo', 1999, 4)])
+        db.executemany('''INSERT INTO track VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                [(1, 1, 'Song A', 1, 200, 'Pop', 1),
+                (2, 1, 'Song B', 2, 200, 'Rock', 1),
+                (3, 1, 'Alone', 4, 100, 'Pop', 2)])
+        self.listened = [(1, '2020-01-01 10:00:00', 150),
+                (2, '2020-01-01 10:05:00', 200),
+                (3, '2020-01-01 23:59:00', 100),
+                (1, '2020-01-02 09:00:00', 50)]
+        db.executemany('''INSERT INTO listened VALUES (?, ?, ?)''',
+                self.listened)
+        db.commit()
+        db.close()
+        self.db = self.open(self.path)
+
+    def testVersion(self):
+        self.assertEqual(self.rows('''SELECT max(version) \
+                FROM schema_version'''), [(dbase.MIGRATIONS[-1][0],)])
+
+    def testPlays(self):
+        self.assertEqual(self.rows('''SELECT date, track, listentime \
+                FROM play ORDER BY date'''),
+                [(dbase.epoch(date), track, listentime)
+                for track, date, listentime in self.listened])
+        # as older templates read them
+        self.assertEqual(self.rows('''SELECT track, date, listentime \
+                FROM listened ORDER BY date'''), self.listened)
+
+    def testArtists(self):
+        self.assertEqual(self.rows('''SELECT count(*) FROM artist \
+                WHERE name = 'A' '''), [(1,)])
+
+    def testAlbums(self):
+        albums = dict(self.rows('''SELECT title, album FROM track'''))
+        self.assertNotEqual(albums['Song A'], albums['Song B'])
+
+    def testStats(self):
+        self.assertEqual(self.rows('''SELECT plays, listentime \
+                FROM track_total WHERE track = 1'''), [(2, 200)])
+        self.assertRebuilt()
+
+class RetagTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        day = 24 * 60 * 60
+        for n, (file, artist) in enumerate([('a.mp3', 'A'), ('b.mp3', 'A'),
+                ('a.mp3', 'A'), ('c.mp3', 'B'), ('a.mp3', 'A')]):
+            date = 1000000 + n * day // 2
+            self.db.update(song(file, file, 'Hits', artist), date)
+            self.db.flush()
+            self.db.updateListentime(60 + n, date)
+            self.db.flush()
+
+    def testUpdate(self):
+        self.db.update(song('a.mp3', 'a.mp3', 'Other', 'C', genre='Jazz'),
+                2000000)
+        self.db.flush()
+        self.assertRebuilt()
+
+    def testBuild(self):
+        list(self.db.build([song('b.mp3', 'b.mp3', 'Hits', 'B', date='2002',
+                genre='Rock')]))
+        self.assertRebuilt()
+
+class MergeTest(DatabaseTest):
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        self.other = os.path.join(self.dir, 'other.db')
+        other = self.open(self.other)
+        for n in range(20):
+            for db, artist in ((self.db, 'A'), (other, 'B')):
+                db.update(song('%s%d' % (artist, n % 3), 'Song %d' % (n % 3),
+                        'Hits', artist), 1000000 + n * 1000)
+                db.flush()
+        # a play both have
+        other.update(song('A0', 'Song 0', 'Hits', 'A'), 1000000)
+        other.close()
+
+    def testMerge(self):
+        list(self.db.merge(self.other, batch_size=7))
+        self.assertEqual(self.rows('''SELECT count(*) FROM play'''), [(40,)])
+        self.assertRebuilt()
+
+    def testMergeAgain(self):
+        list(self.db.merge(self.other, batch_size=7))
+        plays = self.rows('''SELECT * FROM play ORDER BY 1, 2, 3''')
+        derived = self.derived()
+        self.assertEqual(list(self.db.merge(self.other))[-1], (21, 0))
+        self.assertEqual(self.rows('''SELECT * FROM play ORDER BY 1, 2, 3'''),
+                plays)
+        self.assertEqual(self.derived(), derived)
+
+if __name__ == '__main__':
+    unittest.main()
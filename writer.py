@@ -0,0 +1,131 @@
+import sys
+import time
+import threading
+import logging
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import metrics
+
+log = logging.getLogger('mpsd')
+
+class DBWriter(threading.Thread):
+    """
+    Writes plays and listen times to a MpsdDB from its own thread, so the
+    tracker only has to queue them up and never waits on the disk. Every
+    event is also written to each of sinks, objects with the same write
+    interface as MpsdDB (eg. sink.RemoteSink).
+    """
+    def __init__(self, db, queue_size=1000, put_timeout=1, warm_cache=False,
+            sinks=()):
+        threading.Thread.__init__(self, name='mpsd-writer')
+        self.daemon = True
+        self.db = db
+        self.sinks = [db] + list(sinks)
+        self.warm_cache = warm_cache
+        self.queue = queue.Queue(queue_size)
+        # when the queue is full, wait this long for room before dropping
+        self.put_timeout = put_timeout
+
+        # metrics
+        self.written = 0    # events written to the database
+        self.failed = 0     # events the database rejected
+        self.full = 0       # times an event found the queue full
+        self.dropped = 0    # events lost to a full queue
+        self.max_depth = 0  # longest the queue has been
+
+    def put(self, event):
+        """
+        Queue an event for the writer thread.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.full += 1
+            log.warning("Write queue full, waiting for the database")
+            try:
+                self.queue.put(event, timeout=self.put_timeout)
+            except queue.Full:
+                self.dropped += 1
+                log.error("Write queue full, dropped %s event" % event[0])
+                return
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def play(self, song, source=None):
+        """
+        Queue a play of song on source, returning the date it will be
+        recorded with.
+        """
+        date = int(time.time())
+        self.put(('play', song, date, source))
+        return date
+
+    def listentime(self, total, date, source=None, stopped=False):
+        """
+        Queue a listen time update for the play recorded at date, saying
+        whether the player stopped after it.
+        """
+        self.put(('listentime', total, date, source, stopped))
+
+    def stop(self):
+        """
+        Write out everything queued so far, then close the database and
+        end the thread.
+        """
+        if self.is_alive():
+            self.queue.put(('stop',))
+            self.join()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written,
+                'failed': self.failed, 'full': self.full,
+                'dropped': self.dropped, 'max_depth': self.max_depth}
+
+    def write(self, event):
+        """
+        Write event to every sink. Returns False if any of them failed.
+        """
+        ok = True
+        for sink in self.sinks:
+            try:
+                if event[0] == 'play':
+                    sink.update(*event[1:])
+                elif event[0] == 'listentime':
+                    sink.updateListentime(*event[1:])
+            except Exception:
+                ok = False
+                log.error("Could not write %s to %s: %s\n%s"
+                        % (event[0], sink.__class__.__name__,
+                            sys.exc_info()[1], event[1:]))
+        return ok
+
+    def commitTimeout(self):
+        timeouts = [t for t in (s.commitTimeout() for s in self.sinks)
+                if t != None]
+        return min(timeouts) if timeouts else None
+
+    def run(self):
+        # sqlite connections belong to the thread that opened them
+        for sink in self.sinks:
+            sink.connect(warm_cache=self.warm_cache)
+        while True:
+            try:
+                event = self.queue.get(timeout=self.commitTimeout())
+            except queue.Empty:
+                for sink in self.sinks:
+                    sink.commitIfDue()
+                continue
+            if event[0] == 'stop':
+                break
+            if self.write(event):
+                self.written += 1
+                if event[0] == 'play':
+                    metrics.PLAYS.inc(source=event[3] or '')
+            else:
+                self.failed += 1
+        for sink in self.sinks:
+            sink.close()
+        log.info("Writer stopped: %(written)d written, %(failed)d failed, "
+                "%(dropped)d dropped" % self.stats())